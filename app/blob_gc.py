@@ -0,0 +1,322 @@
+# app/blob_gc.py
+# Сборщик мусора хранилища зашифрованных файлов (user_files_encrypted/).
+#
+# 1. Удаленные файлы: soft_delete_file только ставит deleted_at. Через GC_DELETED_RETENTION_DAYS
+#    строки files удаляются пачками (DELETE ... WHERE file_id IN), затем удаляются их .enc-объекты -
+#    кроме тех, на которые еще ссылаются другие строки (дедупликация загрузок, app/dedup.py).
+# 2. Сироты: объекты хранилища (app/storage.py: каталоги шардов локально или бакет S3), которым
+#    не соответствует ни одна строка - .enc без строки files (упавшая загрузка, каскадное удаление
+#    пользователя) и .enc.part* без сессии загрузки. Хранилище читается потоково (os.scandir по каталогам
+#    или постраничный листинг S3) порциями по GC_SCAN_CHUNK имен, на каждую порцию - один SELECT ... IN;
+#    stat() делается только для кандидатов в сироты. Скорость сканирования ограничена
+#    GC_SCAN_RATE_PER_SECOND, чтобы не забивать диск и БД на хранилищах с миллионами файлов.
+#    Файлы моложе GC_ORPHAN_MIN_AGE_HOURS не трогаются: загрузка пишет файл раньше, чем строку в БД.
+#
+#   python -m app.blob_gc [--dry-run] [--deleted-only | --orphans-only]
+# В режиме dry-run ничего не удаляется, только считается (метрики в /metrics, итог в лог).
+import asyncio
+import itertools
+import logging
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional, Tuple
+
+from sqlalchemy import case, delete, func, select
+from starlette.concurrency import run_in_threadpool
+
+from . import models, storage
+from .config import settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+BLOB_NAME_RE = re.compile(r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.enc$")
+TEMP_NAME_RE = re.compile(r"^\.([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})\.enc\.part\d*(\.[0-9a-f]{32}\.tmp)?$")
+
+
+class GCProgress:
+    """Ход текущего/последнего прохода (для /metrics)."""
+
+    FIELDS = (
+        "scanned", "deleted_rows", "deleted_blobs", "orphan_blobs", "orphan_temp_files",
+        "skipped_young", "bytes_freed", "errors",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+        self.dry_run = False
+        self.runs = 0
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.counters = dict.fromkeys(self.FIELDS, 0)
+
+    def start(self, dry_run: bool) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+            self.dry_run = dry_run
+            self.started_at = datetime.now(timezone.utc)
+            self.finished_at = None
+            self.counters = dict.fromkeys(self.FIELDS, 0)
+            return True
+
+    def finish(self):
+        with self._lock:
+            self.running = False
+            self.runs += 1
+            self.finished_at = datetime.now(timezone.utc)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.GC_ENABLED,
+                "running": self.running,
+                "dry_run": self.dry_run,
+                "runs": self.runs,
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+                **self.counters,
+            }
+
+
+gc_progress = GCProgress()
+
+
+def _remove_blobs(target: storage.StorageBackend, blobs: List[Tuple[storage.StoredBlob, int]]) -> int:
+    """Удаляет объекты хранилища, возвращает освобожденные байты. Уже отсутствующие объекты - не ошибка."""
+    freed = 0
+    for blob, size in blobs:
+        try:
+            if target.delete(blob.key):
+                freed += size
+                gc_progress.count("deleted_blobs")
+        except Exception as e:
+            gc_progress.count("errors")
+            logger.warning(f"Не удалось удалить {blob.key}: {e}")
+    return freed
+
+
+def _blob_uuid(row) -> uuid.UUID:
+    """Имя объекта, в котором лежат данные строки (у дедуплицированной - объект исходного файла)."""
+    return row.blob_uuid or row.stored_filename_uuid
+
+
+def _remove_file_blobs(rows) -> int:
+    freed = 0
+    for row in rows:
+        try:
+            if storage.delete_file_blob(row.storage_path, _blob_uuid(row)):
+                freed += row.file_size_bytes or 0
+                gc_progress.count("deleted_blobs")
+        except Exception as e:
+            gc_progress.count("errors")
+            logger.warning(f"Не удалось удалить {row.storage_path}: {e}")
+    return freed
+
+
+async def _referenced_blobs(db, blob_uuids: List[uuid.UUID]) -> set:
+    """Какие из объектов еще нужны оставшимся строкам files (своим именем или через blob_uuid)."""
+    if not blob_uuids:
+        return set()
+    return (await _known_uuids(db, models.File.stored_filename_uuid, blob_uuids)
+            | await _known_uuids(db, models.File.blob_uuid, blob_uuids))
+
+
+async def purge_deleted_files(dry_run: bool = False) -> int:
+    """Окончательно удаляет файлы, удаленные раньше GC_DELETED_RETENTION_DAYS дней назад. Возвращает число строк."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=settings.GC_DELETED_RETENTION_DAYS)
+    expired = (models.File.deleted_at != None, models.File.deleted_at < cutoff)
+    async with AsyncSessionLocal() as db:
+        if dry_run:
+            # Оценка сверху: объект исходного файла, на который ссылаются живые дубликаты, не освободится
+            count, total_bytes = (await db.execute(
+                select(
+                    func.count(),
+                    func.coalesce(func.sum(case((models.File.blob_uuid == None, models.File.file_size_bytes), else_=0)), 0)
+                ).where(*expired)
+            )).one()
+            gc_progress.count("deleted_rows", count)
+            gc_progress.count("bytes_freed", int(total_bytes))
+            return count
+
+        purged = 0
+        while True:
+            rows = (await db.execute(
+                select(models.File.file_id, models.File.storage_path, models.File.stored_filename_uuid,
+                       models.File.blob_uuid, models.File.file_size_bytes)
+                .where(*expired).order_by(models.File.deleted_at).limit(settings.GC_BATCH_SIZE)
+            )).all()
+            if not rows:
+                break
+            # Сначала строки, потом файлы: если упадем между шагами, файлы станут сиротами и уйдут при сканировании
+            await db.execute(
+                delete(models.File)
+                .where(models.File.file_id.in_([row.file_id for row in rows]), *expired)
+                .execution_options(synchronize_session=False)
+            )
+            # Объект удаляется один раз и только если на него не ссылается ни одна оставшаяся строка
+            unique_rows = {}
+            for row in rows:
+                unique_rows.setdefault(_blob_uuid(row), row)
+            still_referenced = await _referenced_blobs(db, list(unique_rows))
+            await db.commit()
+            gc_progress.count("deleted_rows", len(rows))
+            gc_progress.count("bytes_freed", await run_in_threadpool(
+                _remove_file_blobs, [row for key, row in unique_rows.items() if key not in still_referenced]
+            ))
+            purged += len(rows)
+            if len(rows) < settings.GC_BATCH_SIZE:
+                break
+    return purged
+
+
+def _take(iterator: Iterator[storage.StoredBlob], count: int) -> List[storage.StoredBlob]:
+    return list(itertools.islice(iterator, count))
+
+
+def _old_enough(blobs: List[storage.StoredBlob], min_mtime: float) -> List[Tuple[storage.StoredBlob, int]]:
+    """Кандидаты старше min_mtime вместе с размером (stat только для них, не для всего хранилища)."""
+    old = []
+    for blob in blobs:
+        try:
+            size, mtime = blob.stat()
+            if mtime < min_mtime:
+                old.append((blob, size))
+            else:
+                gc_progress.count("skipped_young")
+        except FileNotFoundError:
+            pass
+    return old
+
+
+async def _known_uuids(db, column, uuids: List[uuid.UUID]) -> set:
+    if not uuids:
+        return set()
+    return set((await db.scalars(select(column).where(column.in_(uuids)))).all())
+
+
+async def _scan_target(db, target: storage.StorageBackend, dry_run: bool, min_mtime: float) -> int:
+    chunk_size = max(1, settings.GC_SCAN_CHUNK)
+    found = 0
+    iterator = target.iter_blobs()
+    try:
+        while True:
+            chunk_started = time.monotonic()
+            entries = await run_in_threadpool(_take, iterator, chunk_size)
+            if not entries:
+                break
+            gc_progress.count("scanned", len(entries))
+
+            blobs, temps = {}, {}
+            for entry in entries:
+                match = BLOB_NAME_RE.match(entry.name)
+                if match:
+                    blobs.setdefault(uuid.UUID(match.group(1)), []).append(entry)
+                    continue
+                match = TEMP_NAME_RE.match(entry.name)
+                if match:
+                    temps.setdefault(uuid.UUID(match.group(1)), []).append(entry)
+
+            # Строки files учитываются и удаленные: их файлы уберет purge_deleted_files после срока хранения
+            known_blobs = await _referenced_blobs(db, list(blobs))
+            known_temps = await _known_uuids(db, models.UploadSession.stored_filename_uuid, list(temps))
+            orphan_blobs = [entry for key, group in blobs.items() if key not in known_blobs for entry in group]
+            orphan_temps = [entry for key, group in temps.items() if key not in known_temps for entry in group]
+            await db.rollback() # Не держим транзакцию между порциями
+
+            candidates = orphan_blobs + orphan_temps
+            if candidates:
+                old = await run_in_threadpool(_old_enough, candidates, min_mtime)
+                old_keys = {entry.key for entry, _ in old}
+                gc_progress.count("orphan_blobs", sum(1 for entry in orphan_blobs if entry.key in old_keys))
+                gc_progress.count("orphan_temp_files", sum(1 for entry in orphan_temps if entry.key in old_keys))
+                found += len(old)
+                if dry_run:
+                    gc_progress.count("bytes_freed", sum(size for _, size in old))
+                elif old:
+                    gc_progress.count("bytes_freed", await run_in_threadpool(_remove_blobs, target, old))
+
+            # Ограничение скорости: не быстрее GC_SCAN_RATE_PER_SECOND имен в секунду
+            if settings.GC_SCAN_RATE_PER_SECOND > 0:
+                pause = len(entries) / settings.GC_SCAN_RATE_PER_SECOND - (time.monotonic() - chunk_started)
+                if pause > 0:
+                    await asyncio.sleep(pause)
+    finally:
+        iterator.close()
+    return found
+
+
+async def scan_orphans(dry_run: bool = False) -> int:
+    """Ищет (и удаляет, если не dry_run) объекты хранилища без строк в БД. Возвращает число найденных сирот."""
+    min_mtime = time.time() - settings.GC_ORPHAN_MIN_AGE_HOURS * 3600
+    found = 0
+    async with AsyncSessionLocal() as db:
+        for target in storage.scan_targets():
+            found += await _scan_target(db, target, dry_run, min_mtime)
+    return found
+
+
+async def run_gc(dry_run: bool = False, deleted: bool = True, orphans: bool = True) -> Optional[dict]:
+    """Один проход сборщика. None, если предыдущий проход в этом процессе еще идет."""
+    if not gc_progress.start(dry_run):
+        return None
+    try:
+        result = {}
+        if deleted:
+            result["deleted_files"] = await purge_deleted_files(dry_run)
+        if orphans:
+            result["orphans"] = await scan_orphans(dry_run)
+        return result
+    finally:
+        gc_progress.finish()
+
+
+async def gc_loop():
+    while True:
+        await asyncio.sleep(settings.GC_INTERVAL_SECONDS) # Первый проход - не при старте, чтобы не мешать прогреву
+        try:
+            result = await run_gc(dry_run=settings.GC_DRY_RUN)
+            if result and any(result.values()):
+                logger.info(f"Сборка мусора хранилища{' (dry-run)' if settings.GC_DRY_RUN else ''}: {result}, {gc_progress.snapshot()}")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            gc_progress.count("errors")
+            logger.error("Ошибка сборки мусора хранилища", exc_info=True)
+
+
+async def _run_cli(dry_run: bool, deleted: bool, orphans: bool):
+    from .database import async_engine
+    try:
+        result = await run_gc(dry_run=dry_run, deleted=deleted, orphans=orphans)
+        print(f"{'Найдено (dry-run)' if dry_run else 'Удалено'}: {result}")
+        print(gc_progress.snapshot())
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    import sys
+    from .logging_config import configure_logging, stop_logging
+    arguments = set(sys.argv[1:])
+    if not arguments <= {"--dry-run", "--deleted-only", "--orphans-only"} or {"--deleted-only", "--orphans-only"} <= arguments:
+        print("Usage: python -m app.blob_gc [--dry-run] [--deleted-only | --orphans-only]")
+        sys.exit(2)
+    configure_logging()
+    try:
+        asyncio.run(_run_cli(
+            dry_run="--dry-run" in arguments,
+            deleted="--orphans-only" not in arguments,
+            orphans="--deleted-only" not in arguments,
+        ))
+    finally:
+        stop_logging()
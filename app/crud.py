@@ -1,43 +1,46 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import delete, func, or_ # Добавляем func для count и or_ для поиска
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, func, or_, select, tuple_, update # func для count, or_ для ссылок на объект хранилища
+from sqlalchemy.exc import IntegrityError
 from . import models, schemas
-from .security import get_password_hash, verify_password
+from .password_hashing import hash_password, hash_passwords, verify_password # bcrypt - в отдельном ограниченном пуле
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Tuple # Добавляем Optional и Tuple
 from datetime import datetime # Для фильтрации по дате
 from . import encryption
-import random
+import secrets
 import string # для генерации резервных кодов
-from .security import create_refresh_token_value
+from .security import create_refresh_token_value, backup_code_lookup, normalize_backup_code
 from .config import settings
 import uuid
 from . import encryption # Наш модуль шифрования
+from . import search
 import base64
+import json
 # --- User ---
-def get_user(db: Session, user_id: int) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.user_id == user_id).first()
+async def get_user(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.scalar(select(models.User).filter(models.User.user_id == user_id).limit(1))
 
-def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.email == email).first()
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).filter(models.User.email == email).limit(1))
 
-def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[models.User]:
+    return await db.scalar(select(models.User).filter(models.User.username == username).limit(1))
 
-def create_user(db: Session, user: schemas.UserCreate) -> models.User:
-    hashed_password = get_password_hash(user.password)
+async def create_user(db: AsyncSession, user: schemas.UserCreate) -> models.User:
+    hashed_password = await hash_password(user.password)
     db_user = models.User(
         username=user.username,
         email=user.email,
         password_hash=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 # --- Temporary 2FA/Registration Codes ---
-def create_pending_registration_code(
-    db: Session, 
+async def create_pending_registration_code(
+    db: AsyncSession, 
     email: str, 
     username: str, 
     password_hash: str, 
@@ -46,7 +49,7 @@ def create_pending_registration_code(
 ) -> models.TwoFactorTempCode:
     expires_at = datetime.now(timezone.utc) + timedelta(minutes=expires_delta_minutes)
     # Удаляем предыдущие незавершенные попытки регистрации на этот email
-    db.execute(
+    await db.execute(
         delete(models.TwoFactorTempCode)
         .where(models.TwoFactorTempCode.pending_email == email)
         .where(models.TwoFactorTempCode.purpose == "registration_verify")
@@ -62,36 +65,29 @@ def create_pending_registration_code(
         expires_at=expires_at
     )
     db.add(db_code)
-    db.commit()
-    db.refresh(db_code)
+    await db.commit()
+    await db.refresh(db_code)
     return db_code
 
-def get_valid_pending_registration_code(
-    db: Session, 
+async def get_valid_pending_registration_code(
+    db: AsyncSession, 
     email: str, 
     code_to_verify: str
 ) -> Optional[models.TwoFactorTempCode]:
+    # Просроченные коды только отфильтровываем; удаляет их фоновый sweeper (app/sweeper.py)
     now = datetime.now(timezone.utc)
-    # Очистка просроченных кодов регистрации
-    db.execute(
-        delete(models.TwoFactorTempCode)
-        .where(models.TwoFactorTempCode.purpose == "registration_verify")
-        .where(models.TwoFactorTempCode.expires_at < now)
-    )
-    db.commit()
-
-    return db.query(models.TwoFactorTempCode).filter(
+    return await db.scalar(select(models.TwoFactorTempCode).filter(
         models.TwoFactorTempCode.pending_email == email,
         models.TwoFactorTempCode.code == code_to_verify,
         models.TwoFactorTempCode.purpose == "registration_verify",
         models.TwoFactorTempCode.expires_at >= now
-    ).first()
+    ).limit(1))
 
 # Обновляем create_temp_2fa_code для логина
-def create_temp_login_2fa_code(db: Session, user_id: int, code: str, expires_delta_minutes: int = 5) -> models.TwoFactorTempCode:
+async def create_temp_login_2fa_code(db: AsyncSession, user_id: int, code: str, expires_delta_minutes: int = 5) -> models.TwoFactorTempCode:
     expires_at = datetime.now(timezone.utc) + timedelta(minutes=expires_delta_minutes)
     # Удаляем старые логин-коды этого пользователя
-    db.execute(
+    await db.execute(
         delete(models.TwoFactorTempCode)
         .where(models.TwoFactorTempCode.user_id == user_id)
         .where(models.TwoFactorTempCode.purpose == "login_2fa")
@@ -105,92 +101,133 @@ def create_temp_login_2fa_code(db: Session, user_id: int, code: str, expires_del
         expires_at=expires_at
     )
     db.add(db_code)
-    db.commit()
-    db.refresh(db_code)
+    await db.commit()
+    await db.refresh(db_code)
     return db_code
 
 # Обновляем get_valid_temp_2fa_code для логина
-def get_valid_temp_login_2fa_code(db: Session, user_id: int, code_to_verify: str) -> Optional[models.TwoFactorTempCode]:
+async def get_valid_temp_login_2fa_code(db: AsyncSession, user_id: int, code_to_verify: str) -> Optional[models.TwoFactorTempCode]:
+    # Просроченные коды только отфильтровываем; удаляет их фоновый sweeper (app/sweeper.py)
     now = datetime.now(timezone.utc)
-    # Очистка просроченных логин-кодов
-    db.execute(
-        delete(models.TwoFactorTempCode)
-        .where(models.TwoFactorTempCode.purpose == "login_2fa")
-        .where(models.TwoFactorTempCode.expires_at < now) # Можно добавить и user_id для оптимизации
-    ) 
-    db.commit()
-
-    return db.query(models.TwoFactorTempCode).filter(
+    return await db.scalar(select(models.TwoFactorTempCode).filter(
         models.TwoFactorTempCode.user_id == user_id,
         models.TwoFactorTempCode.code == code_to_verify,
         models.TwoFactorTempCode.purpose == "login_2fa",
         models.TwoFactorTempCode.expires_at >= now
-    ).first()
+    ).limit(1))
 
 # delete_temp_2fa_code остается таким же, он удаляет по ID
-def delete_temp_code_entry(db: Session, temp_code_id: int): # Переименовал для ясности
-     db_code = db.query(models.TwoFactorTempCode).filter(models.TwoFactorTempCode.id == temp_code_id).first()
+async def delete_temp_code_entry(db: AsyncSession, temp_code_id: int): # Переименовал для ясности
+     db_code = await db.scalar(select(models.TwoFactorTempCode).filter(models.TwoFactorTempCode.id == temp_code_id).limit(1))
      if db_code:
-         db.delete(db_code)
-         db.commit()
+         await db.delete(db_code)
+         await db.commit()
 
 # create_user остается почти таким же, но вызывается теперь из другого места
-def create_user_from_pending(db: Session, pending_username: str, pending_email: str, pending_password_hash: str) -> models.User:
+async def create_user_from_pending(db: AsyncSession, pending_username: str, pending_email: str, pending_password_hash: str,
+                                   temp_code_id: int, num_backup_codes: int = 5) -> Tuple[models.User, list[str]]:
+    """Создает пользователя с резервными кодами и удаляет код регистрации одной транзакцией.
+
+    Коды хешируются до любых изменений в БД: если пул bcrypt занят (PasswordHashPoolBusy -> 429),
+    ни пользователь, ни удаление кода регистрации не сохраняются и подтверждение можно повторить.
+    """
+    hashed_codes = await _hash_backup_codes(num_backup_codes)
     db_user = models.User(
         username=pending_username,
         email=pending_email,
         password_hash=pending_password_hash
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
+    await db.flush() # Нужен user_id для code_lookup
+    _add_backup_codes(db, db_user.user_id, hashed_codes)
+    await db.execute(delete(models.TwoFactorTempCode).where(models.TwoFactorTempCode.id == temp_code_id))
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user, [code_value for code_value, _ in hashed_codes]
 
 # --- Backup Codes ---
+BACKUP_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
 def _generate_backup_code_value(length: int = 10) -> str:
     # Пример: A1B2-C3D4-E5F6 (группы по 4, разделенные дефисом)
-    chars = string.ascii_uppercase + string.digits
-    code = "".join(random.choices(chars, k=length))
+    # secrets, а не random: коды заменяют второй фактор и не должны быть предсказуемы
+    code = "".join(secrets.choice(BACKUP_CODE_ALPHABET) for _ in range(length))
     # Можно добавить форматирование, если нужно
     # formatted_code = '-'.join([code[i:i+4] for i in range(0, len(code), 4)])
     return code # пока простой
 
-def create_backup_codes_for_user(db: Session, user_id: int, num_codes: int = 5) -> list[str]:
+async def _hash_backup_codes(num_codes: int) -> list[Tuple[str, str]]:
+    plain_codes = [_generate_backup_code_value() for _ in range(num_codes)]
+    code_hashes = await hash_passwords(plain_codes) # Одной пачкой, параллельно на воркерах пула
+    return list(zip(plain_codes, code_hashes))
+
+def _add_backup_codes(db: AsyncSession, user_id: int, hashed_codes: list[Tuple[str, str]]):
+    db.add_all([
+        models.UserBackupCode(
+            user_id=user_id,
+            code_hash=code_hash,
+            code_lookup=backup_code_lookup(user_id, code_value)
+        )
+        for code_value, code_hash in hashed_codes
+    ])
+
+async def create_backup_codes_for_user(db: AsyncSession, user_id: int, num_codes: int = 5) -> list[str]:
+    # Сначала хешируем: при занятом пуле bcrypt старые коды остаются на месте
+    hashed_codes = await _hash_backup_codes(num_codes)
     # Удаляем старые неиспользованные коды
-    db.execute(
+    await db.execute(
         delete(models.UserBackupCode)
         .where(models.UserBackupCode.user_id == user_id)
         .where(models.UserBackupCode.is_used == False)
     )
-    # db.commit() # Можно коммитить здесь
-
-    plain_codes = []
-    for _ in range(num_codes):
-        code_value = _generate_backup_code_value()
-        plain_codes.append(code_value)
-        code_hash = get_password_hash(code_value) # Хешируем как пароль
-        db_backup_code = models.UserBackupCode(user_id=user_id, code_hash=code_hash)
-        db.add(db_backup_code)
-    db.commit()
-    return plain_codes
-
-def verify_and_use_backup_code(db: Session, user_id: int, backup_code_value: str) -> bool:
-    backup_codes_query = db.query(models.UserBackupCode).filter(
+    _add_backup_codes(db, user_id, hashed_codes)
+    await db.commit()
+    return [code_value for code_value, _ in hashed_codes]
+
+async def _mark_backup_code_used(db: AsyncSession, db_code_entry: models.UserBackupCode) -> bool:
+    # Условный UPDATE: из двух параллельных входов одним кодом пройдет только один
+    result = await db.execute(
+        update(models.UserBackupCode)
+        .where(
+            models.UserBackupCode.backup_code_id == db_code_entry.backup_code_id,
+            models.UserBackupCode.is_used == False
+        )
+        .values(is_used=True, used_at=datetime.now(timezone.utc))
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+async def verify_and_use_backup_code(db: AsyncSession, user_id: int, backup_code_value: str) -> bool:
+    """Одна выборка по индексу (user_id, code_lookup) и не больше одной проверки bcrypt."""
+    code_value = normalize_backup_code(backup_code_value)
+    db_code_entry = await db.scalar(
+        select(models.UserBackupCode).filter(
+            models.UserBackupCode.user_id == user_id,
+            models.UserBackupCode.code_lookup == backup_code_lookup(user_id, code_value),
+            models.UserBackupCode.is_used == False
+        ).limit(1)
+    )
+    if db_code_entry is not None:
+        # HMAC уже нашел строку; bcrypt остается второй линией защиты на случай утечки SECRET_KEY
+        if await verify_password(code_value, db_code_entry.code_hash):
+            return await _mark_backup_code_used(db, db_code_entry)
+        return False
+
+    # Коды, выданные до появления code_lookup, ищем старым перебором. Таких строк становится
+    # меньше с каждой перегенерацией кодов, у новых пользователей их нет совсем.
+    legacy_codes_query = select(models.UserBackupCode).filter(
         models.UserBackupCode.user_id == user_id,
+        models.UserBackupCode.code_lookup == None,
         models.UserBackupCode.is_used == False
     )
-    
-    for db_code_entry in backup_codes_query.all():
-        if verify_password(backup_code_value, db_code_entry.code_hash):
-            db_code_entry.is_used = True
-            db_code_entry.used_at = datetime.now(timezone.utc)
-            db.commit()
-            return True
+    for db_code_entry in (await db.scalars(legacy_codes_query)).all():
+        if await verify_password(code_value, db_code_entry.code_hash):
+            return await _mark_backup_code_used(db, db_code_entry)
     return False
 
 # --- Refresh Tokens ---
-def create_db_refresh_token(
-    db: Session, 
+async def create_db_refresh_token(
+    db: AsyncSession, 
     user_id: int, 
     # expires_delta: Optional[timedelta] = None # Можно передавать, или брать из настроек
     # Пока возьмем из настроек, если они есть
@@ -200,7 +237,7 @@ def create_db_refresh_token(
     
     # Удаляем старые refresh токены этого пользователя перед созданием нового
     # (политика "один активный refresh token на пользователя", можно изменить)
-    db.execute(
+    await db.execute(
         delete(models.RefreshToken)
         .where(models.RefreshToken.user_id == user_id)
     )
@@ -215,102 +252,147 @@ def create_db_refresh_token(
         expires_at=expires_at
     )
     db.add(db_refresh_token)
-    db.commit()
-    db.refresh(db_refresh_token)
+    await db.commit()
+    await db.refresh(db_refresh_token)
     return db_refresh_token
 
-def get_refresh_token_by_value(db: Session, token_value: str) -> Optional[models.RefreshToken]:
+async def get_refresh_token_by_value(db: AsyncSession, token_value: str) -> Optional[models.RefreshToken]:
+    # Просроченные токены только отфильтровываем; удаляет их фоновый sweeper (app/sweeper.py)
     now = datetime.now(timezone.utc)
-    # Очистка всех просроченных refresh токенов (можно делать периодически)
-    db.execute(
-        delete(models.RefreshToken)
-        .where(models.RefreshToken.expires_at < now)
-    )
-    db.commit()
-
-    return db.query(models.RefreshToken).filter(
+    return await db.scalar(select(models.RefreshToken).filter(
         models.RefreshToken.token == token_value,
         models.RefreshToken.expires_at >= now
         # Дополнительно можно проверить models.RefreshToken.revoked_at is None, если есть такое поле
-    ).first()
+    ).limit(1))
 
-def delete_refresh_token(db: Session, token_id: int): # Удаление по ID токена
-    db_token = db.query(models.RefreshToken).filter(models.RefreshToken.id == token_id).first()
+async def delete_refresh_token(db: AsyncSession, token_id: int): # Удаление по ID токена
+    db_token = await db.scalar(select(models.RefreshToken).filter(models.RefreshToken.id == token_id).limit(1))
     if db_token:
-        db.delete(db_token)
-        db.commit()
+        await db.delete(db_token)
+        await db.commit()
 
-def delete_refresh_token_by_value(db: Session, token_value: str): # Удаление по значению токена
-    db_token = db.query(models.RefreshToken).filter(models.RefreshToken.token == token_value).first()
+async def delete_refresh_token_by_value(db: AsyncSession, token_value: str): # Удаление по значению токена
+    db_token = await db.scalar(select(models.RefreshToken).filter(models.RefreshToken.token == token_value).limit(1))
     if db_token:
-        db.delete(db_token)
-        db.commit()
+        await db.delete(db_token)
+        await db.commit()
 
 # --- Files ---
-def create_file_metadata(
-    db: Session,
+async def create_file_metadata(
+    db: AsyncSession,
     user_id: int,
     original_filename: str,
     mime_type: str,
     file_size_bytes: int,
     storage_path: str, # Путь к ЗАШИФРОВАННОМУ файлу
-    file_data_iv: bytes, # IV, использованный для шифрования данных файла
-    file_data_auth_tag: bytes, # Тег аутентификации для данных файла
-    file_encryption_key: bytes # Сгенерированный ключ для шифрования этого файла (DEK)
+    file_data_iv: bytes, # IV (старый формат) или префикс nonce (сегментированный формат)
+    file_data_auth_tag: bytes, # Тег аутентификации данных (для сегментированного формата - тег последнего сегмента)
+    file_encryption_key: bytes, # Сгенерированный ключ для шифрования этого файла (DEK)
+    encryption_algorithm: str = encryption.SEGMENTED_ALGORITHM, # Формат/версия зашифрованного файла на диске
+    plaintext_size_bytes: Optional[int] = None, # Размер исходного (незашифрованного) файла
+    stored_filename_uuid: Optional[uuid.UUID] = None, # UUID, под которым файл лежит на диске
+    content_hash: Optional[str] = None # security.content_hasher от исходного содержимого (для дедупликации)
 ) -> models.File:
     
+    # Строка счетчиков должна существовать до вставки файла (иначе бэкфилл посчитает его дважды)
+    await ensure_user_file_stats(db, user_id)
+
     # Шифруем ключ файла (DEK) с помощью KEK (из settings.SECRET_KEY)
     encrypted_dek_hex, dek_iv_hex, dek_auth_tag_hex = encryption.encrypt_file_key(file_encryption_key)
 
     db_file = models.File(
         user_id=user_id,
         original_filename=original_filename,
-        # stored_filename_uuid генерируется по умолчанию в модели
+        stored_filename_uuid=stored_filename_uuid or uuid.uuid4(), # Совпадает с именем файла на диске
         storage_path=storage_path,
         mime_type=mime_type,
+        mime_family=mime_family(mime_type),
         file_size_bytes=file_size_bytes, # Размер зашифрованного файла может немного отличаться
-        encryption_algorithm="AES-256-GCM", # Хардкодим, т.к. используем его
+        plaintext_size_bytes=plaintext_size_bytes,
+        encryption_algorithm=encryption_algorithm,
         encryption_iv=base64.b16encode(file_data_iv).decode(),
         encryption_auth_tag=base64.b16encode(file_data_auth_tag).decode(),
         encrypted_dek_hex=encrypted_dek_hex,
         dek_iv_hex=dek_iv_hex,
-        dek_auth_tag_hex=dek_auth_tag_hex
+        dek_auth_tag_hex=dek_auth_tag_hex,
+        content_hash=content_hash
     )
     db.add(db_file)
-    db.commit()
-    db.refresh(db_file)
+    # Счетчики меняются в той же транзакции, что и сама запись о файле
+    await _change_user_file_stats(db, user_id, mime_type, files_delta=1, bytes_delta=file_size_bytes)
+    await db.commit()
+    await db.refresh(db_file)
+    search.file_added(db, db_file)
     return db_file
 
-def get_files_for_user(
-    db: Session, 
-    user_id: int, 
-    skip: int = 0, 
-    limit: int = 100,
+async def find_file_by_content_hash(db: AsyncSession, user_id: int, content_hash: str) -> Optional[models.File]:
+    """Неудаленный файл пользователя с тем же содержимым (по индексу idx_files_live_user_content_hash)."""
+    return await db.scalar(select(models.File)
+        .filter(models.File.user_id == user_id, models.File.content_hash == content_hash, models.File.deleted_at == None)
+        .order_by(models.File.file_id)
+        .limit(1))
+
+async def create_deduplicated_file(
+    db: AsyncSession,
+    source: models.File, # Неудаленный файл того же пользователя с тем же содержимым
+    original_filename: str,
+    mime_type: str
+) -> models.File:
+    """Новая запись о файле, которая использует зашифрованный объект (и DEK) файла source, без второй копии данных."""
+    user_id = source.user_id
+    await ensure_user_file_stats(db, user_id)
+    db_file = models.File(
+        user_id=user_id,
+        original_filename=original_filename,
+        stored_filename_uuid=uuid.uuid4(), # Объекта с этим именем нет, данные лежат под blob_uuid
+        blob_uuid=source.blob_uuid or source.stored_filename_uuid,
+        storage_path=source.storage_path,
+        mime_type=mime_type,
+        mime_family=mime_family(mime_type),
+        file_size_bytes=source.file_size_bytes,
+        plaintext_size_bytes=source.plaintext_size_bytes,
+        encryption_algorithm=source.encryption_algorithm,
+        encryption_iv=source.encryption_iv,
+        encryption_auth_tag=source.encryption_auth_tag,
+        encrypted_dek_hex=source.encrypted_dek_hex,
+        dek_iv_hex=source.dek_iv_hex,
+        dek_auth_tag_hex=source.dek_auth_tag_hex,
+        content_hash=source.content_hash
+    )
+    db.add(db_file)
+    await _change_user_file_stats(db, user_id, mime_type, files_delta=1, bytes_delta=source.file_size_bytes,
+                                  saved_bytes_delta=source.file_size_bytes)
+    await db.commit()
+    await db.refresh(db_file)
+    search.file_added(db, db_file)
+    return db_file
+
+async def _apply_file_filters(
+    db: AsyncSession,
+    query,
+    user_id: int,
     search_term: Optional[str] = None,
     mime_type_filter: Optional[str] = None,
     date_from_filter: Optional[datetime] = None,
     date_to_filter: Optional[datetime] = None,
-    sort_by: Optional[str] = None, # Поле для сортировки: "original_filename", "uploaded_at", "mime_type", "file_size_bytes"
-    sort_order: Optional[str] = "desc" # "asc" или "desc"
-) -> List[models.File]:
-    query = db.query(models.File).filter(models.File.user_id == user_id, models.File.deleted_at == None)
-
+    search_mode: Optional[str] = None
+):
+    """Общие фильтры списка файлов (используются и для страницы, и для подсчета)."""
     # Фильтрация и поиск
     if search_term:
-        # Ищем по имени файла ИЛИ по MIME-типу (можно расширить)
-        # Используем ilike для регистронезависимого поиска
-        query = query.filter(
-            or_(
-                models.File.original_filename.ilike(f"%{search_term}%"),
-                models.File.mime_type.ilike(f"%{search_term}%")
-            )
-        )
+        # Ищем по имени файла ИЛИ по MIME-типу; бэкенд (индекс) выбирается настройкой SEARCH_BACKEND
+        query = await search.apply_search(query, db, user_id, search_term, search_mode)
     
     if mime_type_filter:
-        # Точное совпадение или частичное, если нужно (например, "image/" для всех изображений)
-        # query = query.filter(models.File.mime_type == mime_type_filter) 
-        query = query.filter(models.File.mime_type.ilike(f"%{mime_type_filter}%"))
-
+        # Сравнение на равенство, чтобы работали индексы (вместо ILIKE '%...%'):
+        # "image/png" - точный MIME-тип, "image" - семейство, "pdf" - подтип любого семейства
+        mime_type_filter = mime_type_filter.strip().lower()
+        if "/" in mime_type_filter:
+            query = query.filter(models.File.mime_type == mime_type_filter) # MIME-типы хранятся как прислал клиент, обычно в нижнем регистре
+        elif mime_type_filter in MIME_FAMILIES:
+            query = query.filter(models.File.mime_family == mime_type_filter)
+        else:
+            query = query.filter(models.File.mime_type.ilike(f"%/{mime_type_filter}"))
 
     if date_from_filter:
         query = query.filter(models.File.uploaded_at >= date_from_filter)
@@ -320,67 +402,364 @@ def get_files_for_user(
         # или используем datetime с временем 23:59:59
         # query = query.filter(models.File.uploaded_at <= (date_to_filter + timedelta(days=1)))
         query = query.filter(models.File.uploaded_at <= date_to_filter)
+    return query
+
+def _apply_file_page(query, skip: int, limit: int, sort_by: Optional[str], sort_order: Optional[str], cursor: Optional[str]):
+    # Сортировка: всегда добавляем file_id как тай-брейкер, чтобы порядок был однозначным
+    # (это нужно и для стабильной пагинации по offset, и для курсоров)
+    sort_by, sort_order = _normalize_file_sort(sort_by, sort_order)
+    column_to_sort = getattr(models.File, sort_by)
+    if sort_order == "asc":
+        query = query.order_by(column_to_sort.asc(), models.File.file_id.asc())
+    else: # По умолчанию desc
+        query = query.order_by(column_to_sort.desc(), models.File.file_id.desc())
+
+    if cursor:
+        # Keyset-пагинация: продолжаем строго после последней записи предыдущей страницы.
+        # Условие (col, file_id) </> (значение, id) использует индекс и не сканирует пропущенные строки,
+        # поэтому время ответа не зависит от глубины страницы.
+        cursor_value, cursor_file_id = decode_file_cursor(cursor, sort_by, sort_order)
+        position = tuple_(column_to_sort, models.File.file_id)
+        if sort_order == "asc":
+            query = query.filter(position > tuple_(cursor_value, cursor_file_id))
+        else:
+            query = query.filter(position < tuple_(cursor_value, cursor_file_id))
+        return query.limit(limit)
 
+    return query.offset(skip).limit(limit)
 
-    # Сортировка
-    if sort_by:
-        column_to_sort = getattr(models.File, sort_by, None)
-        if column_to_sort: # Проверяем, что такое поле существует в модели
-            if sort_order == "asc":
-                query = query.order_by(column_to_sort.asc())
-            else: # По умолчанию desc
-                query = query.order_by(column_to_sort.desc())
-        else:
-            # По умолчанию сортируем по дате загрузки, если sort_by некорректный
-            query = query.order_by(models.File.uploaded_at.desc())
-    else:
-        # Сортировка по умолчанию
-        query = query.order_by(models.File.uploaded_at.desc())
-        
-    return query.offset(skip).limit(limit).all()
+async def get_files_for_user(
+    db: AsyncSession, 
+    user_id: int, 
+    skip: int = 0, 
+    limit: int = 100,
+    search_term: Optional[str] = None,
+    mime_type_filter: Optional[str] = None,
+    date_from_filter: Optional[datetime] = None,
+    date_to_filter: Optional[datetime] = None,
+    sort_by: Optional[str] = None, # Поле для сортировки: "original_filename", "uploaded_at", "mime_type", "file_size_bytes"
+    sort_order: Optional[str] = "desc", # "asc" или "desc"
+    cursor: Optional[str] = None, # Токен из encode_file_cursor; если задан, skip не используется
+    search_mode: Optional[str] = None # "substring" (по умолчанию), "prefix" или "tokens"
+) -> List[models.File]:
+    query = select(models.File).filter(models.File.user_id == user_id, models.File.deleted_at == None)
+    query = await _apply_file_filters(db, query, user_id, search_term, mime_type_filter, date_from_filter, date_to_filter, search_mode)
+    return list((await db.scalars(_apply_file_page(query, skip, limit, sort_by, sort_order, cursor))).all())
 
-def count_files_for_user(
-    db: Session, 
+async def get_files_with_total_for_user(
+    db: AsyncSession,
+    user_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    search_term: Optional[str] = None,
+    mime_type_filter: Optional[str] = None,
+    date_from_filter: Optional[datetime] = None,
+    date_to_filter: Optional[datetime] = None,
+    sort_by: Optional[str] = None,
+    sort_order: Optional[str] = "desc",
+    search_mode: Optional[str] = None
+) -> Tuple[List[models.File], Optional[int]]:
+    """Страница файлов и общее число совпадений за один запрос (COUNT(*) OVER ()).
+
+    Оконная функция считается по всем строкам, прошедшим WHERE, до LIMIT/OFFSET.
+    Если страница пуста, число не определено - возвращается None.
+    Не подходит для курсоров: условие курсора тоже попадает в WHERE.
+    """
+    query = select(models.File, func.count().over().label("total_count"))\
+        .filter(models.File.user_id == user_id, models.File.deleted_at == None)
+    query = await _apply_file_filters(db, query, user_id, search_term, mime_type_filter, date_from_filter, date_to_filter, search_mode)
+    rows = (await db.execute(_apply_file_page(query, skip, limit, sort_by, sort_order, cursor=None))).all()
+    if not rows:
+        return [], None
+    return [row[0] for row in rows], rows[0][1]
+
+# --- Курсоры для пагинации списка файлов ---
+FILE_SORT_FIELDS = ("original_filename", "uploaded_at", "mime_type", "file_size_bytes")
+
+def _normalize_file_sort(sort_by: Optional[str], sort_order: Optional[str]) -> Tuple[str, str]:
+    if sort_by not in FILE_SORT_FIELDS:
+        sort_by = "uploaded_at" # По умолчанию сортируем по дате загрузки
+    return sort_by, "asc" if sort_order == "asc" else "desc"
+
+def encode_file_cursor(db_file: models.File, sort_by: Optional[str], sort_order: Optional[str]) -> str:
+    """Непрозрачный токен позиции после db_file для заданной сортировки."""
+    sort_by, sort_order = _normalize_file_sort(sort_by, sort_order)
+    value = getattr(db_file, sort_by)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps({"s": sort_by, "o": sort_order, "v": value, "id": db_file.file_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_file_cursor(cursor: str, sort_by: Optional[str], sort_order: Optional[str]) -> Tuple[object, int]:
+    """Возвращает (значение поля сортировки, file_id). ValueError, если курсор поврежден или от другой сортировки."""
+    sort_by, sort_order = _normalize_file_sort(sort_by, sort_order)
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        value, file_id = payload["v"], int(payload["id"])
+        if payload["s"] != sort_by or payload["o"] != sort_order:
+            raise ValueError("Cursor was issued for a different sort order.")
+        if sort_by == "uploaded_at":
+            value = datetime.fromisoformat(value)
+        elif sort_by == "file_size_bytes":
+            value = int(value)
+        elif not isinstance(value, str):
+            raise ValueError("Invalid cursor value.")
+    except (ValueError, KeyError, TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from e
+    return value, file_id
+
+async def count_files_for_user(
+    db: AsyncSession, 
     user_id: int,
     search_term: Optional[str] = None,         # <--- ДОБАВИТЬ
     mime_type_filter: Optional[str] = None,    # <--- ДОБАВИТЬ
     date_from_filter: Optional[datetime] = None, # <--- ДОБАВИТЬ
-    date_to_filter: Optional[datetime] = None    # <--- ДОБАВИТЬ
+    date_to_filter: Optional[datetime] = None,   # <--- ДОБАВИТЬ
+    search_mode: Optional[str] = None
 ) -> int:
-    query = db.query(models.File).filter(models.File.user_id == user_id, models.File.deleted_at == None)
-
+    query = select(func.count(models.File.file_id)).filter(models.File.user_id == user_id, models.File.deleted_at == None)
     # Применяем те же фильтры, что и в get_files_for_user
-    if search_term:
-        query = query.filter(
-            or_(
-                models.File.original_filename.ilike(f"%{search_term}%"),
-                models.File.mime_type.ilike(f"%{search_term}%")
-            )
-        )
-    if mime_type_filter:
-        query = query.filter(models.File.mime_type.ilike(f"%{mime_type_filter}%"))
-    
-    if date_from_filter:
-        query = query.filter(models.File.uploaded_at >= date_from_filter)
-    
-    if date_to_filter:
-        query = query.filter(models.File.uploaded_at <= date_to_filter)
-        
-    count = query.count()
+    query = await _apply_file_filters(db, query, user_id, search_term, mime_type_filter, date_from_filter, date_to_filter, search_mode)
+    count = await db.scalar(query)
     return count
 
-def get_file_by_id_and_user(db: Session, file_id: int, user_id: int) -> Optional[models.File]:
-    return db.query(models.File)\
+async def estimate_files_count_for_user(
+    db: AsyncSession,
+    user_id: int,
+    search_term: Optional[str] = None,
+    mime_type_filter: Optional[str] = None,
+    date_from_filter: Optional[datetime] = None,
+    date_to_filter: Optional[datetime] = None,
+    search_mode: Optional[str] = None
+) -> int:
+    """Оценка числа совпадений по статистике планировщика PostgreSQL (EXPLAIN, без сканирования).
+
+    На других СУБД (SQLite в тестах) оценки нет - считаем точно.
+    """
+    dialect = db.get_bind().dialect
+    if dialect.name != "postgresql":
+        return await count_files_for_user(db, user_id, search_term, mime_type_filter, date_from_filter, date_to_filter, search_mode)
+    query = select(models.File.file_id).filter(models.File.user_id == user_id, models.File.deleted_at == None)
+    query = await _apply_file_filters(db, query, user_id, search_term, mime_type_filter, date_from_filter, date_to_filter, search_mode)
+    # Параметры подставляем литералами: у asyncpg и psycopg2 разный paramstyle, а значения уже проверены
+    compiled = query.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    plan = (await (await db.connection()).exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}")).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+async def get_file_by_id_and_user(db: AsyncSession, file_id: int, user_id: int) -> Optional[models.File]:
+    return await db.scalar(select(models.File)\
         .filter(models.File.file_id == file_id)\
         .filter(models.File.user_id == user_id)\
         .filter(models.File.deleted_at == None)\
-        .first()
-
-def soft_delete_file(db: Session, file_id: int, user_id: int) -> Optional[models.File]:
-    db_file = get_file_by_id_and_user(db, file_id=file_id, user_id=user_id)
+        .limit(1))
+
+async def _has_other_live_references(db: AsyncSession, db_file: models.File) -> bool:
+    """Ссылается ли на объект хранилища файла db_file еще какая-нибудь неудаленная строка (дедупликация)."""
+    blob_uuid = db_file.blob_uuid or db_file.stored_filename_uuid
+    return await db.scalar(select(models.File.file_id)
+        .filter(models.File.user_id == db_file.user_id, models.File.deleted_at == None, models.File.file_id != db_file.file_id)
+        .filter(or_(models.File.stored_filename_uuid == blob_uuid, models.File.blob_uuid == blob_uuid))
+        .limit(1)) is not None
+
+async def soft_delete_file(db: AsyncSession, file_id: int, user_id: int) -> Optional[models.File]:
+    db_file = await get_file_by_id_and_user(db, file_id=file_id, user_id=user_id)
     if db_file:
+        await ensure_user_file_stats(db, user_id)
+        # Экономия по объекту = (живых ссылок - 1) * размер: уменьшается, только если у объекта остаются другие ссылки
+        # (неважно, удаляется исходная строка или дубликат)
+        saved_bytes_delta = -db_file.file_size_bytes if await _has_other_live_references(db, db_file) else 0
         db_file.deleted_at = datetime.now(timezone.utc)
-        db.commit()
-        db.refresh(db_file)
+        await _change_user_file_stats(db, user_id, db_file.mime_type, files_delta=-1, bytes_delta=-db_file.file_size_bytes,
+                                      saved_bytes_delta=saved_bytes_delta)
+        await db.commit()
+        await db.refresh(db_file)
+        search.file_removed(db, db_file)
         # Файл на диске пока не удаляем, это можно делать фоновой задачей
-    return db_file
\ No newline at end of file
+    return db_file
+
+# --- Счетчики файлов пользователя ---
+# Зарегистрированные типы верхнего уровня (IANA); фильтр mime_type с таким значением сравнивается с mime_family
+MIME_FAMILIES = ("application", "audio", "font", "example", "haptics", "image", "message", "model", "multipart", "text", "video")
+
+def mime_family(mime_type: Optional[str]) -> str:
+    """Семейство MIME-типа: "image/png" -> "image". Пустой или странный тип считаем "application"."""
+    family = (mime_type or "").split("/", 1)[0].strip().lower()
+    return family[:50] or "application"
+
+async def ensure_user_file_stats(db: AsyncSession, user_id: int) -> models.UserFileStats:
+    """Возвращает строку счетчиков пользователя, при первом обращении заполняя ее по таблице files.
+
+    Бэкфилл коммитится отдельно, поэтому вызывать нужно до изменений файлов в текущей транзакции.
+    """
+    # populate_existing: счетчики меняются UPDATE-ами в обход объекта в сессии, перечитываем из БД
+    db_stats = await db.get(models.UserFileStats, user_id, populate_existing=True)
+    if db_stats:
+        return db_stats
+
+    total_files, total_bytes = (await db.execute(
+        select(func.count(models.File.file_id), func.coalesce(func.sum(models.File.file_size_bytes), 0))
+        .filter(models.File.user_id == user_id, models.File.deleted_at == None)
+    )).one()
+    # Экономия от дедупликации: по каждому объекту с несколькими живыми ссылками (ссылки - 1) * размер
+    blob_uuid = func.coalesce(models.File.blob_uuid, models.File.stored_filename_uuid)
+    dedup_saved_bytes = sum((count - 1) * size for count, size in await db.execute(
+        select(func.count(models.File.file_id), func.max(models.File.file_size_bytes))
+        .filter(models.File.user_id == user_id, models.File.deleted_at == None)
+        .group_by(blob_uuid)
+        .having(func.count(models.File.file_id) > 1)))
+    family_counts = {}
+    for db_mime_type, count in await db.execute(
+            select(models.File.mime_type, func.count(models.File.file_id))
+            .filter(models.File.user_id == user_id, models.File.deleted_at == None)
+            .group_by(models.File.mime_type)):
+        family = mime_family(db_mime_type)
+        family_counts[family] = family_counts.get(family, 0) + count
+
+    db.add(models.UserFileStats(user_id=user_id, total_files=total_files, total_bytes=total_bytes, dedup_saved_bytes=dedup_saved_bytes))
+    for family, count in family_counts.items():
+        db.add(models.UserMimeFamilyStats(user_id=user_id, mime_family=family, file_count=count))
+    try:
+        await db.commit()
+    except IntegrityError: # Параллельный запрос успел заполнить счетчики раньше нас
+        await db.rollback()
+    return await db.get(models.UserFileStats, user_id, populate_existing=True)
+
+async def _change_user_file_stats(db: AsyncSession, user_id: int, mime_type: Optional[str], files_delta: int, bytes_delta: int,
+                                  saved_bytes_delta: int = 0):
+    # Атомарные UPDATE ... SET x = x + delta: параллельные загрузки не теряют инкременты
+    await db.execute(
+        update(models.UserFileStats)
+        .where(models.UserFileStats.user_id == user_id)
+        .values(
+            total_files=models.UserFileStats.total_files + files_delta,
+            total_bytes=models.UserFileStats.total_bytes + bytes_delta,
+            dedup_saved_bytes=models.UserFileStats.dedup_saved_bytes + saved_bytes_delta,
+            updated_at=datetime.now(timezone.utc)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    family = mime_family(mime_type)
+    result = await db.execute(
+        update(models.UserMimeFamilyStats)
+        .where(models.UserMimeFamilyStats.user_id == user_id, models.UserMimeFamilyStats.mime_family == family)
+        .values(file_count=models.UserMimeFamilyStats.file_count + files_delta)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0 and files_delta > 0:
+        # Первый файл этого семейства; SAVEPOINT, чтобы гонка за вставку не откатила весь файл
+        try:
+            async with db.begin_nested():
+                db.add(models.UserMimeFamilyStats(user_id=user_id, mime_family=family, file_count=files_delta))
+        except IntegrityError:
+            await db.execute(
+                update(models.UserMimeFamilyStats)
+                .where(models.UserMimeFamilyStats.user_id == user_id, models.UserMimeFamilyStats.mime_family == family)
+                .values(file_count=models.UserMimeFamilyStats.file_count + files_delta)
+                .execution_options(synchronize_session=False)
+            )
+
+async def get_user_mime_family_counts(db: AsyncSession, user_id: int) -> dict:
+    await ensure_user_file_stats(db, user_id)
+    rows = (await db.scalars(select(models.UserMimeFamilyStats)\
+        .filter(models.UserMimeFamilyStats.user_id == user_id, models.UserMimeFamilyStats.file_count > 0)\
+        .order_by(models.UserMimeFamilyStats.mime_family))).all()
+    return {row.mime_family: row.file_count for row in rows}
+
+# --- Upload Sessions (возобновляемые загрузки) ---
+async def create_upload_session(
+    db: AsyncSession,
+    user_id: int,
+    original_filename: str,
+    mime_type: str,
+    upload_length: int,
+    temp_path: str,
+    stored_filename_uuid: uuid.UUID,
+    segment_size: int,
+    nonce_prefix: bytes,
+    file_encryption_key: bytes,
+    part_size: Optional[int] = None # Только для multipart-загрузок
+) -> models.UploadSession:
+    # DEK храним только в зашифрованном KEK виде, как и для готовых файлов
+    encrypted_dek_hex, dek_iv_hex, dek_auth_tag_hex = encryption.encrypt_file_key(file_encryption_key)
+    db_session = models.UploadSession(
+        user_id=user_id,
+        original_filename=original_filename,
+        mime_type=mime_type,
+        upload_length=upload_length,
+        upload_offset=0,
+        stored_filename_uuid=stored_filename_uuid,
+        temp_path=temp_path,
+        segment_size=segment_size,
+        nonce_prefix_hex=nonce_prefix.hex(),
+        encrypted_dek_hex=encrypted_dek_hex,
+        dek_iv_hex=dek_iv_hex,
+        dek_auth_tag_hex=dek_auth_tag_hex,
+        part_size=part_size,
+        expires_at=datetime.now(timezone.utc) + timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    )
+    db.add(db_session)
+    await db.commit()
+    await db.refresh(db_session)
+    return db_session
+
+async def get_upload_session(db: AsyncSession, upload_id: uuid.UUID, user_id: int) -> Optional[models.UploadSession]:
+    return await db.scalar(select(models.UploadSession).filter(
+        models.UploadSession.upload_id == upload_id,
+        models.UploadSession.user_id == user_id,
+        models.UploadSession.expires_at >= datetime.now(timezone.utc)
+    ).limit(1))
+
+async def advance_upload_session(db: AsyncSession, db_session: models.UploadSession, expected_offset: int, new_offset: int) -> bool:
+    """Сдвигает offset сессии, только если он не изменился с момента чтения (защита от гонок между воркерами)."""
+    result = await db.execute(
+        update(models.UploadSession)
+        .where(
+            models.UploadSession.upload_id == db_session.upload_id,
+            models.UploadSession.upload_offset == expected_offset
+        )
+        .values(
+            upload_offset=new_offset,
+            updated_at=datetime.now(timezone.utc),
+            # Активная сессия продлевается
+            expires_at=datetime.now(timezone.utc) + timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    await db.refresh(db_session)
+    return result.rowcount == 1
+
+async def delete_upload_session(db: AsyncSession, db_session: models.UploadSession):
+    await db.delete(db_session)
+    await db.commit()
+
+async def get_expired_upload_sessions(db: AsyncSession, limit: int = 100) -> List[models.UploadSession]:
+    return list((await db.scalars(select(models.UploadSession).filter(
+        models.UploadSession.expires_at < datetime.now(timezone.utc)
+    ).order_by(models.UploadSession.expires_at).limit(limit))).all())
+
+async def upsert_upload_part(db: AsyncSession, db_session: models.UploadSession, part_number: int, size: int) -> models.UploadPart:
+    """Регистрирует загруженную часть; повторная загрузка той же части заменяет запись."""
+    db_part = await db.scalar(select(models.UploadPart).filter(
+        models.UploadPart.upload_id == db_session.upload_id,
+        models.UploadPart.part_number == part_number
+    ).limit(1))
+    if db_part:
+        db_part.size = size
+        db_part.created_at = datetime.now(timezone.utc)
+    else:
+        db_part = models.UploadPart(upload_id=db_session.upload_id, part_number=part_number, size=size)
+        db.add(db_part)
+    # Активная сессия продлевается
+    db_session.expires_at = datetime.now(timezone.utc) + timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    await db.commit()
+    await db.refresh(db_part)
+    return db_part
+
+async def get_upload_parts(db: AsyncSession, upload_id: uuid.UUID) -> List[models.UploadPart]:
+    return list((await db.scalars(select(models.UploadPart).filter(
+        models.UploadPart.upload_id == upload_id
+    ).order_by(models.UploadPart.part_number))).all())
+
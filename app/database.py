@@ -1,19 +1,147 @@
+import threading
+import time
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from .config import settings
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# Асинхронные драйверы для схем из DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def make_async_url(database_url: str) -> str:
+    """Строит URL для асинхронного движка из синхронного DATABASE_URL (postgresql -> asyncpg, sqlite -> aiosqlite)."""
+    scheme, sep, rest = database_url.partition("://")
+    if not sep:
+        return database_url
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+
+SQLALCHEMY_ASYNC_DATABASE_URL = settings.ASYNC_DATABASE_URL or make_async_url(SQLALCHEMY_DATABASE_URL)
+
+
+class PoolMetrics:
+    """Счетчики ожидания соединений из пула (отдаются в /metrics вместе с pool.status())."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, wait_seconds: float, timed_out: bool = False):
+        with self._lock:
+            if timed_out:
+                self.checkout_timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            attempts = self.checkouts + self.checkout_timeouts
+            return {
+                "checkouts": self.checkouts,
+                "checkout_timeouts": self.checkout_timeouts,
+                "checkout_wait_seconds_total": round(self.wait_seconds_total, 6),
+                "checkout_wait_seconds_avg": round(self.wait_seconds_total / attempts, 6) if attempts else 0.0,
+                "checkout_wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+
+class _InstrumentedPoolMixin:
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        # Время от запроса соединения до его получения: ожидание свободного слота (+ открытие нового соединения)
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - started)
+        return connection
+
+
+def _instrumented_pool_class(pool_class, metrics: PoolMetrics):
+    # Метрики - атрибут класса, а не аргумент: engine.dispose() пересоздает пул через pool.recreate().
+    # __module__ как у исходного пула: имя логгера пула остается sqlalchemy.pool.*, а не app.* (уровень логгера "app")
+    return type(
+        f"Instrumented{pool_class.__name__}",
+        (_InstrumentedPoolMixin, pool_class),
+        {"metrics": metrics, "__module__": pool_class.__module__}
+    )
+
+
+def _pool_options(database_url: str, pool_class, metrics: PoolMetrics) -> dict:
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {} # База в памяти живет в одном соединении - пул по умолчанию (без QueuePool)
+    return {
+        "poolclass": _instrumented_pool_class(pool_class, metrics),
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+
+
+sync_pool_metrics = PoolMetrics()
+async_pool_metrics = PoolMetrics()
+
+# Синхронный движок: создание таблиц/миграции при старте и CLI-утилиты
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **_pool_options(SQLALCHEMY_DATABASE_URL, QueuePool, sync_pool_metrics))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Асинхронный движок: все запросы из эндпоинтов, чтобы ожидание БД не блокировало event loop
+async_engine = create_async_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL,
+    **_pool_options(SQLALCHEMY_ASYNC_DATABASE_URL, AsyncAdaptedQueuePool, async_pool_metrics)
+)
+# expire_on_commit=False: после commit атрибуты не перечитываются лениво (в async это недопустимо)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+def _pool_stats(pool, metrics: PoolMetrics) -> dict:
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            "size": pool.size(),
+            "in_use": pool.checkedout(),
+            "idle": pool.checkedin(),
+            "overflow": pool.overflow(), # Отрицательное значение - сколько соединений пула еще не открыто
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+        })
+    stats.update(metrics.snapshot())
+    return stats
+
+
+def pool_stats() -> dict:
+    return {
+        "async": _pool_stats(async_engine.pool, async_pool_metrics),
+        "sync": _pool_stats(engine.pool, sync_pool_metrics),
+    }
+
 Base = declarative_base()
 
 # Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
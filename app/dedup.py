@@ -0,0 +1,60 @@
+# app/dedup.py
+# Дедупликация загрузок в пределах одного пользователя.
+# При загрузке (/files/upload и /files/upload/stream) по мере чтения считается security.content_hasher -
+# HMAC-SHA256 исходного содержимого с ключом пользователя. Если у пользователя уже есть неудаленный файл
+# с тем же хешем, новая запись File ссылается на его зашифрованный объект и DEK (File.blob_uuid),
+# а только что зашифрованная копия удаляется, не попадая в хранилище.
+# Объект удаляет app/blob_gc.py, когда на него не остается ни одной строки files (в т.ч. удаленной).
+# Возобновляемые и multipart-загрузки не дедуплицируются: их данные приходят разными запросами
+# (и частями параллельно), состояние HMAC между ними не сохранить.
+import threading
+from typing import Optional
+
+from . import security
+from .config import settings
+
+
+class HashingReader:
+    """Обертка над файлом-источником: все прочитанные байты попадают в hasher."""
+
+    def __init__(self, stream, hasher):
+        self._stream = stream
+        self._hasher = hasher
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._hasher.update(data)
+        return data
+
+
+def new_content_hasher(user_id: int):
+    """HMAC для содержимого новой загрузки или None, если дедупликация выключена (UPLOAD_DEDUP_ENABLED)."""
+    return security.content_hasher(user_id) if settings.UPLOAD_DEDUP_ENABLED else None
+
+
+class DedupStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.hits = 0
+        self.bytes_saved = 0
+
+    def record(self, duplicate_size: Optional[int]):
+        with self._lock:
+            self.checks += 1
+            if duplicate_size is not None:
+                self.hits += 1
+                self.bytes_saved += duplicate_size
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.UPLOAD_DEDUP_ENABLED,
+                "checks": self.checks,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.checks, 4) if self.checks else 0.0,
+                "bytes_saved": self.bytes_saved, # С запуска процесса; по пользователям - user_file_stats.dedup_saved_bytes
+            }
+
+
+dedup_stats = DedupStats()
@@ -1,40 +1,72 @@
 # app/deps.py
-from fastapi import Depends, HTTPException, status
+import hmac
+from typing import Optional
+
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from . import crud, models, schemas
+from . import crud, schemas
+from .config import settings
 from .database import get_db
 from .security import decode_access_token
+from .user_cache import user_cache
 
 # URL для получения токена (эндпоинт /login/verify-2fa или /login/verify-backup-code)
 # Важно, чтобы этот URL был относительным к префиксу API, если он есть
 # Если префикс /api/v1, то tokenUrl="/api/v1/auth/login/verify-2fa" (или куда идет финальный логин)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/login/verify-2fa") 
 
-async def get_current_user(
-    db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
-) -> models.User:
-    credentials_exception = HTTPException(
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
-    print(f"DEBUG: Полученный token_input в get_current_user: {token}")
+
+
+async def get_current_identity(token: str = Depends(oauth2_scheme)) -> schemas.TokenData:
+    """Идентичность из claims JWT без обращения к БД: для эндпоинтов, которым нужен только user_id.
+
+    Токен удаленного пользователя остается рабочим до истечения (ACCESS_TOKEN_EXPIRE_MINUTES),
+    но все его данные удаляются каскадом, так что доступа к чужому это не дает.
+    """
     token_data = decode_access_token(token)
     if token_data is None or token_data.user_id is None:
-        raise credentials_exception
-    
-    user = crud.get_user(db, user_id=token_data.user_id)
-    if user is None:
-        raise credentials_exception
-    return user
+        raise _credentials_exception()
+    return token_data
+
+
+async def get_current_user(
+    db: AsyncSession = Depends(get_db), token_data: schemas.TokenData = Depends(get_current_identity)
+) -> schemas.User:
+    # Сначала кэш в памяти процесса, SELECT - только при промахе
+    user = user_cache.get(token_data.user_id)
+    if user is not None:
+        return user
+    db_user = await crud.get_user(db, user_id=token_data.user_id)
+    if db_user is None:
+        raise _credentials_exception()
+    return user_cache.put(db_user)
 
 async def get_current_active_user(
-    current_user: models.User = Depends(get_current_user)
-) -> models.User:
+    current_user: schemas.User = Depends(get_current_user)
+) -> schemas.User:
     # Здесь можно добавить проверку, если у пользователя есть флаг is_active
     # if not current_user.is_active:
     #     raise HTTPException(status_code=400, detail="Inactive user")
-    return current_user
\ No newline at end of file
+    return current_user
+
+
+async def require_metrics_token(authorization: Optional[str] = Header(None)):
+    """Доступ к внутренним метрикам процесса только по METRICS_TOKEN (не по JWT пользователя)."""
+    if not settings.METRICS_TOKEN:
+        # Токен не настроен - эндпоинта как будто нет
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid metrics token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
@@ -2,13 +2,24 @@
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives import padding as sym_padding # для AES-CBC, если бы использовали
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidTag
+from typing import NamedTuple, Optional
 import os
 import base64
+import logging
+import queue
+import struct
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
 from .config import settings # Для SECRET_KEY, который будет "мастер-ключом" для шифрования ключей файлов
 
+logger = logging.getLogger(__name__)
+
 # --- Функции для шифрования/дешифрования ключей файлов (ДЕКов) ---
 # Это упрощенный пример. В проде нужен KMS или Vault.
 # Используем SECRET_KEY приложения как KEK (Key Encryption Key)
@@ -27,11 +38,51 @@ def derive_kek(password: str, salt: bytes) -> bytes:
     )
     return kdf.derive(password.encode())
 
-KEK = derive_kek(settings.SECRET_KEY, KEK_SALT) # Ключ для шифрования ключей файлов
+# KEK вычисляется лениво, один раз на процесс, при первом обращении (а не при импорте модуля):
+# 100k итераций PBKDF2 не должны замедлять запуск каждого воркера, теста и CLI-команды.
+# Источники KEK по приоритету:
+#   1. KEK_HEX  - заранее вычисленный ключ (64 hex-символа), например вывод `python -m app.encryption derive-kek`;
+#   2. KEK_FILE - файл с высокоэнтропийным секретом (>= 32 байт), ключ получается через HKDF (дешево);
+#   3. PBKDF2 от SECRET_KEY (как раньше).
+# Важно: KEK_FILE дает ДРУГОЙ ключ, чем PBKDF2 от SECRET_KEY, поэтому переключаться на него можно только
+# на новой базе (или после перешифрования DEK). KEK_HEX от derive-kek совместим с существующими данными.
+KEK_HKDF_INFO = b"pochta-files KEK v1"
+_kek: Optional[bytes] = None
+_kek_lock = threading.Lock()
+
+def _load_kek() -> bytes:
+    if settings.KEK_HEX:
+        kek = bytes.fromhex(settings.KEK_HEX.strip())
+        if len(kek) != 32:
+            raise ValueError("KEK_HEX must encode exactly 32 bytes (64 hex characters).")
+        return kek
+    if settings.KEK_FILE:
+        with open(settings.KEK_FILE, "rb") as key_file:
+            key_material = key_file.read().strip()
+        if len(key_material) < 32:
+            raise ValueError("KEK_FILE must contain at least 32 bytes of high-entropy key material.")
+        # Исходный материал уже высокоэнтропийный, поэтому медленный KDF не нужен
+        return HKDF(algorithm=hashes.SHA256(), length=32, salt=KEK_SALT, info=KEK_HKDF_INFO).derive(key_material)
+    return derive_kek(settings.SECRET_KEY, KEK_SALT)
+
+def get_kek() -> bytes:
+    """Ключ для шифрования ключей файлов (KEK). Вычисляется при первом вызове и кэшируется."""
+    global _kek
+    if _kek is None:
+        with _kek_lock:
+            if _kek is None:
+                _kek = _load_kek()
+    return _kek
+
+def reset_kek():
+    """Сбрасывает закэшированный KEK (после смены настроек). Кэш DEK при этом нужно очистить отдельно."""
+    global _kek
+    with _kek_lock:
+        _kek = None
 
 def encrypt_file_key(file_key: bytes) -> tuple[str, str]: # возвращает (зашифрованный_ключ_hex, iv_hex)
     iv = os.urandom(12) # GCM рекомендует 12 байт IV
-    cipher = Cipher(algorithms.AES(KEK), modes.GCM(iv), backend=default_backend())
+    cipher = Cipher(algorithms.AES(get_kek()), modes.GCM(iv), backend=default_backend())
     encryptor = cipher.encryptor()
     encrypted_data = encryptor.update(file_key) + encryptor.finalize()
     # Возвращаем зашифрованный ключ и IV в hex, и тег аутентификации
@@ -41,7 +92,7 @@ def decrypt_file_key(encrypted_file_key_hex: str, iv_hex: str, auth_tag_hex: str
     iv = base64.b16decode(iv_hex)
     encrypted_data = base64.b16decode(encrypted_file_key_hex)
     auth_tag = base64.b16decode(auth_tag_hex)
-    cipher = Cipher(algorithms.AES(KEK), modes.GCM(iv, auth_tag), backend=default_backend())
+    cipher = Cipher(algorithms.AES(get_kek()), modes.GCM(iv, auth_tag), backend=default_backend())
     decryptor = cipher.decryptor()
     return decryptor.update(encrypted_data) + decryptor.finalize()
 
@@ -49,29 +100,406 @@ def decrypt_file_key(encrypted_file_key_hex: str, iv_hex: str, auth_tag_hex: str
 def generate_random_file_key(key_size_bytes: int = 32) -> bytes: # 32 байта для AES-256
     return os.urandom(key_size_bytes)
 
-def encrypt_file_stream(input_stream, output_stream, file_key: bytes):
-    """Шифрует данные из input_stream и пишет в output_stream, используя AES-GCM."""
-    iv = os.urandom(12)  # GCM рекомендует 12 байт IV
-    output_stream.write(iv) # Сначала пишем IV в выходной файл/поток
+# --- Сегментированный формат файлов (STREAM-подобная конструкция, как в age) ---
+# Файл на диске:
+#   заголовок (16 байт): MAGIC (4) | версия (1) | размер сегмента, uint32 BE (4) | префикс nonce (7)
+#   сегменты: AES-GCM(plaintext сегмента) + тег (16 байт); все сегменты, кроме последнего, полные
+# Nonce сегмента = префикс (7) | номер сегмента, uint32 BE (4) | флаг последнего сегмента (1).
+# Заголовок передается как AAD в каждый сегмент, поэтому подмена размера/версии, перестановка,
+# удаление или обрезка сегментов обнаруживаются. Каждый сегмент проверяется независимо,
+# что позволяет отдавать данные по мере проверки, начинать с любого смещения и работать параллельно.
+LEGACY_ALGORITHM = "AES-256-GCM" # Старый формат: IV (12) + один GCM-поток, тег хранится в БД
+SEGMENTED_ALGORITHM = "AES-256-GCM-SEG-v1" # Значение File.encryption_algorithm для нового формата
+
+SEGMENTED_MAGIC = b"PCHF"
+SEGMENTED_VERSION = 1
+SEGMENTED_HEADER_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+GCM_TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_INDEX = 2**32 - 1
+
+
+class SegmentedHeader(NamedTuple):
+    segment_size: int
+    nonce_prefix: bytes
+    raw: bytes # Байты заголовка как есть (используются как AAD)
+
+
+def build_segmented_header(segment_size: int, nonce_prefix: bytes) -> SegmentedHeader:
+    raw = SEGMENTED_MAGIC + struct.pack(">BI", SEGMENTED_VERSION, segment_size) + nonce_prefix
+    return SegmentedHeader(segment_size, nonce_prefix, raw)
+
+
+def parse_segmented_header(raw: bytes) -> SegmentedHeader:
+    if len(raw) != SEGMENTED_HEADER_SIZE or raw[:4] != SEGMENTED_MAGIC:
+        raise ValueError("Decryption failed: not a segmented encrypted file.")
+    version, segment_size = struct.unpack(">BI", raw[4:9])
+    if version != SEGMENTED_VERSION:
+        raise ValueError(f"Decryption failed: unsupported segmented format version {version}.")
+    if segment_size <= 0:
+        raise ValueError("Decryption failed: invalid segment size in header.")
+    return SegmentedHeader(segment_size, raw[9:], raw)
+
+
+def _segment_nonce(nonce_prefix: bytes, index: int, final: bool) -> bytes:
+    if index > MAX_SEGMENT_INDEX:
+        raise ValueError("File is too large for the segmented format.")
+    return nonce_prefix + struct.pack(">IB", index, 1 if final else 0)
+
+
+def encrypt_segment(aead: AESGCM, header: SegmentedHeader, index: int, plaintext: bytes, final: bool) -> bytes:
+    """Шифрует один сегмент; результат = ciphertext + тег (16 байт)."""
+    return aead.encrypt(_segment_nonce(header.nonce_prefix, index, final), plaintext, header.raw)
+
+
+def decrypt_segment(aead: AESGCM, header: SegmentedHeader, index: int, ciphertext: bytes, final: bool) -> bytes:
+    """Проверяет и дешифрует один сегмент. При несовпадении тега бросает ValueError."""
+    try:
+        return aead.decrypt(_segment_nonce(header.nonce_prefix, index, final), ciphertext, header.raw)
+    except InvalidTag as e:
+        raise ValueError(f"Decryption failed: segment {index} is corrupted or was tampered with.") from e
+
+
+def segment_count(encrypted_size: int, segment_size: int) -> int:
+    """Число сегментов в файле по его зашифрованному размеру (включая заголовок)."""
+    body_size = encrypted_size - SEGMENTED_HEADER_SIZE
+    if body_size < GCM_TAG_SIZE:
+        raise ValueError("Decryption failed: encrypted file is truncated.")
+    full_segment = segment_size + GCM_TAG_SIZE
+    return (body_size + full_segment - 1) // full_segment
+
+
+def segmented_encrypted_size(plaintext_size: int, segment_size: int) -> int:
+    """Размер файла на диске (заголовок + сегменты с тегами) для plaintext_size байт исходных данных."""
+    segments = max(1, -(-plaintext_size // segment_size)) # Пустой файл - один пустой финальный сегмент
+    return SEGMENTED_HEADER_SIZE + plaintext_size + segments * GCM_TAG_SIZE
 
-    cipher = Cipher(algorithms.AES(file_key), modes.GCM(iv), backend=default_backend())
-    encryptor = cipher.encryptor()
 
-    chunk_size = 4096  # Читаем и шифруем по частям
+def segmented_plaintext_size(encrypted_size: int, segment_size: int) -> int:
+    """Размер исходных данных: без заголовка и тегов. Ничего не дешифрует."""
+    return encrypted_size - SEGMENTED_HEADER_SIZE - segment_count(encrypted_size, segment_size) * GCM_TAG_SIZE
+
+
+class SegmentedEncryptor:
+    """Инкрементальный шифратор сегментированного формата.
+
+    update() принимает данные любыми порциями и возвращает готовые зашифрованные байты;
+    последний полный сегмент придерживается до следующего update()/finalize(),
+    потому что только тогда известно, является ли он финальным.
+    """
+
+    def __init__(self, file_key: bytes, segment_size: int = DEFAULT_SEGMENT_SIZE, nonce_prefix: Optional[bytes] = None):
+        self.header = build_segmented_header(segment_size, nonce_prefix or os.urandom(NONCE_PREFIX_SIZE))
+        self._aead = AESGCM(file_key)
+        self._buffer = bytearray()
+        self._next_index = 0
+        self._header_written = False
+        self.plaintext_size = 0
+        self.final_tag: Optional[bytes] = None
+
+    def _take_header(self) -> bytes:
+        if self._header_written:
+            return b""
+        self._header_written = True
+        return self.header.raw
+
+    def update(self, data: bytes) -> bytes:
+        if self.final_tag is not None:
+            raise ValueError("Encryptor already finalized.")
+        self._buffer += data
+        self.plaintext_size += len(data)
+        out = [self._take_header()]
+        segment_size = self.header.segment_size
+        # Строго больше: последний полный сегмент может оказаться финальным
+        while len(self._buffer) > segment_size:
+            out.append(encrypt_segment(self._aead, self.header, self._next_index, bytes(self._buffer[:segment_size]), final=False))
+            del self._buffer[:segment_size]
+            self._next_index += 1
+        return b"".join(out)
+
+    def finalize(self) -> bytes:
+        if self.final_tag is not None:
+            raise ValueError("Encryptor already finalized.")
+        last = encrypt_segment(self._aead, self.header, self._next_index, bytes(self._buffer), final=True)
+        self._buffer.clear()
+        self.final_tag = last[-GCM_TAG_SIZE:]
+        return self._take_header() + last
+
+
+def encrypt_file_stream(input_stream, output_stream, file_key: bytes, segment_size: int = DEFAULT_SEGMENT_SIZE):
+    """Шифрует данные из input_stream и пишет в output_stream в сегментированном формате (SEGMENTED_ALGORITHM)."""
+    encryptor = SegmentedEncryptor(file_key, segment_size)
     while True:
-        chunk = input_stream.read(chunk_size)
+        chunk = input_stream.read(segment_size)
         if not chunk:
             break
-        encrypted_chunk = encryptor.update(chunk)
-        output_stream.write(encrypted_chunk)
-    
-    encrypted_final_chunk = encryptor.finalize()
-    output_stream.write(encrypted_final_chunk)
-    
-    # Сохраняем тег аутентификации (важно для GCM)
-    # Его нужно будет сохранить в метаданных файла в БД
-    auth_tag = encryptor.tag
-    return iv, auth_tag # Возвращаем IV и тег, чтобы сохранить их
+        output_stream.write(encryptor.update(chunk))
+    output_stream.write(encryptor.finalize())
+    # Префикс nonce и тег последнего сегмента сохраняем в метаданных файла в БД
+    # (encryption_iv / encryption_auth_tag); для дешифрования они не обязательны.
+    return encryptor.header.nonce_prefix, encryptor.final_tag
+
+
+# --- Конвейерное шифрование загрузок ---
+# Чтение исходного потока, шифрование и запись на диск идут в трех потоках, связанных
+# ограниченными очередями: пока шифруется буфер N, читается N+1 и пишется N-1.
+# Память ограничена ~ (2 * PIPELINE_QUEUE_DEPTH + 1) * PIPELINE_BUFFER_SIZE независимо от размера файла.
+PIPELINE_BUFFER_SIZE = 1024 * 1024
+PIPELINE_QUEUE_DEPTH = 4
+_PIPELINE_END = object()
+
+
+def encrypt_file_stream_pipelined(input_stream, output_stream, file_key: bytes,
+                                  segment_size: int = DEFAULT_SEGMENT_SIZE,
+                                  buffer_size: int = PIPELINE_BUFFER_SIZE,
+                                  queue_depth: int = PIPELINE_QUEUE_DEPTH):
+    """То же, что encrypt_file_stream, но чтение и запись перекрываются с шифрованием.
+
+    Функция блокирующая: из async-кода ее нужно вызывать через threadpool (run_in_threadpool).
+    Формат на диске идентичен encrypt_file_stream. Возвращает (префикс nonce, тег последнего сегмента).
+    """
+    encryptor = SegmentedEncryptor(file_key, segment_size)
+    read_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event() # Выставляется при ошибке в любом из потоков
+    errors = []
+
+    def put(target_queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(source_queue):
+        while not stop.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _PIPELINE_END
+
+    def reader():
+        try:
+            while True:
+                chunk = input_stream.read(buffer_size)
+                if not chunk or not put(read_queue, chunk):
+                    break
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(read_queue, _PIPELINE_END)
+
+    def writer():
+        try:
+            while True:
+                item = get(write_queue)
+                if item is _PIPELINE_END:
+                    break
+                output_stream.write(item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    reader_thread = threading.Thread(target=reader, name="upload-reader", daemon=True)
+    writer_thread = threading.Thread(target=writer, name="upload-writer", daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+    try:
+        while True:
+            chunk = get(read_queue)
+            if chunk is _PIPELINE_END:
+                break
+            if not put(write_queue, encryptor.update(chunk)):
+                break
+        if not stop.is_set():
+            put(write_queue, encryptor.finalize())
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        put(write_queue, _PIPELINE_END)
+        writer_thread.join()
+        stop.set() # Освобождаем читателя, если он еще ждет места в очереди
+        reader_thread.join()
+
+    if errors:
+        raise errors[0]
+    return encryptor.header.nonce_prefix, encryptor.final_tag
+
+
+# --- Параллельное шифрование сегментов (multipart-загрузки) ---
+# Сегменты независимы (номер зашит в nonce), поэтому пачки сегментов можно шифровать
+# на пуле потоков или процессов и затем писать в порядке номеров.
+_segment_executor: Optional[Executor] = None
+_segment_executor_lock = threading.Lock()
+
+
+def get_segment_executor() -> Executor:
+    """Общий пул для шифрования пачек сегментов (создается при первом обращении)."""
+    global _segment_executor
+    if _segment_executor is None:
+        with _segment_executor_lock:
+            if _segment_executor is None:
+                workers = max(1, settings.UPLOAD_ENCRYPTION_WORKERS)
+                if settings.UPLOAD_ENCRYPTION_EXECUTOR == "process":
+                    _segment_executor = ProcessPoolExecutor(max_workers=workers)
+                else:
+                    _segment_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="segment-encrypt")
+    return _segment_executor
+
+
+def shutdown_segment_executor():
+    global _segment_executor
+    if _segment_executor is not None:
+        _segment_executor.shutdown(wait=False, cancel_futures=True)
+        _segment_executor = None
+
+
+def encrypt_segment_batch(file_key: bytes, header_raw: bytes, first_index: int, data: bytes, final_index: int) -> bytes:
+    """Шифрует подряд идущие сегменты, начиная с first_index (функция верхнего уровня - годится для ProcessPool).
+
+    data должна быть кратна размеру сегмента, кроме пачки, содержащей финальный сегмент final_index.
+    Пустая пачка, начинающаяся с финального сегмента, дает пустой финальный сегмент.
+    """
+    header = parse_segmented_header(header_raw)
+    aead = AESGCM(file_key)
+    segment_size = header.segment_size
+    out = []
+    index = first_index
+    position = 0
+    while position < len(data) or (index == final_index and not out and not data):
+        if index > final_index:
+            raise ValueError("Data extends past the final segment.")
+        segment = data[position:position + segment_size]
+        out.append(encrypt_segment(aead, header, index, segment, final=index == final_index))
+        position += segment_size
+        index += 1
+    return b"".join(out)
+
+
+def _stream_size(stream) -> int:
+    try:
+        return os.fstat(stream.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        position = stream.tell()
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return size
+
+
+def read_segmented_header(input_stream) -> SegmentedHeader:
+    input_stream.seek(0)
+    return parse_segmented_header(input_stream.read(SEGMENTED_HEADER_SIZE))
+
+
+def iter_decrypt_segmented(input_stream, file_key: bytes, start_segment: int = 0, end_segment: Optional[int] = None,
+                           encrypted_size: Optional[int] = None, header: Optional[SegmentedHeader] = None):
+    """Генератор: проверяет и дешифрует сегменты [start_segment, end_segment] включительно.
+
+    Каждый сегмент отдается только после проверки его тега. input_stream должен поддерживать seek().
+    """
+    if header is None:
+        header = read_segmented_header(input_stream)
+    if encrypted_size is None:
+        encrypted_size = _stream_size(input_stream)
+    last_index = segment_count(encrypted_size, header.segment_size) - 1
+    if end_segment is None or end_segment > last_index:
+        end_segment = last_index
+
+    aead = AESGCM(file_key)
+    full_segment = header.segment_size + GCM_TAG_SIZE
+    input_stream.seek(SEGMENTED_HEADER_SIZE + start_segment * full_segment)
+    for index in range(start_segment, end_segment + 1):
+        ciphertext = input_stream.read(full_segment)
+        final = index == last_index
+        if not final and len(ciphertext) != full_segment:
+            raise ValueError("Decryption failed: encrypted file is truncated.")
+        plaintext = decrypt_segment(aead, header, index, ciphertext, final)
+        if plaintext:
+            yield plaintext
+
+
+def iter_decrypt_range(input_stream, file_key: bytes, start: int, end: int, encrypted_size: Optional[int] = None):
+    """Генератор: отдает байты plaintext [start, end] включительно (сегментированный формат).
+
+    Читаются и дешифруются только сегменты, покрывающие диапазон; каждый проверяется по тегу.
+    """
+    header = read_segmented_header(input_stream)
+    segment_size = header.segment_size
+    first_segment = start // segment_size
+    skip = start - first_segment * segment_size
+    remaining = end - start + 1
+    for plaintext in iter_decrypt_segmented(input_stream, file_key, first_segment, end // segment_size,
+                                            encrypted_size=encrypted_size, header=header):
+        if skip:
+            plaintext = plaintext[skip:]
+            skip = 0
+        if len(plaintext) > remaining:
+            plaintext = plaintext[:remaining]
+        remaining -= len(plaintext)
+        if plaintext:
+            yield plaintext
+        if remaining <= 0:
+            break
+
+
+def plaintext_size(input_stream, encryption_algorithm: str, encrypted_size: Optional[int] = None) -> int:
+    """Размер исходного файла по зашифрованному, без дешифрования (для старых записей без plaintext_size_bytes)."""
+    if encrypted_size is None:
+        encrypted_size = _stream_size(input_stream)
+    if encryption_algorithm == SEGMENTED_ALGORITHM:
+        return segmented_plaintext_size(encrypted_size, read_segmented_header(input_stream).segment_size)
+    if encryption_algorithm == LEGACY_ALGORITHM:
+        return encrypted_size - 12 # IV в начале файла, тег хранится в БД
+    raise ValueError(f"Unsupported encryption algorithm: {encryption_algorithm}")
+
+
+def supports_range(encryption_algorithm: str) -> bool:
+    """Можно ли дешифровать произвольный диапазон, не теряя проверки целостности."""
+    return encryption_algorithm == SEGMENTED_ALGORITHM
+
+
+def iter_decrypt_file(input_stream, file_key: bytes, encryption_algorithm: str, auth_tag: bytes):
+    """Генератор дешифрования с выбором формата по File.encryption_algorithm."""
+    if encryption_algorithm == SEGMENTED_ALGORITHM:
+        return iter_decrypt_segmented(input_stream, file_key)
+    if encryption_algorithm == LEGACY_ALGORITHM:
+        return iter_decrypt_file_stream(input_stream, file_key, auth_tag)
+    raise ValueError(f"Unsupported encryption algorithm: {encryption_algorithm}")
+
+
+# --- Старый формат (один GCM-поток), только чтение ---
+def iter_decrypt_file_stream(input_stream, file_key: bytes, auth_tag: bytes, chunk_size: int = 64 * 1024):
+    """Генератор: читает input_stream по частям, дешифрует и отдает plaintext-чанки (AES-GCM).
+
+    В память никогда не попадает больше одного чанка, поэтому расход памяти не зависит от размера файла.
+    Тег аутентификации проверяется в конце потока (finalize): при несовпадении генератор бросает ValueError,
+    и потребитель (StreamingResponse) должен оборвать передачу, а не завершать ее как успешную.
+    """
+    iv = input_stream.read(12) # Сначала читаем IV из входного файла/потока
+
+    cipher = Cipher(algorithms.AES(file_key), modes.GCM(iv, auth_tag), backend=default_backend())
+    decryptor = cipher.decryptor()
+
+    while True:
+        encrypted_chunk = input_stream.read(chunk_size)
+        if not encrypted_chunk:
+            break
+        decrypted_chunk = decryptor.update(encrypted_chunk)
+        if decrypted_chunk:
+            yield decrypted_chunk
+
+    try:
+        decrypted_final_chunk = decryptor.finalize() # Проверка тега аутентификации
+    except Exception as e: # InvalidTag, если данные повреждены/изменены
+        raise ValueError("Decryption failed: Invalid authentication tag or corrupted data.") from e
+    if decrypted_final_chunk:
+        yield decrypted_final_chunk
 
 def decrypt_file_stream(input_stream, output_stream, file_key: bytes, auth_tag: bytes):
     """Дешифрует данные из input_stream и пишет в output_stream, используя AES-GCM."""
@@ -92,5 +520,16 @@ def decrypt_file_stream(input_stream, output_stream, file_key: bytes, auth_tag:
         decrypted_final_chunk = decryptor.finalize() # Проверка тега аутентификации
         output_stream.write(decrypted_final_chunk)
     except Exception as e: # InvalidTag или другая ошибка, если данные повреждены/изменены
-        print(f"Ошибка дешифрования (возможно, неверный ключ или поврежденные данные): {e}")
-        raise ValueError("Decryption failed: Invalid authentication tag or corrupted data.") from e
\ No newline at end of file
+        logger.warning(f"Ошибка дешифрования (возможно, неверный ключ или поврежденные данные): {e}")
+        raise ValueError("Decryption failed: Invalid authentication tag or corrupted data.") from e
+
+
+if __name__ == "__main__":
+    # python -m app.encryption derive-kek
+    # Печатает KEK, вычисленный из SECRET_KEY, для переменной KEK_HEX: воркеры перестанут тратить время на PBKDF2
+    import sys
+    if sys.argv[1:] == ["derive-kek"]:
+        print(derive_kek(settings.SECRET_KEY, KEK_SALT).hex())
+    else:
+        print("Usage: python -m app.encryption derive-kek")
+        sys.exit(2)
@@ -0,0 +1,42 @@
+# app/key_cache.py
+# Кэш расшифрованных ключей файлов (DEK) в памяти процесса.
+# Сетка превью и Range-запросы многократно скачивают одни и те же файлы; без кэша каждый
+# запрос заново делает hex-декодирование и AES-GCM-расшифровку DEK ключом KEK.
+from . import encryption, models
+from .config import settings
+from .ttl_cache import TTLCache
+
+
+class DEKCache(TTLCache):
+    """LRU-кэш DEK (по file_id) с ограничением по числу записей и TTL.
+
+    Ключи хранятся в bytearray и затираются нулями при вытеснении/инвалидации.
+    Полной гарантии это не дает: get() возвращает неизменяемую копию bytes,
+    которую Python не позволяет затереть, но время жизни ключа в памяти сокращается.
+    invalidate(file_id) - при удалении файла или перешифровании его DEK, clear() - при смене KEK.
+    """
+
+    def _release(self, key_buffer: bytearray):
+        key_buffer[:] = bytes(len(key_buffer))
+
+    def _export(self, key_buffer: bytearray) -> bytes:
+        return bytes(key_buffer)
+
+    def put(self, file_id: int, file_key: bytes):
+        super().put(file_id, bytearray(file_key))
+
+
+dek_cache = DEKCache(settings.DEK_CACHE_MAX_ENTRIES, settings.DEK_CACHE_TTL_SECONDS)
+
+
+def get_file_key(db_file: models.File) -> bytes:
+    """DEK файла: из кэша или расшифровкой ключом KEK (с сохранением в кэш)."""
+    file_key = dek_cache.get(db_file.file_id)
+    if file_key is None:
+        file_key = encryption.decrypt_file_key(
+            encrypted_file_key_hex=db_file.encrypted_dek_hex,
+            iv_hex=db_file.dek_iv_hex,
+            auth_tag_hex=db_file.dek_auth_tag_hex
+        )
+        dek_cache.put(db_file.file_id, file_key)
+    return file_key
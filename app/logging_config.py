@@ -0,0 +1,223 @@
+# app/logging_config.py
+# Логирование приложения: логгер "app" (и дочерние app.*) пишет через очередь.
+# В потоке запроса QueueHandler только кладет запись в очередь; форматирование и запись
+# в stdout делает QueueListener в отдельном потоке, поэтому вывод не блокирует event loop.
+#
+# Каждая запись получает request_id текущего запроса (RequestContextMiddleware) и проходит
+# редактирование секретов: Bearer-токены, JWT и значения полей вида password=/token=/code=.
+# Журнал запросов (логгер app.access) пишется с выборкой по префиксам путей (LOG_ACCESS_SAMPLE_RATES);
+# ошибки 5xx и медленные запросы пишутся всегда.
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import List, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+
+from .config import settings
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_INCOMING_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+REDACTED = "[REDACTED]"
+_REDACT_PATTERNS = [
+    (re.compile(r"(?i)\bbearer\s+[A-Za-z0-9._~+/=-]+"), f"Bearer {REDACTED}"),
+    (re.compile(r"\beyJ[A-Za-z0-9_-]*\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*"), REDACTED), # JWT без префикса Bearer
+    (
+        re.compile(
+            r"(?i)\b(password|password_hash|passwd|secret|secret_key|token|access_token|refresh_token|"
+            r"authorization|code|backup_code|backup_codes|kek_hex)(['\"]?\s*[:=]\s*['\"]?)[^\s'\",;&}\]]+"
+        ),
+        rf"\1\2{REDACTED}"
+    ),
+]
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in _REDACT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class _RequestIdFilter(logging.Filter):
+    # Выполняется в потоке/задаче запроса, где виден contextvar
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class _RedactingQueueHandler(QueueHandler):
+    """QueueHandler, который до постановки в очередь подставляет аргументы и вырезает секреты.
+
+    Трейсбек сохраняется отдельно (exc_text), чтобы JSON-форматтер мог вывести его отдельным полем.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = redact(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = redact(record.exc_text)
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+
+_exception_formatter = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись. Дополнительные поля передаются через extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] [%(name)s] [%(request_id)s] %(message)s"
+
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
+_listener_running = False
+
+
+def configure_logging():
+    """Настраивает логгер "app" (идемпотентно) и запускает поток записи."""
+    global _queue_handler, _listener
+    if _queue_handler is None:
+        output_handler = logging.StreamHandler(sys.stdout)
+        if settings.LOG_FORMAT.lower() == "json":
+            output_handler.setFormatter(JsonFormatter())
+        else:
+            output_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        _queue_handler = _RedactingQueueHandler(_log_queue)
+        _queue_handler.addFilter(_RequestIdFilter())
+        _listener = QueueListener(_log_queue, output_handler, respect_handler_level=True)
+
+        app_logger = logging.getLogger("app")
+        app_logger.setLevel(settings.LOG_LEVEL.upper())
+        app_logger.handlers = [_queue_handler]
+        app_logger.propagate = False # Без дублей через корневой логгер
+
+        # Журнал доступа uvicorn - через ту же очередь (собственный журнал запросов - app.access)
+        uvicorn_logger = logging.getLogger("uvicorn.access")
+        uvicorn_logger.handlers = [_queue_handler]
+        uvicorn_logger.propagate = False
+    start_logging()
+
+
+def start_logging():
+    global _listener_running
+    if _listener is not None and not _listener_running:
+        _listener.start()
+        _listener_running = True
+
+
+def stop_logging():
+    """Дописывает накопленные записи и останавливает поток записи (при остановке приложения)."""
+    global _listener_running
+    if _listener is not None and _listener_running:
+        _listener.stop()
+        _listener_running = False
+
+
+def _parse_sample_rates(raw: str) -> List[Tuple[str, float]]:
+    # "/api/v1/files/=0.05,/api/v1/health=0" -> [(префикс, доля)], длинные префиксы проверяются первыми
+    rules = []
+    for item in (raw or "").split(","):
+        prefix, sep, rate = item.strip().rpartition("=")
+        if not sep or not prefix:
+            continue
+        rules.append((prefix, min(max(float(rate), 0.0), 1.0)))
+    return sorted(rules, key=lambda rule: len(rule[0]), reverse=True)
+
+
+_access_sample_rules = _parse_sample_rates(settings.LOG_ACCESS_SAMPLE_RATES)
+access_logger = logging.getLogger("app.access")
+
+
+def access_sample_rate(path: str) -> float:
+    for prefix, rate in _access_sample_rules:
+        if path.startswith(prefix):
+            return rate
+    return settings.LOG_ACCESS_SAMPLE_RATE
+
+
+def _should_log_access(path: str, status_code: int, duration_ms: float) -> bool:
+    if status_code >= 500 or duration_ms >= settings.LOG_SLOW_REQUEST_MS:
+        return True
+    rate = access_sample_rate(path)
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+class RequestContextMiddleware:
+    """ASGI-middleware: request_id (из заголовка X-Request-ID или новый), заголовок ответа и журнал запросов.
+
+    Чистый ASGI, а не BaseHTTPMiddleware: не буферизует StreamingResponse при скачивании файлов.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope["headers"]).get(REQUEST_ID_HEADER.lower().encode(), b"").decode("latin-1")
+        request_id = incoming if _INCOMING_REQUEST_ID_RE.match(incoming) else uuid.uuid4().hex
+        # Не сбрасываем после ответа: обработчик необработанных исключений (ServerErrorMiddleware)
+        # работает снаружи этого middleware и тоже должен видеть request_id. Каждый запрос
+        # выполняется в своей задаче со своей копией контекста, так что значение не протекает.
+        request_id_var.set(request_id)
+
+        status_code = 500 # Если ответ так и не начался - необработанное исключение
+        started = time.perf_counter()
+
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append(REQUEST_ID_HEADER, request_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            path = scope["path"] # Без query string: в ней могут быть секреты
+            if _should_log_access(path, status_code, duration_ms):
+                access_logger.info(
+                    "%s %s %s %.1fms", scope["method"], path, status_code, duration_ms,
+                    extra={"fields": {
+                        "method": scope["method"],
+                        "path": path,
+                        "status": status_code,
+                        "duration_ms": round(duration_ms, 1),
+                        "sample_rate": access_sample_rate(path),
+                    }}
+                )
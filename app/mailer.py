@@ -0,0 +1,334 @@
+# app/mailer.py
+# Отправка почты через очередь в БД (таблица mail_outbox).
+# Раньше каждый 2FA-код отправлялся BackgroundTask'ом с новым SMTP-соединением (TCP + STARTTLS + LOGIN
+# на каждое письмо), а при перезапуске воркера неотправленные письма терялись.
+# Теперь запрос только добавляет строку в mail_outbox (enqueue_mail), а MailSender в фоне забирает
+# пачки писем и рассылает их через MAIL_CONNECTIONS постоянных соединений aiosmtplib,
+# повторяя неудачные попытки с экспоненциальной задержкой.
+#
+#   python -m app.mailer run                      - отправитель отдельным процессом (MAIL_SENDER_ENABLED=false в приложении)
+#   python -m app.mailer debug-server [порт]      - локальный SMTP-приемник для разработки и тестов:
+#                                                   печатает письма вместо отправки (SMTP_SERVER=localhost,
+#                                                   SMTP_PORT=1025, SMTP_STARTTLS=false, без EMAIL_PASSWORD)
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from typing import List, Optional
+
+import aiosmtplib
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def mail_from() -> Optional[str]:
+    return settings.MAIL_FROM or settings.EMAIL_USER
+
+
+async def enqueue_mail(
+    db: AsyncSession,
+    recipient: str,
+    subject: str,
+    body: str,
+    expires_at: Optional[datetime] = None
+) -> models.MailOutbox:
+    """Ставит письмо в очередь (с коммитом) и будит отправителя этого процесса."""
+    if not mail_from():
+        raise ValueError("Email credentials not configured in application settings.")
+    db_mail = models.MailOutbox(recipient=recipient, subject=subject, body=body, expires_at=expires_at)
+    db.add(db_mail)
+    await db.commit()
+    mail_sender.wake()
+    return db_mail
+
+
+def _build_message(db_mail: models.MailOutbox) -> EmailMessage:
+    message = EmailMessage()
+    message["Subject"] = db_mail.subject
+    message["From"] = mail_from()
+    message["To"] = db_mail.recipient
+    message.set_content(db_mail.body)
+    return message
+
+
+def _retry_delay(attempts: int) -> float:
+    # Экспоненциальная задержка с джиттером, чтобы повторы разных писем не шли одной волной
+    delay = min(settings.MAIL_RETRY_MAX_SECONDS, settings.MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _is_permanent(error: Exception) -> bool:
+    # 5xx на конкретное письмо (неверный адрес и т.п.) повторять бессмысленно
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(500 <= recipient_error.code < 600 for recipient_error in error.recipients)
+    return isinstance(error, aiosmtplib.SMTPResponseException) and 500 <= error.code < 600 \
+        and not isinstance(error, aiosmtplib.SMTPAuthenticationError)
+
+
+class _PooledConnection:
+    """Одно SMTP-соединение, переиспользуемое между письмами и пачками (закрывается после простоя)."""
+
+    def __init__(self, sender: "MailSender"):
+        self.sender = sender
+        self.client: Optional[aiosmtplib.SMTP] = None
+        self.last_used = 0.0
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(
+            hostname=settings.SMTP_SERVER,
+            port=settings.SMTP_PORT,
+            timeout=settings.SMTP_TIMEOUT_SECONDS,
+            start_tls=settings.SMTP_STARTTLS,
+        )
+        await client.connect()
+        if settings.EMAIL_USER and settings.EMAIL_PASSWORD:
+            await client.login(settings.EMAIL_USER, settings.EMAIL_PASSWORD)
+        self.sender.count("connections_opened")
+        return client
+
+    async def send(self, message: EmailMessage):
+        if self.client is not None and time.monotonic() - self.last_used > settings.MAIL_CONNECTION_IDLE_SECONDS:
+            await self.close() # Сервер мог уже закрыть простаивающее соединение
+        for attempt in range(2):
+            if self.client is None or not self.client.is_connected:
+                self.client = await self._connect()
+            try:
+                await self.client.send_message(message)
+                self.last_used = time.monotonic()
+                return
+            except aiosmtplib.SMTPServerDisconnected:
+                # Соединение закрыто сервером между письмами - один раз переподключаемся
+                self.client = None
+                if attempt:
+                    raise
+
+    async def close(self):
+        client, self.client = self.client, None
+        if client is not None and client.is_connected:
+            try:
+                await client.quit()
+            except aiosmtplib.SMTPException:
+                client.close()
+
+
+class MailSender:
+    def __init__(self):
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+        self.counters = {"sent": 0, "retried": 0, "failed": 0, "connections_opened": 0, "batches": 0}
+        self.last_error: Optional[str] = None
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _claim_batch(self, db: AsyncSession) -> List[models.MailOutbox]:
+        """Забирает пачку писем, которые пора отправлять. Метка claim_token не дает двум воркерам взять одно письмо."""
+        now = datetime.now(timezone.utc)
+        stale_claim = now - timedelta(seconds=settings.MAIL_CLAIM_TIMEOUT_SECONDS)
+        due_ids = (await db.scalars(
+            select(models.MailOutbox.id).where(
+                or_(
+                    (models.MailOutbox.status == "pending") & (models.MailOutbox.next_attempt_at <= now),
+                    # Письма воркера, упавшего посреди отправки
+                    (models.MailOutbox.status == "sending") & (models.MailOutbox.claimed_at < stale_claim)
+                ),
+                or_(models.MailOutbox.expires_at == None, models.MailOutbox.expires_at > now)
+            ).order_by(models.MailOutbox.next_attempt_at).limit(settings.MAIL_BATCH_SIZE)
+        )).all()
+        if not due_ids:
+            return []
+        claim_token = uuid.uuid4().hex
+        await db.execute(
+            update(models.MailOutbox)
+            .where(
+                models.MailOutbox.id.in_(due_ids),
+                or_(
+                    models.MailOutbox.status == "pending",
+                    (models.MailOutbox.status == "sending") & (models.MailOutbox.claimed_at < stale_claim)
+                )
+            )
+            .values(status="sending", claim_token=claim_token, claimed_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return list((await db.scalars(
+            select(models.MailOutbox).where(models.MailOutbox.claim_token == claim_token)
+        )).all())
+
+    async def _send_chunk(self, connection: _PooledConnection, batch: List[models.MailOutbox]) -> list:
+        results = []
+        for db_mail in batch:
+            try:
+                await connection.send(_build_message(db_mail))
+                results.append((db_mail, None))
+            except (aiosmtplib.SMTPException, OSError) as e:
+                results.append((db_mail, e))
+                if not isinstance(e, aiosmtplib.SMTPResponseException):
+                    await connection.close() # Сетевая ошибка: следующее письмо - через новое соединение
+        return results
+
+    async def _record_results(self, db: AsyncSession, results: list):
+        sent_ids = [db_mail.id for db_mail, error in results if error is None]
+        if sent_ids:
+            # Отправленные письма не храним: в них одноразовые коды
+            await db.execute(delete(models.MailOutbox).where(models.MailOutbox.id.in_(sent_ids)))
+            self.count("sent", len(sent_ids))
+        for db_mail, error in results:
+            if error is None:
+                continue
+            db_mail.attempts += 1
+            db_mail.last_error = str(error)[:1000]
+            db_mail.claim_token = None
+            if _is_permanent(error) or db_mail.attempts >= settings.MAIL_MAX_ATTEMPTS:
+                db_mail.status = "failed"
+                self.count("failed")
+                logger.error(f"Письмо {db_mail.id} для {db_mail.recipient} не отправлено после {db_mail.attempts} попыток: {error}")
+            else:
+                db_mail.status = "pending"
+                db_mail.next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=_retry_delay(db_mail.attempts))
+                self.count("retried")
+                logger.warning(f"Ошибка отправки письма {db_mail.id}, попытка {db_mail.attempts}: {error}")
+            self.last_error = str(error)[:1000]
+        await db.commit()
+
+    async def send_due(self, connections: List[_PooledConnection]) -> int:
+        """Отправляет одну пачку писем, распределив ее по соединениям. Возвращает размер пачки."""
+        async with AsyncSessionLocal() as db:
+            batch = await self._claim_batch(db)
+            if not batch:
+                return 0
+            self.count("batches")
+            chunks = [batch[i::len(connections)] for i in range(len(connections))]
+            chunk_results = await asyncio.gather(*[
+                self._send_chunk(connection, chunk) for connection, chunk in zip(connections, chunks) if chunk
+            ])
+            await self._record_results(db, [result for results in chunk_results for result in results])
+            return len(batch)
+
+    async def run(self):
+        """Цикл отправителя: пачки подряд, пока есть что отправлять, затем ожидание wake() или опроса."""
+        self._wakeup = asyncio.Event()
+        connections = [_PooledConnection(self) for _ in range(max(1, settings.MAIL_CONNECTIONS))]
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    sent = await self.send_due(connections)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.last_error = str(e)[:1000]
+                    logger.error("Ошибка в отправителе почты", exc_info=True)
+                    sent = 0
+                if sent >= settings.MAIL_BATCH_SIZE:
+                    continue # Очередь не пуста - следующая пачка сразу
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.MAIL_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                for connection in connections:
+                    if connection.client is not None and time.monotonic() - connection.last_used > settings.MAIL_CONNECTION_IDLE_SECONDS:
+                        await connection.close()
+        finally:
+            self._wakeup = None
+            for connection in connections:
+                try:
+                    await connection.close()
+                except Exception:
+                    pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.MAIL_SENDER_ENABLED,
+                "connections": settings.MAIL_CONNECTIONS,
+                "batch_size": settings.MAIL_BATCH_SIZE,
+                **self.counters,
+                "last_error": self.last_error,
+            }
+
+
+mail_sender = MailSender()
+
+
+async def _debug_smtp_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Минимальный SMTP-сервер: принимает письма без TLS и AUTH и печатает их
+    writer.write(b"220 pochta-debug ESMTP\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        command = line.decode("utf-8", errors="replace").strip()
+        verb = command.split(" ", 1)[0].upper()
+        if verb == "EHLO":
+            writer.write(b"250-pochta-debug\r\n250-8BITMIME\r\n250 SMTPUTF8\r\n")
+        elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+            writer.write(b"250 OK\r\n")
+        elif verb == "DATA":
+            writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+            await writer.drain()
+            data = []
+            while True:
+                data_line = await reader.readline()
+                if not data_line or data_line == b".\r\n":
+                    break
+                data.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+            print(f"---------- письмо ----------\n{b''.join(data).decode('utf-8', errors='replace')}", flush=True)
+            writer.write(b"250 OK: queued\r\n")
+        elif verb == "QUIT":
+            writer.write(b"221 Bye\r\n")
+            await writer.drain()
+            break
+        else:
+            writer.write(b"502 Command not implemented\r\n")
+        await writer.drain()
+    writer.close()
+
+
+async def serve_debug_smtp(host: str = "127.0.0.1", port: int = 1025):
+    server = await asyncio.start_server(_debug_smtp_session, host, port)
+    print(f"Отладочный SMTP-сервер слушает {host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+async def _run_sender_cli():
+    from .database import async_engine
+    try:
+        await mail_sender.run()
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    import sys
+    from .logging_config import configure_logging, stop_logging
+    arguments = sys.argv[1:]
+    try:
+        if arguments == ["run"]:
+            configure_logging()
+            asyncio.run(_run_sender_cli())
+        elif arguments[:1] == ["debug-server"] and len(arguments) <= 2:
+            asyncio.run(serve_debug_smtp(port=int(arguments[1]) if len(arguments) == 2 else 1025))
+        else:
+            print("Usage: python -m app.mailer run | debug-server [port]")
+            sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()
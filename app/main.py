@@ -1,59 +1,69 @@
-from fastapi import FastAPI, Request, status, HTTPException
+from fastapi import Depends, FastAPI, Request, status, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware # Если нужен CORS
-import logging # для логгирования
-import sys # для логгирования
 from fastapi.encoders import jsonable_encoder # Важно для корректной сериализации
 import logging # Используем стандартный logging
-
-from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 
-from .database import engine, Base
-from .routers import auth
+from .database import engine, async_engine, Base, pool_stats
+from .migrations import upgrade_schema
+from . import blob_gc, dedup, encryption, key_cache, mailer, storage, sweeper, user_cache
+from .password_hashing import password_hash_pool, PasswordHashPoolBusy
+from .logging_config import configure_logging, stop_logging, RequestContextMiddleware
 from .config import settings # импортируем настройки
-from .routers import auth, files
-
-
-log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] [%(name)s] %(message)s (%(filename)s:%(lineno)d)")
-logger = logging.getLogger("app") # Главный логгер приложения
-logger.setLevel(logging.INFO) # Уровень по умолчанию
-
-# Обработчик для вывода в консоль
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
-logger.addHandler(console_handler)
+from .deps import require_metrics_token
+from .routers import auth, files, uploads, users
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+import asyncio
 
-# Опционально: Обработчик для записи в файл
-# file_handler = logging.FileHandler("app.log")
-# file_handler.setFormatter(log_formatter)
-# logger.addHandler(file_handler)
 
-# Логгер для uvicorn (чтобы он тоже использовал наш формат, если хотим)
-uvicorn_logger = logging.getLogger("uvicorn.access")
-uvicorn_logger.handlers = logger.handlers # Используем те же обработчики
-uvicorn_logger.propagate = False # Не передавать сообщения вышестоящим логгерам
+# Логгер "app" пишет через очередь в отдельном потоке (см. app/logging_config.py)
+configure_logging()
+logger = logging.getLogger(__name__)
 
 try:
     Base.metadata.create_all(bind=engine)
-    print("Таблицы успешно созданы/проверены.")
-except Exception as e:
-    print(f"Ошибка при создании таблиц: {e}")
+    schema_changes = upgrade_schema(engine) # Новые колонки в уже существующих таблицах
+    logger.info(f"Таблицы успешно созданы/проверены. Изменения схемы: {schema_changes or 'нет'}")
+except Exception:
+    logger.error("Ошибка при создании таблиц", exc_info=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging() # Повторный запуск приложения в том же процессе (тесты) снова поднимает поток записи
+    # Просроченные коды, токены и брошенные загрузки удаляются в фоне, а не в запросах
+    sweeper_task = asyncio.create_task(sweeper.sweeper_loop()) if settings.SWEEPER_ENABLED else None
+    # Письма (2FA-коды) отправляются из очереди mail_outbox через постоянные SMTP-соединения
+    mailer_task = asyncio.create_task(mailer.mail_sender.run()) if settings.MAIL_SENDER_ENABLED else None
+    # Удаленные файлы после срока хранения и файлы-сироты в хранилище
+    gc_task = asyncio.create_task(blob_gc.gc_loop()) if settings.GC_ENABLED else None
+    # Прогреваем KEK в фоне: сервер уже принимает запросы, а первый запрос с ключами не ждет KDF
+    kek_warmup_task = asyncio.create_task(run_in_threadpool(encryption.get_kek))
+    try:
+        yield
+    finally:
+        for task in (sweeper_task, mailer_task, gc_task):
+            if task is not None:
+                task.cancel()
+        kek_warmup_task.cancel()
+        encryption.shutdown_segment_executor()
+        password_hash_pool.shutdown()
+        storage.backend.close()
+        await async_engine.dispose()
+        stop_logging()
 
 
 app = FastAPI(
+    lifespan=lifespan,
     title="Cloud Safe Folder API",
     version="0.1.0",
     description="API for a secure cloud folder with 2FA.",
     # Мы не будем указывать openapi_url здесь, а сгенерируем его кастомно
 )
 
-# Настройка логгирования (простой пример)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-
 # CORS Middleware (если фронтенд будет на другом домене/порту)
 origins = [
     "http://localhost",
@@ -65,11 +75,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+# request_id для логов и журнал запросов; добавлен последним - внешний слой, видит и ответы CORS
+app.add_middleware(RequestContextMiddleware)
 
 API_V1_PREFIX = "/api/v1"
 app.include_router(auth.router, prefix=f"{API_V1_PREFIX}/auth", tags=["Authentication"])
 app.include_router(files.router, prefix=f"{API_V1_PREFIX}/files", tags=["Files"]) # Новый роутер
+app.include_router(uploads.router, prefix=f"{API_V1_PREFIX}/uploads", tags=["Uploads"]) # Возобновляемые загрузки
+app.include_router(users.router, prefix=f"{API_V1_PREFIX}/users", tags=["Users"])
 
 # Обработчик ошибок валидации Pydantic
 @app.exception_handler(RequestValidationError)
@@ -90,8 +105,10 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
                 processed_error['input'] = repr(processed_error['input'])
         errors_for_log.append(processed_error)
 
+    # Введенные значения (пароли, коды) в лог не пишем - только в ответ клиенту
+    errors_without_input = [{key: value for key, value in error.items() if key != 'input'} for error in errors_for_log]
     logger.warning(
-        f"Validation error for {request.method} {request.url} - Client: {request.client.host} - Errors: {jsonable_encoder(errors_for_log)}"
+        f"Validation error for {request.method} {request.url} - Client: {request.client.host} - Errors: {jsonable_encoder(errors_without_input)}"
     )
     return JSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -117,6 +134,17 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     )
 
 
+@app.exception_handler(PasswordHashPoolBusy)
+async def password_hash_busy_handler(request: Request, exc: PasswordHashPoolBusy):
+    # Очередь bcrypt заполнена: отказываем сразу, чтобы всплеск логинов не копился в памяти и не занимал потоки
+    logger.warning(f"Password hash queue is full for {request.method} {request.url.path} - Client: {request.client.host}")
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many authentication requests, please retry later."},
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.exception_handler(Exception) # Этот должен идти последним
 async def generic_exception_handler(request: Request, exc: Exception):
     # Логируем ошибку с уровнем ERROR и полным трейсбеком
@@ -129,15 +157,26 @@ async def generic_exception_handler(request: Request, exc: Exception):
         content={"detail": "An internal server error occurred."},
     )
 
-# Подключение роутеров
-API_V1_PREFIX = "/api/v1" # Определяем префикс для API
-app.include_router(auth.router, prefix=f"{API_V1_PREFIX}/auth", tags=["Authentication"])
-
 
 @app.get(f"{API_V1_PREFIX}/health", tags=["Health"])
 async def health_check():
     return {"status": "ok"}
 
+@app.get(f"{API_V1_PREFIX}/metrics", tags=["Health"], dependencies=[Depends(require_metrics_token)])
+async def metrics():
+    # Внутренние счетчики процесса (для подбора размеров кэшей/пулов); доступ - только с METRICS_TOKEN
+    return {
+        "dek_cache": key_cache.dek_cache.stats(),
+        "auth_user_cache": user_cache.user_cache.stats(),
+        "password_hash": password_hash_pool.stats(),
+        "sweeper": sweeper.sweeper_stats.snapshot(),
+        "mailer": mailer.mail_sender.stats(),
+        "blob_gc": blob_gc.gc_progress.snapshot(),
+        "storage": storage.backend.stats(),
+        "dedup": dedup.dedup_stats.snapshot(),
+        "db_pool": pool_stats(),
+    }
+
 # Кастомная функция для модификации OpenAPI схемы
 def custom_openapi():
     if app.openapi_schema:
@@ -0,0 +1,182 @@
+# app/migrations.py
+# Легковесные миграции схемы. Base.metadata.create_all создает только отсутствующие таблицы,
+# но не добавляет новые колонки в уже существующие (например, в базу из mydb_backup.sql).
+# Здесь собраны идемпотентные шаги, которые выполняются при старте приложения.
+import logging
+
+from sqlalchemy import inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+
+from . import models, search
+from .crud import mime_family
+
+logger = logging.getLogger(__name__)
+
+# Колонки, добавленные после первой версии схемы: (таблица, имя колонки).
+# Должны быть nullable или иметь server_default, иначе ALTER TABLE упадет на непустой таблице.
+ADDED_COLUMNS = [
+    (models.File.__table__, "plaintext_size_bytes"),
+    (models.UploadSession.__table__, "part_size"),
+    (models.File.__table__, "mime_family"),
+    (models.UserBackupCode.__table__, "code_lookup"),
+    (models.File.__table__, "content_hash"),
+    (models.File.__table__, "blob_uuid"),
+    (models.UserFileStats.__table__, "dedup_saved_bytes"),
+]
+
+# Таблицы, чьи индексы из моделей (__table_args__) нужно досоздать в существующей базе
+INDEXED_TABLES = [models.File.__table__]
+# Отдельные новые индексы в таблицах, остальные индексы которых в старой базе названы иначе: (таблица, имя индекса)
+ADDED_INDEXES = [
+    (models.UserBackupCode.__table__, "idx_user_backup_codes_lookup"),
+    (models.TwoFactorTempCode.__table__, "idx_two_factor_temp_codes_expires_at"),
+    (models.RefreshToken.__table__, "idx_refresh_tokens_expires_at"),
+]
+
+
+def _add_missing_columns(engine: Engine) -> list[str]:
+    inspector = inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table, column_name in ADDED_COLUMNS:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            if column_name in existing_columns:
+                continue
+            column = table.c[column_name]
+            column_type = column.type.compile(dialect=engine.dialect)
+            if column.server_default is not None:
+                column_type += f" NOT NULL DEFAULT {column.server_default.arg}" if not column.nullable else f" DEFAULT {column.server_default.arg}"
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}"))
+            added.append(f"{table.name}.{column_name}")
+    return added
+
+
+def _backfill_mime_family(engine: Engine) -> list[str]:
+    # Различных MIME-типов немного, поэтому обновляем по одному UPDATE на тип
+    files = models.File.__table__
+    with engine.begin() as conn:
+        mime_types = conn.execute(
+            select(files.c.mime_type).where(files.c.mime_family == None).distinct()
+        ).scalars().all()
+        for mime_type in mime_types:
+            conn.execute(
+                update(files)
+                .where(files.c.mime_type == mime_type, files.c.mime_family == None)
+                .values(mime_family=mime_family(mime_type))
+            )
+    return [f"files.mime_family: {len(mime_types)} MIME types"] if mime_types else []
+
+
+# Ключ pg_try_advisory_lock для построения индексов: при одновременном старте воркеров индексы строит один,
+# остальные этот шаг пропускают (недостающее достроит следующий запуск)
+INDEX_BUILD_LOCK_KEY = 0x706F6368
+
+
+def _existing_indexes(engine: Engine, table_name: str) -> set[str]:
+    """Имена готовых индексов таблицы. Невалидные индексы PostgreSQL (прерванный CONCURRENTLY) не считаются."""
+    names = {index["name"] for index in inspect(engine).get_indexes(table_name)}
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            names -= set(conn.execute(text(
+                "SELECT index_class.relname FROM pg_index "
+                "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+                "JOIN pg_class table_class ON table_class.oid = pg_index.indrelid "
+                "WHERE table_class.relname = :table AND NOT pg_index.indisvalid"
+            ), {"table": table_name}).scalars())
+    return names
+
+
+def _build_indexes(engine: Engine, statements: list[tuple[str, str]]) -> list[str]:
+    """Выполняет (имя индекса, CREATE INDEX IF NOT EXISTS ...), каждый отдельно.
+
+    В PostgreSQL - CREATE INDEX CONCURRENTLY вне транзакции: на большой таблице files обычный CREATE INDEX
+    блокирует запись на все время построения. Ошибка одного индекса не отменяет остальные шаги миграции.
+    """
+    if not statements:
+        return []
+    created = []
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            for index_name, ddl in statements:
+                conn.execute(text(ddl))
+                created.append(index_name)
+        return created
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": INDEX_BUILD_LOCK_KEY}).scalar():
+            logger.info("Индексы строит другой процесс, шаг пропущен")
+            return []
+        try:
+            for index_name, ddl in statements:
+                # Прерванный CONCURRENTLY оставляет невалидный индекс, который IF NOT EXISTS не пересоздаст.
+                # Под блокировкой его точно никто не строит - удаляем и строим заново
+                invalid = conn.execute(text(
+                    "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                    "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+                ), {"name": index_name}).scalar()
+                try:
+                    if invalid:
+                        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+                    conn.execute(text(ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)))
+                    created.append(index_name)
+                except DBAPIError as e:
+                    logger.error(f"Не удалось создать индекс {index_name}: {e}")
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": INDEX_BUILD_LOCK_KEY})
+    return created
+
+
+def _create_missing_indexes(engine: Engine) -> list[str]:
+    wanted = [(table, index) for table in INDEXED_TABLES for index in sorted(table.indexes, key=lambda index: index.name)]
+    wanted += [
+        (table, index) for table, index_name in ADDED_INDEXES
+        for index in table.indexes if index.name == index_name
+    ]
+    existing_indexes = {}
+    statements = []
+    for table, index in wanted:
+        if table.name not in existing_indexes:
+            existing_indexes[table.name] = _existing_indexes(engine, table.name)
+        if index.name in existing_indexes[table.name]:
+            continue
+        statements.append((index.name, str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))))
+    return _build_indexes(engine, statements)
+
+
+# GIN-индексы pg_trgm для поиска (search.like_search_clause): ускоряют ILIKE '%term%' и 'term%'
+TRIGRAM_INDEXES = [
+    ("idx_files_original_filename_trgm", "files", "original_filename"),
+    ("idx_files_mime_type_trgm", "files", "mime_type"),
+]
+
+
+def _create_trigram_indexes(engine: Engine) -> list[str]:
+    if engine.dialect.name != "postgresql" or search.resolve_backend(engine.dialect.name) != "trigram":
+        return []
+    existing_indexes = _existing_indexes(engine, "files")
+    missing = [index for index in TRIGRAM_INDEXES if index[0] not in existing_indexes]
+    if not missing:
+        return []
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError as e:
+        # Без прав на CREATE EXTENSION поиск работает, но без индекса (как бэкенд ilike)
+        logger.warning(f"Не удалось включить pg_trgm, поиск будет без индекса: {e}")
+        return []
+    return _build_indexes(engine, [
+        (index_name, f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} USING gin ({column_name} gin_trgm_ops)")
+        for index_name, table_name, column_name in missing
+    ])
+
+
+def upgrade_schema(engine: Engine) -> list[str]:
+    """Приводит существующую базу к текущей схеме моделей. Возвращает список выполненных изменений."""
+    return (
+        _add_missing_columns(engine)
+        + _backfill_mime_family(engine)
+        + _create_missing_indexes(engine)
+        + _create_trigram_indexes(engine)
+    )
@@ -1,9 +1,9 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, UUID # Добавил UUID
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, UUID, Index # Добавил UUID
 from sqlalchemy.orm import relationship
 from .database import Base
 from datetime import datetime, timezone # импортируем timezone
 import uuid # Для генерации UUID
-from sqlalchemy import Text
+from sqlalchemy import Text, text
 
 
 class User(Base):
@@ -27,12 +27,18 @@ class UserBackupCode(Base):
     backup_code_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
     code_hash = Column(String(255), nullable=False)
+    # HMAC-SHA256 кода (security.backup_code_lookup) для поиска по индексу; NULL у кодов, созданных до его появления
+    code_lookup = Column(String(64), nullable=True)
     is_used = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     used_at = Column(DateTime(timezone=True), nullable=True)
 
     user = relationship("User", back_populates="backup_codes")
 
+    __table_args__ = (
+        Index("idx_user_backup_codes_lookup", "user_id", "code_lookup"),
+    )
+
 
 class File(Base):
     __tablename__ = "files"
@@ -44,10 +50,12 @@ class File(Base):
     stored_filename_uuid = Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
     storage_path = Column(String(512), nullable=False)
     mime_type = Column(String(100), nullable=False)
+    mime_family = Column(String(50), nullable=True) # Часть MIME-типа до "/" ("image", "video", ...), для фильтра по равенству
     file_size_bytes = Column(Integer, nullable=False) # Integer обычно достаточно, если файлы не гигантские, иначе BIGINT
-    encryption_algorithm = Column(String(50), nullable=False)
-    encryption_iv = Column(String(24), nullable=False) # IV для данных файла (12 байт hex = 24 символа)
-    encryption_auth_tag = Column(String(32), nullable=False) # Тег для данных файла (16 байт hex = 32 символа)
+    plaintext_size_bytes = Column(BigInteger, nullable=True) # Размер исходного файла (для Content-Length/Range без дешифрования)
+    encryption_algorithm = Column(String(50), nullable=False) # Формат на диске: "AES-256-GCM" (старый) или "AES-256-GCM-SEG-v1"
+    encryption_iv = Column(String(24), nullable=False) # IV (12 байт) или префикс nonce сегментов (7 байт), hex
+    encryption_auth_tag = Column(String(32), nullable=False) # Тег данных файла / тег последнего сегмента (16 байт hex = 32 символа)
 
     # Поля для зашифрованного ключа файла (Data Encryption Key - DEK)
     encrypted_dek_hex = Column(Text, nullable=False) # Сам зашифрованный DEK
@@ -58,8 +66,109 @@ class File(Base):
     last_accessed_at = Column(DateTime(timezone=True), nullable=True)
     deleted_at = Column(DateTime(timezone=True), nullable=True) # For soft delete
 
+    # Дедупликация загрузок: HMAC-SHA256 содержимого с ключом пользователя (security.content_hasher);
+    # NULL - не вычислялся (возобновляемые/multipart-загрузки, старые файлы)
+    content_hash = Column(String(64), nullable=True)
+    # stored_filename_uuid файла, чей зашифрованный объект (и DEK) использует эта запись; NULL - объект свой.
+    # Объект удаляется, только когда на него не ссылается ни одна строка (app/blob_gc.py)
+    blob_uuid = Column(UUID(as_uuid=True), nullable=True)
+
     owner = relationship("User", back_populates="files")
 
+    # Частичные составные индексы под список файлов: WHERE user_id = ? AND deleted_at IS NULL ORDER BY <col>, file_id.
+    # Отдельные DESC-индексы не нужны: ORDER BY col DESC, file_id DESC читает тот же индекс в обратном порядке.
+    __table_args__ = (
+        Index("idx_files_live_user_uploaded_at", "user_id", "uploaded_at", "file_id",
+              postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL")),
+        Index("idx_files_live_user_original_filename", "user_id", "original_filename", "file_id",
+              postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL")),
+        Index("idx_files_live_user_mime_type", "user_id", "mime_type", "file_id",
+              postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL")),
+        Index("idx_files_live_user_file_size_bytes", "user_id", "file_size_bytes", "file_id",
+              postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL")),
+        # Фильтр по семейству MIME-типа с сортировкой по умолчанию (по дате загрузки)
+        Index("idx_files_live_user_mime_family_uploaded_at", "user_id", "mime_family", "uploaded_at", "file_id",
+              postgresql_where=text("deleted_at IS NULL"), sqlite_where=text("deleted_at IS NULL")),
+        # Удаленные файлы, срок хранения которых истек (app/blob_gc.py)
+        Index("idx_files_deleted_at", "deleted_at",
+              postgresql_where=text("deleted_at IS NOT NULL"), sqlite_where=text("deleted_at IS NOT NULL")),
+        # Поиск дубликата при загрузке
+        Index("idx_files_live_user_content_hash", "user_id", "content_hash",
+              postgresql_where=text("deleted_at IS NULL AND content_hash IS NOT NULL"),
+              sqlite_where=text("deleted_at IS NULL AND content_hash IS NOT NULL")),
+        # Ссылки на чужие объекты: проверка перед удалением объекта и при поиске сирот
+        Index("idx_files_blob_uuid", "blob_uuid",
+              postgresql_where=text("blob_uuid IS NOT NULL"), sqlite_where=text("blob_uuid IS NOT NULL")),
+    )
+
+
+class UserFileStats(Base):
+    """Агрегаты по неудаленным файлам пользователя (обновляются при загрузке и удалении, см. crud)."""
+    __tablename__ = "user_file_stats"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    total_files = Column(Integer, nullable=False, default=0)
+    total_bytes = Column(BigInteger, nullable=False, default=0) # Сумма file_size_bytes (то, что занято на диске)
+    # Сумма file_size_bytes неудаленных файлов, которые ссылаются на объект другого файла (не хранятся повторно)
+    dedup_saved_bytes = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+
+class UserMimeFamilyStats(Base):
+    """Число файлов пользователя по семейству MIME-типа ("image", "video", "application", ...)."""
+    __tablename__ = "user_mime_family_stats"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    mime_family = Column(String(50), primary_key=True)
+    file_count = Column(Integer, nullable=False, default=0)
+
+
+class UploadSession(Base):
+    """Незавершенная возобновляемая загрузка (tus-подобный протокол, см. routers/uploads.py)."""
+    __tablename__ = "upload_sessions"
+
+    upload_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    original_filename = Column(String(255), nullable=False)
+    mime_type = Column(String(100), nullable=False)
+    upload_length = Column(BigInteger, nullable=False) # Заявленный размер исходного файла
+    upload_offset = Column(BigInteger, nullable=False, default=0) # Сколько байт исходника уже зашифровано и сохранено
+    # Файл шифруется сегментированным форматом по мере поступления частей
+    stored_filename_uuid = Column(UUID(as_uuid=True), unique=True, nullable=False, default=uuid.uuid4)
+    temp_path = Column(String(512), nullable=False) # Частично записанный зашифрованный файл
+    segment_size = Column(Integer, nullable=False)
+    nonce_prefix_hex = Column(String(14), nullable=False)
+    encrypted_dek_hex = Column(Text, nullable=False)
+    dek_iv_hex = Column(String(24), nullable=False)
+    dek_auth_tag_hex = Column(String(32), nullable=False)
+    # Для multipart-загрузок: размер каждой части (кроме последней). NULL - последовательная (tus) загрузка
+    part_size = Column(BigInteger, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True) # Брошенные сессии удаляются сборщиком
+
+    user = relationship("User")
+    parts = relationship("UploadPart", back_populates="upload_session", cascade="all, delete-orphan")
+
+    @property
+    def part_count(self) -> int:
+        if not self.part_size:
+            return 0
+        return max(1, -(-self.upload_length // self.part_size))
+
+
+class UploadPart(Base):
+    """Загруженная и зашифрованная часть multipart-загрузки."""
+    __tablename__ = "upload_parts"
+
+    upload_id = Column(UUID(as_uuid=True), ForeignKey("upload_sessions.upload_id", ondelete="CASCADE"), primary_key=True)
+    part_number = Column(Integer, primary_key=True) # Нумерация с 1, как в S3
+    size = Column(BigInteger, nullable=False) # Размер исходных данных части
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+    upload_session = relationship("UploadSession", back_populates="parts")
+
 
 class TwoFactorTempCode(Base): # Модель теперь будет использоваться и для регистрации
     __tablename__ = "two_factor_temp_codes"
@@ -80,6 +189,10 @@ class TwoFactorTempCode(Base): # Модель теперь будет испол
 
     user = relationship("User", back_populates="temp_2fa_codes")
 
+    __table_args__ = (
+        Index("idx_two_factor_temp_codes_expires_at", "expires_at"), # Для пакетного удаления просроченных (app/sweeper.py)
+    )
+
 class RefreshToken(Base):
     __tablename__ = "refresh_tokens"
 
@@ -90,4 +203,32 @@ class RefreshToken(Base):
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     # revoked_at = Column(DateTime(timezone=True), nullable=True) # Для явного отзыва токена
 
-    user = relationship("User") # Можно добавить back_populates в User, если нужно
\ No newline at end of file
+    user = relationship("User") # Можно добавить back_populates в User, если нужно
+
+    __table_args__ = (
+        Index("idx_refresh_tokens_expires_at", "expires_at"), # Для пакетного удаления просроченных (app/sweeper.py)
+    )
+
+
+class MailOutbox(Base):
+    """Исходящее письмо в очереди app/mailer.py. Отправленные письма удаляются из таблицы."""
+    __tablename__ = "mail_outbox"
+
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String(255), nullable=False)
+    subject = Column(String(255), nullable=False)
+    body = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="pending") # "pending", "sending" или "failed" (попытки исчерпаны)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    claim_token = Column(String(32), nullable=True) # Какой отправитель забрал письмо (при нескольких воркерах)
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(Text, nullable=True)
+    # После этого времени письмо бессмысленно (код истек): не отправляется, удаляется sweeper'ом
+    expires_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        Index("idx_mail_outbox_due", "status", "next_attempt_at"),
+        Index("idx_mail_outbox_expires_at", "expires_at"),
+    )
@@ -0,0 +1,128 @@
+# app/password_hashing.py
+# Отдельный ограниченный пул для bcrypt (пароли и резервные коды).
+# Раньше хеширование шло через общий threadpool Starlette (run_in_threadpool), в котором
+# крутятся и потоковые скачивания файлов: всплеск логинов занимал все потоки и тормозил файлы.
+# Здесь у bcrypt свой пул (PASSWORD_HASH_WORKERS) и своя очередь (PASSWORD_HASH_MAX_QUEUE):
+# когда очередь полна, запрос сразу получает 429 вместо ожидания.
+import asyncio
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Optional
+
+from . import security
+from .config import settings
+
+
+class PasswordHashPoolBusy(Exception):
+    """Очередь хеширования заполнена (в main.py превращается в 429 Too Many Requests)."""
+
+
+def _timed_call(function, *args):
+    # Выполняется в воркере: время самого bcrypt, без ожидания в очереди
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+class PasswordHashPool:
+    def __init__(self, workers: int, max_queue: int, executor_kind: str = "thread"):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.executor_kind = executor_kind
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self.in_flight = 0 # Выполняются + ждут в очереди
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.hash_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.executor_kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+            return self._executor
+
+    def _admit(self, count: int):
+        with self._lock:
+            if self.in_flight + count > self.workers + self.max_queue:
+                self.rejected += count
+                raise PasswordHashPoolBusy()
+            self.in_flight += count
+
+    async def _execute(self, function, args: tuple):
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, hash_seconds = await loop.run_in_executor(self._get_executor(), _timed_call, function, *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        latency = time.perf_counter() - started
+        with self._lock:
+            self.completed += 1
+            self.hash_seconds_total += hash_seconds
+            self.wait_seconds_total += max(0.0, latency - hash_seconds)
+            self.latency_seconds_max = max(self.latency_seconds_max, latency)
+        return result
+
+    async def run(self, function, *args):
+        """Выполняет function(*args) в пуле; PasswordHashPoolBusy, если свободных мест в очереди нет."""
+        self._admit(1)
+        return await self._execute(function, args)
+
+    async def run_many(self, function, args_list: list) -> list:
+        """Пачка вызовов: места в очереди занимаются сразу на всю пачку (все или ничего),
+        сами вызовы распределяются по воркерам параллельно."""
+        self._admit(len(args_list))
+        # Дожидаемся всех вызовов даже при ошибке одного: каждый сам освобождает свое место в очереди
+        results = await asyncio.gather(*[self._execute(function, args) for args in args_list], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "executor": self.executor_kind,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "hash_seconds_avg": round(self.hash_seconds_total / self.completed, 6) if self.completed else 0.0,
+                "queue_wait_seconds_avg": round(self.wait_seconds_total / self.completed, 6) if self.completed else 0.0,
+                "latency_seconds_max": round(self.latency_seconds_max, 6),
+            }
+
+
+password_hash_pool = PasswordHashPool(
+    settings.PASSWORD_HASH_WORKERS,
+    settings.PASSWORD_HASH_MAX_QUEUE,
+    settings.PASSWORD_HASH_EXECUTOR
+)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hash_pool.run(security.get_password_hash, password)
+
+
+async def hash_passwords(passwords: list) -> list:
+    return await password_hash_pool.run_many(security.get_password_hash, [(password,) for password in passwords])
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hash_pool.run(security.verify_password, plain_password, hashed_password)
@@ -1,36 +1,69 @@
 # app/routers/files.py
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File as FastAPIFile, Query
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File as FastAPIFile, Query, Header, Request
 from fastapi.responses import StreamingResponse # Для скачивания файлов
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from email.utils import format_datetime
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import logging
 import shutil # Для копирования потоков файлов
 import os
 import uuid
 import base64
-from io import BytesIO
 from urllib.parse import quote # <--- ДОБАВИТЬ ЭТОТ ИМПОРТ
-from datetime import datetime, date # Добавляем date для query параметров даты
-from typing import Optional # Добавляем Optional
-from .. import schemas, crud, models, encryption
+from datetime import datetime, date, timezone # Добавляем date для query параметров даты
+from typing import Optional, Tuple # Добавляем Optional
+from .. import schemas, crud, models, encryption, key_cache, dedup, storage, storage_layout
 from ..database import get_db
-from ..deps import get_current_active_user # Зависимость для аутентификации
+from ..deps import get_current_identity # Зависимость для аутентификации
 from ..config import settings
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     tags=["Files"],
-    dependencies=[Depends(get_current_active_user)] # Все эндпоинты здесь требуют аутентификации
+    dependencies=[Depends(get_current_identity)] # Все эндпоинты здесь требуют аутентификации
 )
 
-# Определяем базовый путь для хранения файлов (лучше вынести в config.py)
-# Убедитесь, что эта директория существует и у приложения есть права на запись
-FILES_STORAGE_PATH = os.path.join(os.getcwd(), "user_files_encrypted") 
-os.makedirs(FILES_STORAGE_PATH, exist_ok=True)
+# Базовый каталог локального хранилища и временных файлов загрузок (settings.FILES_STORAGE_PATH);
+# пути внутри него выбирает storage_layout, а где лежат готовые файлы - storage.backend
+FILES_STORAGE_PATH = storage_layout.FILES_STORAGE_PATH
+
+
+def _encrypt_to_disk(source_stream, file_location_on_disk: str, file_encryption_key: bytes):
+    """Блокирующая часть загрузки: шифрует source_stream в файл на диске. Вызывать через run_in_threadpool."""
+    with open(file_location_on_disk, "wb", buffering=encryption.PIPELINE_BUFFER_SIZE) as encrypted_file_on_disk:
+        # Шифруем и пишем файл по сегментам (encryption.SEGMENTED_ALGORITHM)
+        return encryption.encrypt_file_stream_pipelined(source_stream, encrypted_file_on_disk, file_encryption_key)
+
+
+def _remove_temp_file(temp_location_on_disk: str):
+    try:
+        os.remove(temp_location_on_disk)
+    except FileNotFoundError:
+        pass
+
+
+async def _store_unless_duplicate(db: AsyncSession, user_id: int, content_hash: Optional[str],
+                                  temp_location_on_disk: str, stored_path: str) -> Optional[models.File]:
+    """Если у пользователя уже есть неудаленный файл с тем же содержимым, удаляет временную копию и возвращает его.
+    Иначе передает временный файл в хранилище под stored_path и возвращает None."""
+    duplicate = await crud.find_file_by_content_hash(db, user_id, content_hash) if content_hash else None
+    if content_hash:
+        dedup.dedup_stats.record(duplicate.file_size_bytes if duplicate else None)
+    if duplicate is not None:
+        await run_in_threadpool(os.remove, temp_location_on_disk)
+    else:
+        await run_in_threadpool(storage.backend.put_file, temp_location_on_disk, stored_path)
+    return duplicate
 
 
 @router.post("/upload", response_model=schemas.FileInfo, status_code=status.HTTP_201_CREATED)
 async def upload_file(
     file: UploadFile = FastAPIFile(...), 
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
 ):
     if not file.filename:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No filename provided.")
@@ -39,31 +72,36 @@ async def upload_file(
     
     # Генерируем уникальное имя для хранения файла на сервере
     stored_file_uuid = uuid.uuid4()
-    # Путь, где будет храниться зашифрованный файл
-    # Можно добавить поддиректории на основе user_id для организации
-    file_location_on_disk = os.path.join(FILES_STORAGE_PATH, f"{stored_file_uuid}.enc")
+    # Ключ зашифрованного файла в хранилище (в БД - он же); шифруем во временный локальный файл,
+    # готовый файл забирает storage.backend
+    stored_path = storage_layout.layout.blob_path(stored_file_uuid)
+    temp_location_on_disk = storage_layout.ensure_parent_directory(storage_layout.layout.temp_path(stored_file_uuid))
 
     file_data_iv = None
     file_data_auth_tag = None
     actual_file_size = 0
+    # Хеш содержимого для дедупликации считается тем же чтением, что и шифрование
+    content_hasher = dedup.new_content_hasher(current_user.user_id)
 
     try:
-        # Открываем временный файл для записи зашифрованных данных
-        with open(file_location_on_disk, "wb") as encrypted_file_on_disk:
-            # Шифруем и пишем файл по частям
-            file_data_iv, file_data_auth_tag = encryption.encrypt_file_stream(
-                file.file, # file.file - это файлоподобный объект UploadFile
-                encrypted_file_on_disk, 
-                file_encryption_key
-            )
-        # Получаем размер ЗАШИФРОВАННОГО файла
-        actual_file_size = os.path.getsize(file_location_on_disk)
+        # Чтение спула UploadFile, шифрование и запись идут в threadpool (конвейером, буферы по 1 МиБ),
+        # чтобы большая загрузка не блокировала event loop для остальных запросов
+        file_data_iv, file_data_auth_tag = await run_in_threadpool(
+            _encrypt_to_disk,
+            dedup.HashingReader(file.file, content_hasher) if content_hasher else file.file, # file.file - это файлоподобный объект UploadFile
+            temp_location_on_disk,
+            file_encryption_key
+        )
+        # Получаем размер ЗАШИФРОВАННОГО файла (stat - тоже в threadpool)
+        actual_file_size = await run_in_threadpool(os.path.getsize, temp_location_on_disk)
+        plaintext_size = encryption.segmented_plaintext_size(actual_file_size, encryption.DEFAULT_SEGMENT_SIZE)
+        content_hash = content_hasher.hexdigest() if content_hasher else None
+        duplicate = await _store_unless_duplicate(db, current_user.user_id, content_hash, temp_location_on_disk, stored_path)
 
     except Exception as e:
         # Если ошибка при шифровании/записи, удаляем частично созданный файл
-        if os.path.exists(file_location_on_disk):
-            os.remove(file_location_on_disk)
-        print(f"Ошибка при загрузке и шифровании файла: {e}")
+        await asyncio.shield(run_in_threadpool(_remove_temp_file, temp_location_on_disk))
+        logger.error(f"Ошибка при загрузке и шифровании файла: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not upload/encrypt file: {e}")
     finally:
         await file.close() # Важно закрыть файл, который пришел в UploadFile
@@ -71,29 +109,132 @@ async def upload_file(
     if file_data_iv is None or file_data_auth_tag is None:
          raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Encryption metadata (IV/Tag) not generated.")
 
+    if duplicate is not None:
+        # Такое содержимое у пользователя уже есть: новая запись ссылается на сохраненный объект
+        return await crud.create_deduplicated_file(db, duplicate, original_filename=file.filename,
+                                                   mime_type=file.content_type or "application/octet-stream")
+
     # Сохраняем метаданные в БД
-    db_file = crud.create_file_metadata(
+    db_file = await crud.create_file_metadata(
         db=db,
         user_id=current_user.user_id,
         original_filename=file.filename,
         mime_type=file.content_type or "application/octet-stream",
         file_size_bytes=actual_file_size, # Сохраняем размер зашифрованного файла
-        storage_path=file_location_on_disk, # Или относительный путь, если FILES_STORAGE_PATH - базовый
+        storage_path=stored_path, # Относительно FILES_STORAGE_PATH
         file_data_iv=file_data_iv,
         file_data_auth_tag=file_data_auth_tag,
-        file_encryption_key=file_encryption_key
+        file_encryption_key=file_encryption_key,
+        encryption_algorithm=encryption.SEGMENTED_ALGORITHM,
+        plaintext_size_bytes=plaintext_size,
+        stored_filename_uuid=stored_file_uuid,
+        content_hash=content_hash
     )
     
     return db_file
 
 
+def _write_encrypted(encryptor: encryption.SegmentedEncryptor, encrypted_file_on_disk, data: bytes, content_hasher=None):
+    if content_hasher is not None:
+        content_hasher.update(data)
+    encrypted_file_on_disk.write(encryptor.update(data))
+
+
+def _finish_encrypted(encryptor: encryption.SegmentedEncryptor, encrypted_file_on_disk, data: bytes, content_hasher=None):
+    if content_hasher is not None:
+        content_hasher.update(data)
+    encrypted_file_on_disk.write(encryptor.update(data))
+    encrypted_file_on_disk.write(encryptor.finalize())
+    encrypted_file_on_disk.flush()
+    os.fsync(encrypted_file_on_disk.fileno()) # Данные должны быть на диске до атомарного переименования
+
+
+@router.post("/upload/stream", response_model=schemas.FileInfo, status_code=status.HTTP_201_CREATED)
+async def upload_file_stream(
+    request: Request,
+    filename: str = Query(..., min_length=1, max_length=255, description="Original filename of the uploaded content"),
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    """Загрузка "сырым" телом запроса (не multipart).
+
+    В отличие от /upload, тело не спулится Starlette во временный файл: каждый пришедший кусок
+    сразу шифруется и пишется в user_files_encrypted/ под временным именем, а после успешного
+    завершения файл атомарно переименовывается. Каждый байт пишется на диск один раз,
+    и размер загрузки не ограничен местом во временной директории.
+    MIME-тип берется из заголовка Content-Type.
+    """
+    mime_type = (request.headers.get("content-type") or "application/octet-stream").split(";")[0].strip()
+
+    file_encryption_key = encryption.generate_random_file_key() # DEK для этого файла
+    stored_file_uuid = uuid.uuid4()
+    stored_path = storage_layout.layout.blob_path(stored_file_uuid)
+    # Временное имя в каталоге итогового файла: локальный бэкенд забирает его атомарным os.replace
+    temp_location_on_disk = storage_layout.ensure_parent_directory(storage_layout.layout.temp_path(stored_file_uuid))
+
+    encryptor = encryption.SegmentedEncryptor(file_encryption_key)
+    content_hasher = dedup.new_content_hasher(current_user.user_id)
+    try:
+        # Открытие, закрытие и удаление временного файла - тоже в threadpool, как и запись
+        encrypted_file_on_disk = await run_in_threadpool(open, temp_location_on_disk, "wb")
+        try:
+            buffer = bytearray()
+            async for chunk in request.stream():
+                buffer += chunk
+                if len(buffer) >= encryption.PIPELINE_BUFFER_SIZE:
+                    # Шифрование и запись - в threadpool, сеть продолжает читаться в event loop
+                    await run_in_threadpool(_write_encrypted, encryptor, encrypted_file_on_disk, bytes(buffer), content_hasher)
+                    buffer.clear()
+            await run_in_threadpool(_finish_encrypted, encryptor, encrypted_file_on_disk, bytes(buffer), content_hasher)
+        finally:
+            # shield: файл закрывается и при отмене запроса
+            await asyncio.shield(run_in_threadpool(encrypted_file_on_disk.close))
+        # Размер зашифрованного файла известен без обращения к диску
+        actual_file_size = encryption.segmented_encrypted_size(encryptor.plaintext_size, encryptor.header.segment_size)
+        content_hash = content_hasher.hexdigest() if content_hasher else None
+        duplicate = await _store_unless_duplicate(db, current_user.user_id, content_hash, temp_location_on_disk, stored_path)
+    except ClientDisconnect:
+        await asyncio.shield(run_in_threadpool(_remove_temp_file, temp_location_on_disk))
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Client disconnected during upload.")
+    except Exception as e:
+        await asyncio.shield(run_in_threadpool(_remove_temp_file, temp_location_on_disk))
+        logger.error(f"Ошибка при потоковой загрузке и шифровании файла: {e}", exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Could not upload/encrypt file: {e}")
+
+    if duplicate is not None:
+        return await crud.create_deduplicated_file(db, duplicate, original_filename=filename, mime_type=mime_type)
+
+    db_file = await crud.create_file_metadata(
+        db=db,
+        user_id=current_user.user_id,
+        original_filename=filename,
+        mime_type=mime_type,
+        file_size_bytes=actual_file_size, # Размер зашифрованного файла
+        storage_path=stored_path,
+        file_data_iv=encryptor.header.nonce_prefix,
+        file_data_auth_tag=encryptor.final_tag,
+        file_encryption_key=file_encryption_key,
+        encryption_algorithm=encryption.SEGMENTED_ALGORITHM,
+        plaintext_size_bytes=encryptor.plaintext_size,
+        stored_filename_uuid=stored_file_uuid,
+        content_hash=content_hash
+    )
+    return db_file
+
+
 @router.get("", response_model=schemas.FileListResponse) # Путь остается тот же
-def list_user_files(
+async def list_user_files(
     # Параметры пагинации
     skip: int = Query(0, ge=0, description="Number of records to skip for pagination"),
     limit: int = Query(100, ge=1, le=200, description="Maximum number of records to return"),
+    cursor: Optional[str] = Query(None, max_length=1024, description="Opaque next_cursor from the previous page (keyset pagination, use instead of skip)"),
     # Параметры поиска и фильтрации
     search: Optional[str] = Query(None, min_length=1, max_length=100, description="Search term for filename or MIME type"),
+    search_mode: str = Query(
+        "substring",
+        description="How to match search: 'substring' (anywhere), 'prefix' (start of filename/MIME type) or 'tokens' (all words, any order)",
+        regex="^(substring|prefix|tokens)$"
+    ),
     mime_type: Optional[str] = Query(None, max_length=50, description="Filter by MIME type (e.g., 'image/jpeg', 'image', 'pdf')"),
     date_from: Optional[date] = Query(None, description="Filter by upload date from (YYYY-MM-DD)"),
     date_to: Optional[date] = Query(None, description="Filter by upload date to (YYYY-MM-DD)"),
@@ -109,8 +250,13 @@ def list_user_files(
         description="Sort order: 'asc' or 'desc'",
         regex="^(asc|desc)$" # Строго 'asc' или 'desc'
     ),
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    count_mode: str = Query(
+        "exact",
+        description="How to compute total_files for filtered listings: 'exact' (window function, same query), 'estimate' (planner estimate) or 'none'",
+        regex="^(exact|estimate|none)$"
+    ),
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
 ):
     # FastAPI автоматически преобразует date из строки "YYYY-MM-DD" в объект datetime.date
     # Для сравнения с полем DateTime в БД, их нужно будет привести к datetime.datetime
@@ -133,115 +279,256 @@ def list_user_files(
             detail=f"Invalid sort_by field. Allowed fields are: {', '.join(allowed_sort_fields)}"
         )
 
-    files_list = crud.get_files_for_user(
-        db, 
-        user_id=current_user.user_id, 
-        skip=skip, 
-        limit=limit,
-        search_term=search,
-        mime_type_filter=mime_type,
-        date_from_filter=datetime_from,
-        date_to_filter=datetime_to,
-        sort_by=sort_by,
-        sort_order=sort_order.lower() if sort_order else "desc" # Приводим к нижнему регистру
-    )
-    total_files_count = crud.count_files_for_user(
-        db, 
-        user_id=current_user.user_id,
+    if cursor and skip:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Use either skip or cursor, not both.")
+
+    sort_order = sort_order.lower() if sort_order else "desc" # Приводим к нижнему регистру
+    filter_kwargs = dict(
         search_term=search,
         mime_type_filter=mime_type,
         date_from_filter=datetime_from,
         date_to_filter=datetime_to
     )
-    return {"files": files_list, "total_files": total_files_count}
+    is_filtered = any(value is not None for value in filter_kwargs.values())
+    filter_kwargs["search_mode"] = search_mode
+    # Без фильтров общее число берем из счетчиков пользователя - отдельный COUNT(*) не нужен.
+    # С фильтрами при exact считаем окном COUNT(*) OVER () в том же запросе, что и страницу.
+    use_window_count = count_mode == "exact" and is_filtered and not cursor
+    total_files_count = None
+    try:
+        # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+        if use_window_count:
+            files_list, total_files_count = await crud.get_files_with_total_for_user(
+                db,
+                user_id=current_user.user_id,
+                skip=skip,
+                limit=limit + 1,
+                sort_by=sort_by,
+                sort_order=sort_order,
+                **filter_kwargs
+            )
+        else:
+            files_list = await crud.get_files_for_user(
+                db, 
+                user_id=current_user.user_id, 
+                skip=skip, 
+                limit=limit + 1,
+                sort_by=sort_by,
+                sort_order=sort_order,
+                cursor=cursor,
+                **filter_kwargs
+            )
+    except ValueError as ve: # Поврежденный курсор или курсор от другой сортировки
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(ve))
+
+    next_cursor = None
+    if len(files_list) > limit:
+        files_list = files_list[:limit]
+        next_cursor = crud.encode_file_cursor(files_list[-1], sort_by, sort_order)
+
+    total_files_is_estimate = False
+    if count_mode == "none":
+        total_files_count = None
+    elif not is_filtered:
+        total_files_count = (await crud.ensure_user_file_stats(db, current_user.user_id)).total_files
+    elif use_window_count:
+        if total_files_count is None:
+            # Пустая страница: окно ничего не вернуло. На первой странице это 0, дальше - считаем отдельно
+            total_files_count = await crud.count_files_for_user(db, user_id=current_user.user_id, **filter_kwargs) if skip else 0
+    elif count_mode == "estimate":
+        total_files_count = await crud.estimate_files_count_for_user(db, user_id=current_user.user_id, **filter_kwargs)
+        total_files_is_estimate = True
+    else:
+        # exact + курсор: условие курсора попадает в WHERE, окно посчитало бы только остаток
+        total_files_count = await crud.count_files_for_user(db, user_id=current_user.user_id, **filter_kwargs)
+    return {
+        "files": files_list,
+        "total_files": total_files_count,
+        "total_files_is_estimate": total_files_is_estimate,
+        "next_cursor": next_cursor
+    }
+
+
+@router.get("/stats", response_model=schemas.FileStats)
+async def get_user_file_stats(
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_stats = await crud.ensure_user_file_stats(db, current_user.user_id)
+    return {
+        "total_files": db_stats.total_files,
+        "total_bytes": db_stats.total_bytes,
+        "dedup_saved_bytes": db_stats.dedup_saved_bytes,
+        "mime_families": await crud.get_user_mime_family_counts(db, current_user.user_id)
+    }
+
+
+def _parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Разбирает заголовок Range (RFC 9110) для одного диапазона байт.
+
+    Возвращает (start, end) включительно; None, если заголовок не поддерживается (тогда отдаем весь файл).
+    Бросает 416, если диапазон синтаксически верен, но не пересекается с файлом.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not ranges or "," in ranges: # Несколько диапазонов не поддерживаем
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "": # bytes=-N: последние N байт
+            suffix_length = int(last)
+            if suffix_length <= 0:
+                raise ValueError
+            start, end = max(size - suffix_length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else max(start, size - 1)
+            if start < 0 or end < start: # Синтаксически неверный диапазон игнорируется
+                return None
+            end = min(end, size - 1)
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable.",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def _file_validators(db_file: models.File) -> Tuple[str, str]:
+    # Содержимое файла никогда не меняется после загрузки, поэтому UUID хранения - надежный сильный ETag
+    etag = f'"{db_file.stored_filename_uuid}"'
+    last_modified = ""
+    if db_file.uploaded_at:
+        uploaded_at = db_file.uploaded_at
+        if uploaded_at.tzinfo is None: # SQLite возвращает naive datetime (храним в UTC)
+            uploaded_at = uploaded_at.replace(tzinfo=timezone.utc)
+        last_modified = format_datetime(uploaded_at, usegmt=True)
+    return etag, last_modified
+
+
+def _get_plaintext_size(db_file: models.File, encrypted_stream) -> int:
+    # Старые записи без размера: вычисляем по размеру зашифрованного файла (читается только заголовок)
+    return encryption.plaintext_size(encrypted_stream, db_file.encryption_algorithm)
 
 
 @router.get("/{file_id}/download")
 async def download_file(
     file_id: int,
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_range: Optional[str] = Header(None, alias="If-Range"),
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_file = crud.get_file_by_id_and_user(db, file_id=file_id, user_id=current_user.user_id)
+    db_file = await crud.get_file_by_id_and_user(db, file_id=file_id, user_id=current_user.user_id)
     if not db_file:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
 
-    if not os.path.exists(db_file.storage_path):
+    # Путь из БД, а если файл уже перенесен в новую раскладку (storage_layout migrate) - путь по раскладке.
+    # Открываем до ответа, чтобы отсутствие файла было 500, а не оборванным потоком
+    try:
+        encrypted_stream = await run_in_threadpool(storage.open_file_blob, db_file.storage_path, db_file.blob_uuid or db_file.stored_filename_uuid)
+    except FileNotFoundError:
         # Это серьезная проблема, метаданные есть, а файла нет
-        print(f"Критическая ошибка: файл {db_file.storage_path} не найден на диске для file_id {db_file.file_id}")
+        logger.critical(f"Критическая ошибка: файл {db_file.storage_path} не найден в хранилище для file_id {db_file.file_id}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="File data missing on server.")
 
+    # До создания генераторов поток закрываем сами: любое исключение ниже (ключ, размер, 416 на Range)
+    # иначе оставит открытым файловый дескриптор или HTTP-соединение S3
     try:
-        # Дешифруем ключ файла (DEK)
-        file_encryption_key = encryption.decrypt_file_key(
-            encrypted_file_key_hex=db_file.encrypted_dek_hex,
-            iv_hex=db_file.dek_iv_hex,
-            auth_tag_hex=db_file.dek_auth_tag_hex
-        )
-        
-        # Получаем тег аутентификации для данных файла
-        file_data_auth_tag = base64.b16decode(db_file.encryption_auth_tag)
+        try:
+            # Дешифруем ключ файла (DEK) или берем его из кэша
+            file_encryption_key = key_cache.get_file_key(db_file)
 
-    except Exception as e:
-        print(f"Ошибка при дешифровании ключа файла {db_file.file_id}: {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to prepare file for download (key error).")
+            # Получаем тег аутентификации для данных файла
+            file_data_auth_tag = base64.b16decode(db_file.encryption_auth_tag)
 
-    async def file_streamer():
-        try:
-            with open(db_file.storage_path, "rb") as encrypted_file_on_disk:
-                # Создаем временный поток в памяти для дешифрованных данных
-                # В реальном приложении с большими файлами лучше стримить дешифрование напрямую
-                # или использовать временные файлы для дешифрованных данных, если памяти мало.
-                # Для РГР BytesIO может подойти для небольших/средних файлов.
-                
-                # Это не самый эффективный способ для больших файлов, т.к. весь файл читается в память
-                # Лучше было бы создать генератор, который читает и дешифрует по частям.
-                # Но для простоты пока так:
-                decrypted_stream = BytesIO()
-                encryption.decrypt_file_stream(
-                    encrypted_file_on_disk, 
-                    decrypted_stream, 
-                    file_encryption_key, 
+        except Exception as e:
+            logger.error(f"Ошибка при дешифровании ключа файла {db_file.file_id}: {e}")
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to prepare file for download (key error).")
+
+        file_size = db_file.plaintext_size_bytes
+        if file_size is None: # Старые записи: читается заголовок файла
+            file_size = await run_in_threadpool(_get_plaintext_size, db_file, encrypted_stream)
+        etag, last_modified = _file_validators(db_file)
+        can_seek = encryption.supports_range(db_file.encryption_algorithm)
+
+        # Range учитываем только для сегментированного формата: старый GCM-поток нельзя дешифровать
+        # с середины без потери проверки целостности, поэтому для него всегда отдаем весь файл (200).
+        # If-Range: если валидатор не совпадает, файл изменился - отдаем его целиком.
+        byte_range = None
+        if range_header and can_seek and (if_range is None or if_range.strip() in (etag, last_modified)):
+            byte_range = _parse_range_header(range_header, file_size)
+    except BaseException:
+        encrypted_stream.close()
+        raise
+
+    def range_streamer(start: int, end: int):
+        with encrypted_stream as encrypted_file_on_disk:
+            try:
+                yield from encryption.iter_decrypt_range(encrypted_file_on_disk, file_encryption_key, start, end)
+            except ValueError as ve:
+                logger.error(f"Ошибка целостности при скачивании диапазона файла {db_file.file_id}: {ve}")
+                raise
+
+    def file_streamer():
+        # Синхронный генератор: StreamingResponse крутит его в threadpool, так что чтение с диска
+        # и дешифрование не блокируют event loop. В памяти держим только текущий чанк.
+        with encrypted_stream as encrypted_file_on_disk:
+            encrypted_file_on_disk.seek(0)
+            try:
+                # Сегментированный формат проверяется и отдается посегментно,
+                # старый (один GCM-поток) - проверяется в конце потока
+                yield from encryption.iter_decrypt_file(
+                    encrypted_file_on_disk,
+                    file_encryption_key,
+                    db_file.encryption_algorithm,
                     file_data_auth_tag
                 )
-                decrypted_stream.seek(0) # Перемещаем курсор в начало потока
-                while True:
-                    chunk = decrypted_stream.read(4096)
-                    if not chunk:
-                        break
-                    yield chunk
-        except ValueError as ve: # Ошибка от decrypt_file_stream (InvalidTag)
-            print(f"Ошибка целостности при скачивании файла {db_file.file_id}: {ve}")
-            # Важно не отдавать поврежденные данные. Как обработать на клиенте?
-            # Можно попробовать передать ошибку в заголовке или вернуть другой статус, но StreamingResponse сложнее.
-            # Простейший вариант - просто прервать поток. Клиент получит неполный файл или ошибку сети.
-            # Для Swagger это может быть не очень наглядно.
-            # raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(ve)) # Не сработает внутри генератора
-            # Вместо этого можно yield b"ERROR: Decryption failed due to integrity check." и закрыть.
-            # Но клиент должен это обработать.
-            yield b"" # Отдаем пустой остаток или специальный маркер ошибки, если клиент умеет
-        except Exception as e:
-            print(f"Ошибка при потоковой передаче файла {db_file.file_id}: {e}")
-            yield b"" # Аналогично
+            except ValueError as ve: # Ошибка целостности (InvalidTag)
+                logger.error(f"Ошибка целостности при скачивании файла {db_file.file_id}: {ve}")
+                # Заголовки уже отправлены, поэтому вернуть 500 нельзя. Пробрасываем исключение:
+                # соединение оборвется без корректного завершения, и клиент не примет поврежденный файл как целый.
+                raise
 
     encoded_filename = quote(db_file.original_filename.encode('utf-8'))
     
     headers = {
         # Простой filename для старых браузеров (может отобразить кракозябры, если есть не-ASCII)
-        'Content-Disposition': f'attachment; filename="{db_file.original_filename.encode("latin-1", "replace").decode("latin-1")}"; filename*=UTF-8\'\'{encoded_filename}'
+        'Content-Disposition': f'attachment; filename="{db_file.original_filename.encode("latin-1", "replace").decode("latin-1")}"; filename*=UTF-8\'\'{encoded_filename}',
+        'Accept-Ranges': 'bytes' if can_seek else 'none',
+        'ETag': etag,
     }
+    if last_modified:
+        headers['Last-Modified'] = last_modified
     # ------------------------
-    
+
+    if byte_range is not None:
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(
+            range_streamer(start, end),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type=db_file.mime_type,
+            headers=headers
+        )
+
+    headers['Content-Length'] = str(file_size)
     return StreamingResponse(file_streamer(), media_type=db_file.mime_type, headers=headers)
 
 
 @router.delete("/{file_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_file_permanently(
     file_id: int,
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
 ):
-    db_file_metadata = crud.get_file_by_id_and_user(db, file_id=file_id, user_id=current_user.user_id)
+    db_file_metadata = await crud.get_file_by_id_and_user(db, file_id=file_id, user_id=current_user.user_id)
     if not db_file_metadata:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found or access denied.")
 
@@ -254,9 +541,10 @@ async def delete_file_permanently(
     # db.delete(db_file_metadata)
     # db.commit()
     # Для soft delete:
-    deleted_meta = crud.soft_delete_file(db, file_id=file_id, user_id=current_user.user_id)
+    deleted_meta = await crud.soft_delete_file(db, file_id=file_id, user_id=current_user.user_id)
     if not deleted_meta: # Если вдруг soft_delete вернул None
          raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="File not found during delete.")
+    key_cache.dek_cache.invalidate(file_id) # Ключ удаленного файла больше не нужен в памяти
 
 
     # Затем удаляем файл с диска (если это не soft delete, а полное удаление)
@@ -0,0 +1,531 @@
+# app/routers/uploads.py
+# Возобновляемые загрузки (по мотивам протокола tus):
+#   POST   /uploads                -> создать сессию (имя, MIME, полный размер)
+#   HEAD   /uploads/{id}           -> узнать текущий Upload-Offset
+#   PATCH  /uploads/{id}           -> дослать данные, начиная с Upload-Offset
+#   POST   /uploads/{id}/finalize  -> превратить сессию в обычный File
+#   DELETE /uploads/{id}           -> отменить загрузку
+# Параллельные multipart-загрузки (по мотивам S3 multipart upload):
+#   POST   /uploads/multipart               -> создать сессию с фиксированным размером части
+#   PUT    /uploads/{id}/parts/{n}          -> загрузить часть n (части можно слать одновременно)
+#   GET    /uploads/{id}/parts              -> список загруженных частей
+#   POST   /uploads/{id}/complete           -> склеить части в один File
+# Данные шифруются сегментированным форматом (encryption.SEGMENTED_ALGORITHM) сразу по мере
+# поступления. Сохраняются только целые сегменты (и финальный), поэтому после обрыва связи
+# сервер сообщает offset, выровненный по границе сегмента, и клиент досылает только недостающее.
+import asyncio
+import logging
+import os
+import shutil
+import uuid
+from collections import deque
+from typing import List, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import APIRouter, Depends, HTTPException, status, Request, Header, Response, Path
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+from .. import schemas, crud, models, encryption, storage, storage_layout
+from ..database import get_db, AsyncSessionLocal
+from ..deps import get_current_identity
+from ..config import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    tags=["Uploads"],
+    dependencies=[Depends(get_current_identity)]
+)
+
+# Не даем двум PATCH одной сессии писать в файл одновременно (в пределах процесса;
+# между воркерами гонку ловит условный UPDATE в crud.advance_upload_session)
+_session_locks: dict[uuid.UUID, asyncio.Lock] = {}
+
+
+def _persisted_encrypted_size(db_session: models.UploadSession) -> int:
+    """Размер части файла, соответствующей сохраненному offset (выровнен по сегменту или равен upload_length)."""
+    if db_session.upload_offset == db_session.upload_length:
+        # Все данные получены: в файле есть и финальный (неполный или пустой) сегмент
+        return encryption.segmented_encrypted_size(db_session.upload_length, db_session.segment_size)
+    full_segments = db_session.upload_offset // db_session.segment_size
+    return encryption.SEGMENTED_HEADER_SIZE + full_segments * (db_session.segment_size + encryption.GCM_TAG_SIZE)
+
+
+def _session_header(db_session: models.UploadSession) -> encryption.SegmentedHeader:
+    return encryption.build_segmented_header(db_session.segment_size, bytes.fromhex(db_session.nonce_prefix_hex))
+
+
+def _session_file_key(db_session: models.UploadSession) -> bytes:
+    return encryption.decrypt_file_key(
+        encrypted_file_key_hex=db_session.encrypted_dek_hex,
+        iv_hex=db_session.dek_iv_hex,
+        auth_tag_hex=db_session.dek_auth_tag_hex
+    )
+
+
+def _encrypt_segments(aead: AESGCM, header: encryption.SegmentedHeader, part_file, data: bytes, offset: int, total: int) -> int:
+    """Шифрует и дописывает все целые сегменты из data (data начинается с plaintext-смещения offset).
+
+    Финальный (возможно неполный) сегмент записывается, когда данные доходят до total.
+    Возвращает число использованных байт data; остаток не сохраняется.
+    """
+    segment_size = header.segment_size
+    consumed = 0
+    while offset + consumed < total:
+        segment_start = offset + consumed
+        segment_end = min(segment_start + segment_size, total)
+        needed = segment_end - segment_start
+        if len(data) - consumed < needed:
+            break
+        final = segment_end == total
+        part_file.write(encryption.encrypt_segment(
+            aead, header, segment_start // segment_size, data[consumed:consumed + needed], final
+        ))
+        consumed += needed
+    return consumed
+
+
+def _sync_file(part_file):
+    part_file.flush()
+    os.fsync(part_file.fileno())
+
+
+def _open_for_append(temp_location_on_disk: str, persisted_size: int):
+    # Отбрасываем хвост, записанный после последнего сохраненного offset (например, при падении процесса)
+    part_file = open(temp_location_on_disk, "r+b")
+    part_file.truncate(persisted_size)
+    part_file.seek(0, os.SEEK_END)
+    return part_file
+
+
+def _upload_headers(db_session: models.UploadSession) -> dict:
+    return {
+        "Upload-Offset": str(db_session.upload_offset),
+        "Upload-Length": str(db_session.upload_length),
+        "Cache-Control": "no-store",
+    }
+
+
+async def _get_session_or_404(db: AsyncSession, upload_id: uuid.UUID, user_id: int) -> models.UploadSession:
+    db_session = await crud.get_upload_session(db, upload_id=upload_id, user_id=user_id)
+    if not db_session:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload session not found or expired.")
+    return db_session
+
+
+def _temp_location(db_session: models.UploadSession) -> str:
+    # temp_path хранится относительно FILES_STORAGE_PATH (у старых сессий - абсолютный)
+    return storage_layout.absolute_path(db_session.temp_path)
+
+
+def _part_path(db_session: models.UploadSession, part_number: int) -> str:
+    return f"{_temp_location(db_session)}{part_number}"
+
+
+def _remove_session_files(db_session: models.UploadSession, part_numbers: List[int]):
+    for path in [_temp_location(db_session)] + [_part_path(db_session, number) for number in part_numbers]:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Не удалось удалить файл загрузки {path}: {e}")
+
+
+def _create_session_file(temp_location_on_disk: str, header: encryption.SegmentedHeader, file_encryption_key: bytes, write_empty_final: bool):
+    with open(temp_location_on_disk, "wb") as part_file:
+        part_file.write(header.raw)
+        if write_empty_final:
+            part_file.write(encryption.encrypt_segment(AESGCM(file_encryption_key), header, 0, b"", final=True))
+
+
+async def _start_session(db: AsyncSession, upload_in: schemas.UploadSessionCreate, user_id: int, part_size: Optional[int] = None) -> models.UploadSession:
+    file_encryption_key = encryption.generate_random_file_key()
+    stored_file_uuid = uuid.uuid4()
+    # Временный файл - локально, в каталоге шарда итогового файла (локальный бэкенд забирает его атомарным os.replace)
+    temp_path = storage_layout.layout.temp_path(stored_file_uuid)
+    temp_location_on_disk = storage_layout.ensure_parent_directory(temp_path)
+    header = encryption.build_segmented_header(encryption.DEFAULT_SEGMENT_SIZE, os.urandom(encryption.NONCE_PREFIX_SIZE))
+
+    # Пустой файл в последовательном режиме: сразу пишем пустой финальный сегмент
+    # (в multipart-режиме его дает единственная пустая часть)
+    write_empty_final = upload_in.upload_length == 0 and part_size is None
+    await run_in_threadpool(_create_session_file, temp_location_on_disk, header, file_encryption_key, write_empty_final)
+
+    return await crud.create_upload_session(
+        db,
+        user_id=user_id,
+        original_filename=upload_in.filename,
+        mime_type=upload_in.mime_type or "application/octet-stream",
+        upload_length=upload_in.upload_length,
+        temp_path=temp_path,
+        stored_filename_uuid=stored_file_uuid,
+        segment_size=header.segment_size,
+        nonce_prefix=header.nonce_prefix,
+        file_encryption_key=file_encryption_key,
+        part_size=part_size
+    )
+
+
+def _move_session_file(db_session: models.UploadSession, stored_path: str) -> Tuple[bytes, int]:
+    """Передает собранный файл в хранилище. Возвращает (тег последнего сегмента, размер файла).
+
+    Если размер файла не совпадает с ожидаемым для upload_length, бросает ValueError и файл не трогает.
+    """
+    temp_location_on_disk = _temp_location(db_session)
+    with open(temp_location_on_disk, "rb") as part_file:
+        encrypted_size = os.fstat(part_file.fileno()).st_size
+        expected_size = encryption.segmented_encrypted_size(db_session.upload_length, db_session.segment_size)
+        if encrypted_size != expected_size:
+            raise ValueError(f"Upload file has {encrypted_size} bytes, expected {expected_size}.")
+        part_file.seek(-encryption.GCM_TAG_SIZE, os.SEEK_END)
+        final_tag = part_file.read(encryption.GCM_TAG_SIZE)
+    storage.backend.put_file(temp_location_on_disk, stored_path)
+    return final_tag, encrypted_size
+
+
+async def _commit_session_file(db: AsyncSession, db_session: models.UploadSession, user_id: int) -> models.File:
+    """Переносит собранный зашифрованный файл на постоянное место и создает запись File."""
+    stored_path = storage_layout.layout.blob_path(db_session.stored_filename_uuid)
+    try:
+        final_tag, encrypted_size = await run_in_threadpool(_move_session_file, db_session, stored_path)
+    except ValueError as e:
+        # Файл, который нельзя дешифровать, не должен стать записью File
+        logger.error(f"Загрузка {db_session.upload_id} не завершена: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Uploaded data on the server is incomplete. Abort this upload and start a new one."
+        )
+
+    db_file = await crud.create_file_metadata(
+        db=db,
+        user_id=user_id,
+        original_filename=db_session.original_filename,
+        mime_type=db_session.mime_type,
+        file_size_bytes=encrypted_size, # Размер зашифрованного файла
+        storage_path=stored_path,
+        file_data_iv=bytes.fromhex(db_session.nonce_prefix_hex),
+        file_data_auth_tag=final_tag,
+        file_encryption_key=_session_file_key(db_session),
+        encryption_algorithm=encryption.SEGMENTED_ALGORITHM,
+        plaintext_size_bytes=db_session.upload_length,
+        stored_filename_uuid=db_session.stored_filename_uuid
+    )
+    await crud.delete_upload_session(db, db_session)
+    return db_file
+
+
+@router.post("", response_model=schemas.UploadSessionInfo, status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    upload_in: schemas.UploadSessionCreate,
+    response: Response,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _start_session(db, upload_in, current_user.user_id)
+    response.headers["Location"] = f"{db_session.upload_id}"
+    response.headers.update(_upload_headers(db_session))
+    return db_session
+
+
+@router.post("/multipart", response_model=schemas.MultipartUploadInfo, status_code=status.HTTP_201_CREATED)
+async def create_multipart_upload(
+    upload_in: schemas.MultipartUploadCreate,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    part_size = upload_in.part_size or settings.MULTIPART_DEFAULT_PART_SIZE
+    # Часть должна состоять из целых сегментов: тогда номер первого сегмента части известен заранее
+    # и каждую часть можно шифровать независимо от остальных
+    if part_size % encryption.DEFAULT_SEGMENT_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"part_size must be a multiple of {encryption.DEFAULT_SEGMENT_SIZE} bytes."
+        )
+    if max(1, -(-upload_in.upload_length // part_size)) > settings.MULTIPART_MAX_PARTS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Too many parts: increase part_size (max {settings.MULTIPART_MAX_PARTS} parts)."
+        )
+    return await _start_session(db, upload_in, current_user.user_id, part_size=part_size)
+
+
+@router.head("/{upload_id}")
+async def get_upload_offset(
+    upload_id: uuid.UUID,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    return Response(status_code=status.HTTP_200_OK, headers=_upload_headers(db_session))
+
+
+@router.get("/{upload_id}", response_model=schemas.UploadSessionInfo)
+async def get_upload(
+    upload_id: uuid.UUID,
+    response: Response,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    response.headers.update(_upload_headers(db_session))
+    return db_session
+
+
+@router.patch("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: uuid.UUID,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset", ge=0),
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    if db_session.part_size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="This is a multipart upload: use PUT /parts/{part_number}.")
+    lock = _session_locks.setdefault(upload_id, asyncio.Lock())
+    if lock.locked():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another chunk for this upload is in progress.")
+
+    async with lock:
+        try:
+            start_offset = db_session.upload_offset
+            if upload_offset != start_offset:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Upload-Offset mismatch: server has {start_offset} bytes.",
+                    headers=_upload_headers(db_session)
+                )
+
+            header = _session_header(db_session)
+            aead = AESGCM(_session_file_key(db_session))
+            total = db_session.upload_length
+            offset = start_offset
+            buffer = bytearray()
+            too_large = False
+
+            if start_offset == total:
+                # Все данные уже сохранены: файл с финальным сегментом не открываем (повтор последнего PATCH
+                # или PATCH пустого файла), любые новые байты - больше Upload-Length
+                try:
+                    async for chunk in request.stream():
+                        if chunk:
+                            too_large = True
+                            break
+                except ClientDisconnect:
+                    pass
+            else:
+                # Открытие и усечение файла - тоже в threadpool, как и шифрование с записью
+                part_file = await run_in_threadpool(_open_for_append, _temp_location(db_session), _persisted_encrypted_size(db_session))
+                try:
+                    try:
+                        async for chunk in request.stream():
+                            if offset + len(buffer) + len(chunk) > total:
+                                too_large = True
+                                break
+                            buffer += chunk
+                            if len(buffer) >= encryption.PIPELINE_BUFFER_SIZE:
+                                consumed = await run_in_threadpool(_encrypt_segments, aead, header, part_file, bytes(buffer), offset, total)
+                                offset += consumed
+                                del buffer[:consumed]
+                    except ClientDisconnect:
+                        pass # Сохраняем то, что успели получить; клиент узнает offset через HEAD
+                    consumed = await run_in_threadpool(_encrypt_segments, aead, header, part_file, bytes(buffer), offset, total)
+                    offset += consumed
+                    await run_in_threadpool(_sync_file, part_file)
+                finally:
+                    # shield: файл закрывается и при отмене запроса
+                    await asyncio.shield(run_in_threadpool(part_file.close))
+
+            if offset != start_offset and not await crud.advance_upload_session(db, db_session, start_offset, offset):
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session was modified concurrently.")
+            if too_large:
+                raise HTTPException(
+                    status_code=status.HTTP_413_CONTENT_TOO_LARGE,
+                    detail="Chunk exceeds the declared Upload-Length.",
+                    headers=_upload_headers(db_session)
+                )
+        finally:
+            _session_locks.pop(upload_id, None)
+
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_upload_headers(db_session))
+
+
+@router.post("/{upload_id}/finalize", response_model=schemas.FileInfo, status_code=status.HTTP_201_CREATED)
+async def finalize_upload(
+    upload_id: uuid.UUID,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    if db_session.part_size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="This is a multipart upload: use /complete.")
+    if db_session.upload_offset != db_session.upload_length:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload is incomplete: {db_session.upload_offset} of {db_session.upload_length} bytes received.",
+            headers=_upload_headers(db_session)
+        )
+    return await _commit_session_file(db, db_session, current_user.user_id)
+
+
+# Сколько пачек сегментов одной части может шифроваться одновременно (ограничивает память на запрос)
+MAX_BATCHES_IN_FLIGHT = 4
+
+
+def _publish_part(part_file, temp_part_location: str, part_location: str):
+    part_file.close()
+    os.replace(temp_part_location, part_location)
+
+
+def _discard_part(part_file, temp_part_location: str):
+    part_file.close()
+    try:
+        os.remove(temp_part_location)
+    except FileNotFoundError:
+        pass
+
+
+@router.put("/{upload_id}/parts/{part_number}", response_model=schemas.UploadPartInfo)
+async def upload_part(
+    upload_id: uuid.UUID,
+    request: Request,
+    part_number: int = Path(..., ge=1),
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    if not db_session.part_size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not a multipart upload.")
+    if part_number > db_session.part_count:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Part number must be between 1 and {db_session.part_count}.")
+
+    segment_size = db_session.segment_size
+    total = db_session.upload_length
+    part_start = (part_number - 1) * db_session.part_size
+    expected_size = min(db_session.part_size, total - part_start)
+    first_index = part_start // segment_size
+    final_index = max(0, -(-total // segment_size) - 1)
+    header_raw = _session_header(db_session).raw
+    file_key = _session_file_key(db_session)
+
+    loop = asyncio.get_running_loop()
+    executor = encryption.get_segment_executor()
+    batch_size = encryption.PIPELINE_BUFFER_SIZE - encryption.PIPELINE_BUFFER_SIZE % segment_size
+    pending = deque()
+    next_index = first_index
+
+    def submit(batch: bytes, index: int):
+        # Пачки шифруются параллельно на общем пуле, а пишутся строго по порядку
+        pending.append(loop.run_in_executor(executor, encryption.encrypt_segment_batch, file_key, header_raw, index, batch, final_index))
+
+    # Уникальное временное имя: повторная загрузка той же части не мешает текущей
+    part_location = _part_path(db_session, part_number)
+    temp_part_location = f"{part_location}.{uuid.uuid4().hex}.tmp"
+    # Открытие, закрытие и переименование файла - в threadpool, как и запись
+    part_file = await run_in_threadpool(open, temp_part_location, "wb")
+    try:
+        received = 0
+        buffer = bytearray()
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > expected_size:
+                raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f"Part {part_number} must be exactly {expected_size} bytes.")
+            buffer += chunk
+            while len(buffer) >= batch_size:
+                submit(bytes(buffer[:batch_size]), next_index)
+                del buffer[:batch_size]
+                next_index += batch_size // segment_size
+                if len(pending) >= MAX_BATCHES_IN_FLIGHT:
+                    await run_in_threadpool(part_file.write, await pending.popleft())
+        if received != expected_size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Part {part_number} must be exactly {expected_size} bytes, got {received}.")
+        if buffer or expected_size == 0: # Пустая часть бывает только у пустого файла: это пустой финальный сегмент
+            submit(bytes(buffer), next_index)
+        while pending:
+            await run_in_threadpool(part_file.write, await pending.popleft())
+        await run_in_threadpool(_sync_file, part_file)
+        await run_in_threadpool(_publish_part, part_file, temp_part_location, part_location)
+    except BaseException as e:
+        for future in pending:
+            future.cancel()
+        # shield: временный файл удаляется и при отмене запроса
+        await asyncio.shield(run_in_threadpool(_discard_part, part_file, temp_part_location))
+        if isinstance(e, ClientDisconnect):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Client disconnected during part upload.")
+        raise
+
+    return await crud.upsert_upload_part(db, db_session, part_number=part_number, size=expected_size)
+
+
+@router.get("/{upload_id}/parts", response_model=List[schemas.UploadPartInfo])
+async def list_upload_parts(
+    upload_id: uuid.UUID,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    return await crud.get_upload_parts(db, upload_id=db_session.upload_id)
+
+
+def _assemble_parts(db_session: models.UploadSession):
+    # Манифест = части по порядку номеров; сегменты уже зашифрованы с глобальными номерами,
+    # поэтому склейка - простое дописывание частей за заголовком
+    with open(_temp_location(db_session), "r+b") as assembled_file:
+        assembled_file.truncate(encryption.SEGMENTED_HEADER_SIZE)
+        assembled_file.seek(0, os.SEEK_END)
+        for part_number in range(1, db_session.part_count + 1):
+            with open(_part_path(db_session, part_number), "rb") as part_file:
+                shutil.copyfileobj(part_file, assembled_file, encryption.PIPELINE_BUFFER_SIZE)
+        _sync_file(assembled_file)
+
+
+@router.post("/{upload_id}/complete", response_model=schemas.FileInfo, status_code=status.HTTP_201_CREATED)
+async def complete_multipart_upload(
+    upload_id: uuid.UUID,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    if not db_session.part_size:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not a multipart upload: use /finalize.")
+
+    part_numbers = [db_part.part_number for db_part in await crud.get_upload_parts(db, upload_id=db_session.upload_id)]
+    missing_parts = sorted(set(range(1, db_session.part_count + 1)) - set(part_numbers))
+    if missing_parts:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Missing parts: {missing_parts[:50]}")
+
+    await run_in_threadpool(_assemble_parts, db_session)
+    db_file = await _commit_session_file(db, db_session, current_user.user_id)
+    await run_in_threadpool(_remove_session_files, db_session, part_numbers)
+    return db_file
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload(
+    upload_id: uuid.UUID,
+    current_user: schemas.TokenData = Depends(get_current_identity),
+    db: AsyncSession = Depends(get_db)
+):
+    db_session = await _get_session_or_404(db, upload_id, current_user.user_id)
+    part_numbers = [db_part.part_number for db_part in await crud.get_upload_parts(db, upload_id=db_session.upload_id)]
+    await run_in_threadpool(_remove_session_files, db_session, part_numbers)
+    await crud.delete_upload_session(db, db_session)
+    return
+
+
+async def purge_expired_upload_sessions(batch_size: int = 100) -> int:
+    """Удаляет брошенные сессии, их частично записанные файлы и загруженные части. Возвращает число удаленных сессий."""
+    purged = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            expired_sessions = await crud.get_expired_upload_sessions(db, limit=batch_size)
+            if not expired_sessions:
+                break
+            for db_session in expired_sessions:
+                part_numbers = [db_part.part_number for db_part in await crud.get_upload_parts(db, upload_id=db_session.upload_id)]
+                await run_in_threadpool(_remove_session_files, db_session, part_numbers)
+                await crud.delete_upload_session(db, db_session)
+                purged += 1
+    return purged
@@ -0,0 +1,16 @@
+# app/routers/users.py
+from fastapi import APIRouter, Depends
+
+from .. import schemas
+from ..deps import get_current_active_user
+
+router = APIRouter(
+    tags=["Users"],
+)
+
+
+@router.get("/me", response_model=schemas.User)
+async def read_current_user(current_user: schemas.User = Depends(get_current_active_user)):
+    # Данные пользователя из кэша (app/user_cache.py); SELECT - только при промахе.
+    # SPA запрашивает их после входа (pochta_files/src/contexts/AuthContext.tsx)
+    return current_user
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr, Field, field_validator
 from datetime import datetime # Убедимся что есть
-from typing import List, Optional
+from typing import Dict, List, Optional
 import uuid
 import re
 
@@ -91,4 +91,44 @@ class FileInfo(FileBase):
 # Для ответа со списком файлов
 class FileListResponse(BaseModel):
     files: List[FileInfo]
-    total_files: int # Если нужна пагинация или общее количество
\ No newline at end of file
+    total_files: Optional[int] = None # Общее количество; None при count_mode=none (или если число не определено)
+    total_files_is_estimate: bool = False # True, если total_files - оценка планировщика (count_mode=estimate)
+    next_cursor: Optional[str] = None # Передать как cursor, чтобы получить следующую страницу; None - страниц больше нет
+
+# Агрегаты по файлам пользователя
+class FileStats(BaseModel):
+    total_files: int
+    total_bytes: int
+    dedup_saved_bytes: int = 0 # Из total_bytes: по каждому объекту хранилища (живых ссылок - 1) * размер (не занимают места)
+    mime_families: Dict[str, int] # {"image": 12, "application": 3, ...}
+
+# --- Возобновляемые загрузки ---
+class UploadSessionCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    mime_type: Optional[str] = Field(None, max_length=100)
+    upload_length: int = Field(..., ge=0, description="Total size of the original file in bytes")
+
+class UploadSessionInfo(BaseModel):
+    upload_id: uuid.UUID
+    upload_offset: int
+    upload_length: int
+    segment_size: int # Части лучше слать кратными этому размеру: сохраняются только целые сегменты
+    expires_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class MultipartUploadCreate(UploadSessionCreate):
+    part_size: Optional[int] = Field(None, gt=0, description="Size of every part except the last; must be a multiple of the segment size")
+
+class MultipartUploadInfo(UploadSessionInfo):
+    part_size: int
+    part_count: int
+
+class UploadPartInfo(BaseModel):
+    part_number: int
+    size: int
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,236 @@
+# app/search.py
+# Поиск файлов по имени/MIME-типу (параметр search в GET /files).
+#
+# Бэкенды (settings.SEARCH_BACKEND):
+#   "trigram" - ILIKE по колонкам с GIN-индексами pg_trgm (PostgreSQL, индексы создает migrations.py);
+#   "ngram"   - n-граммный индекс в памяти процесса (SQLite в тестах/локально): отбираем file_id
+#               пересечением списков n-грамм, а SQL фильтрует по file_id IN (...);
+#   "ilike"   - ILIKE без индекса (последовательный просмотр файлов пользователя);
+#   "auto"    - trigram на PostgreSQL, ngram на остальных СУБД.
+#
+# Режимы (search_mode): "substring" - подстрока где угодно, "prefix" - начало имени/типа,
+# "tokens" - все слова запроса встречаются в имени или типе (в любом порядке).
+import bisect
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+
+SEARCH_BACKENDS = ("auto", "trigram", "ngram", "ilike")
+SEARCH_MODES = ("substring", "prefix", "tokens")
+NGRAM_MAX_N = 3 # Храним 1-, 2- и 3-граммы: короткие запросы ищутся по своей n-грамме целиком
+
+_TOKEN_SPLIT_RE = re.compile(r"\s+")
+
+
+def resolve_backend(dialect_name: str) -> str:
+    backend = (settings.SEARCH_BACKEND or "auto").lower()
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown SEARCH_BACKEND '{settings.SEARCH_BACKEND}'. Allowed: {', '.join(SEARCH_BACKENDS)}")
+    if backend == "auto":
+        return "trigram" if dialect_name == "postgresql" else "ngram"
+    return backend
+
+
+def split_tokens(search_term: str) -> List[str]:
+    return [token for token in _TOKEN_SPLIT_RE.split(search_term.strip()) if token]
+
+
+def _escape_like(value: str) -> str:
+    # % и _ в запросе пользователя - обычные символы, а не шаблоны LIKE
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _like_clause(pattern: str):
+    return or_(
+        models.File.original_filename.ilike(pattern, escape="\\"),
+        models.File.mime_type.ilike(pattern, escape="\\")
+    )
+
+
+def like_search_clause(search_term: str, search_mode: str):
+    """Условие WHERE для бэкендов ilike/trigram (GIN gin_trgm_ops ускоряет ILIKE '%...%' и 'abc%')."""
+    if search_mode == "prefix":
+        return _like_clause(f"{_escape_like(search_term)}%")
+    if search_mode == "tokens":
+        tokens = split_tokens(search_term) or [search_term]
+        return and_(*[_like_clause(f"%{_escape_like(token)}%") for token in tokens])
+    return _like_clause(f"%{_escape_like(search_term)}%")
+
+
+def _ngrams(text: str, n: int) -> Iterable[str]:
+    return (text[i:i + n] for i in range(len(text) - n + 1))
+
+
+class _UserIndex:
+    """N-граммы имен и MIME-типов файлов одного пользователя."""
+
+    def __init__(self):
+        self.documents: Dict[int, tuple] = {} # file_id -> (имя в нижнем регистре, тип в нижнем регистре)
+        self.postings: Dict[str, Set[int]] = {} # n-грамма -> file_id
+        self.sorted_keys: List[tuple] = [] # (строка, file_id) по возрастанию - для префиксного поиска
+
+    def add(self, file_id: int, original_filename: str, mime_type: str):
+        if file_id in self.documents:
+            return
+        document = ((original_filename or "").lower(), (mime_type or "").lower())
+        self.documents[file_id] = document
+        for text in document:
+            for n in range(1, NGRAM_MAX_N + 1):
+                for gram in _ngrams(text, n):
+                    self.postings.setdefault(gram, set()).add(file_id)
+            bisect.insort(self.sorted_keys, (text, file_id))
+
+    def remove(self, file_id: int):
+        document = self.documents.pop(file_id, None)
+        if document is None:
+            return
+        for text in document:
+            for n in range(1, NGRAM_MAX_N + 1):
+                for gram in _ngrams(text, n):
+                    file_ids = self.postings.get(gram)
+                    if file_ids is not None:
+                        file_ids.discard(file_id)
+                        if not file_ids:
+                            del self.postings[gram]
+            position = bisect.bisect_left(self.sorted_keys, (text, file_id))
+            if position < len(self.sorted_keys) and self.sorted_keys[position] == (text, file_id):
+                del self.sorted_keys[position]
+
+    def _substring(self, term: str) -> Set[int]:
+        n = min(len(term), NGRAM_MAX_N)
+        grams = sorted(set(_ngrams(term, n)), key=lambda gram: len(self.postings.get(gram, ())))
+        if not grams:
+            return set(self.documents)
+        candidates = set(self.postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates &= self.postings.get(gram, set())
+        if len(term) <= NGRAM_MAX_N:
+            return candidates # n-грамма совпадает с самим запросом, проверка не нужна
+        # Все n-граммы на месте еще не значит, что они идут подряд - проверяем кандидатов
+        return {file_id for file_id in candidates if any(term in text for text in self.documents[file_id])}
+
+    def _prefix(self, term: str) -> Set[int]:
+        found = set()
+        position = bisect.bisect_left(self.sorted_keys, (term,))
+        while position < len(self.sorted_keys) and self.sorted_keys[position][0].startswith(term):
+            found.add(self.sorted_keys[position][1])
+            position += 1
+        return found
+
+    def search(self, search_term: str, search_mode: str) -> Set[int]:
+        term = search_term.lower()
+        if search_mode == "prefix":
+            return self._prefix(term)
+        if search_mode == "tokens":
+            found = None
+            for token in sorted(split_tokens(term) or [term], key=len, reverse=True): # Длинные токены селективнее
+                found = self._substring(token) if found is None else found & self._substring(token)
+                if not found:
+                    break
+            return found or set()
+        return self._substring(term)
+
+
+class NgramIndex:
+    """Индекс в памяти процесса. Пользователь загружается из БД при первом поиске, дальше
+    поддерживается вызовами file_added/file_removed из crud. Годится для одного процесса
+    (SQLite-окружения); при нескольких воркерах используйте trigram на PostgreSQL.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users: "OrderedDict[int, _UserIndex]" = OrderedDict()
+        # Изменения, пришедшие, пока пользователь загружается из БД: (добавить?, file_id, имя, тип)
+        self._pending: Dict[int, list] = {}
+        self._lock = threading.Lock()
+
+    async def _load_user(self, db: AsyncSession, user_id: int) -> _UserIndex:
+        with self._lock:
+            user_index = self._users.get(user_id)
+            if user_index is not None:
+                self._users.move_to_end(user_id)
+                return user_index
+            pending = self._pending.setdefault(user_id, [])
+
+        # Запрос к БД идет без блокировки; изменения, закоммиченные во время запроса, копятся в pending
+        rows = await db.execute(
+            select(models.File.file_id, models.File.original_filename, models.File.mime_type)
+            .filter(models.File.user_id == user_id, models.File.deleted_at == None)
+        )
+        user_index = _UserIndex()
+        for file_id, original_filename, mime_type in rows:
+            user_index.add(file_id, original_filename, mime_type)
+
+        with self._lock:
+            if user_id in self._users: # Параллельный поиск загрузил пользователя раньше
+                return self._users[user_id]
+            # add/remove идемпотентны, поэтому повтор уже попавших в выборку изменений безопасен
+            for is_added, file_id, original_filename, mime_type in self._pending.pop(user_id, pending):
+                if is_added:
+                    user_index.add(file_id, original_filename, mime_type)
+                else:
+                    user_index.remove(file_id)
+            self._users[user_id] = user_index
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return user_index
+
+    async def search(self, db: AsyncSession, user_id: int, search_term: str, search_mode: str) -> Set[int]:
+        user_index = await self._load_user(db, user_id)
+        with self._lock:
+            return user_index.search(search_term, search_mode)
+
+    def _record(self, db_file: models.File, is_added: bool):
+        with self._lock:
+            user_index = self._users.get(db_file.user_id)
+            if user_index is not None:
+                if is_added:
+                    user_index.add(db_file.file_id, db_file.original_filename, db_file.mime_type)
+                else:
+                    user_index.remove(db_file.file_id)
+            elif db_file.user_id in self._pending:
+                self._pending[db_file.user_id].append((is_added, db_file.file_id, db_file.original_filename, db_file.mime_type))
+            # Незагруженного пользователя прочитаем из БД при первом поиске
+
+    def file_added(self, db_file: models.File):
+        self._record(db_file, is_added=True)
+
+    def file_removed(self, db_file: models.File):
+        self._record(db_file, is_added=False)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+ngram_index = NgramIndex(max_users=settings.SEARCH_NGRAM_MAX_USERS)
+
+
+async def apply_search(query, db: AsyncSession, user_id: int, search_term: str, search_mode: Optional[str] = None):
+    """Добавляет к запросу по models.File условие поиска выбранным бэкендом."""
+    search_mode = search_mode or "substring"
+    if search_mode not in SEARCH_MODES:
+        raise ValueError(f"Invalid search_mode. Allowed: {', '.join(SEARCH_MODES)}")
+    if resolve_backend(db.get_bind().dialect.name) == "ngram":
+        file_ids = await ngram_index.search(db, user_id, search_term, search_mode)
+        return query.filter(models.File.file_id.in_(file_ids))
+    return query.filter(like_search_clause(search_term, search_mode))
+
+
+def file_added(db: AsyncSession, db_file: models.File):
+    if resolve_backend(db.get_bind().dialect.name) == "ngram":
+        ngram_index.file_added(db_file)
+
+
+def file_removed(db: AsyncSession, db_file: models.File):
+    if resolve_backend(db.get_bind().dialect.name) == "ngram":
+        ngram_index.file_removed(db_file)
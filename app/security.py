@@ -5,6 +5,8 @@ from passlib.context import CryptContext
 from .config import settings
 from . import schemas
 import secrets # Для генерации случайных токенов
+import hashlib
+import hmac
 from .config import settings
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -23,6 +25,28 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
+# Ключ HMAC-индекса резервных кодов (UserBackupCode.code_lookup). Выводится из SECRET_KEY:
+# без него по дампу БД нельзя перебрать коды через HMAC, остается только bcrypt.
+_BACKUP_CODE_LOOKUP_KEY = hmac.new(SECRET_KEY.encode(), b"backup-code-lookup-v1", hashlib.sha256).digest()
+
+def normalize_backup_code(code: str) -> str:
+    """Код без пробелов и дефисов, в верхнем регистре (так его и хешируем)."""
+    return "".join(code.split()).replace("-", "").upper()
+
+def backup_code_lookup(user_id: int, code: str) -> str:
+    """HMAC-SHA256 кода для индексного поиска строки: одна строка вместо перебора bcrypt по всем кодам."""
+    message = f"{user_id}:{normalize_backup_code(code)}".encode()
+    return hmac.new(_BACKUP_CODE_LOOKUP_KEY, message, hashlib.sha256).hexdigest()
+
+# Ключ хешей содержимого для дедупликации загрузок (File.content_hash). Хеш ключевой и свой у каждого пользователя:
+# по дампу БД нельзя проверить, есть ли у кого-то известный файл, и сопоставить файлы разных пользователей.
+_CONTENT_HASH_KEY = hmac.new(SECRET_KEY.encode(), b"file-content-dedup-v1", hashlib.sha256).digest()
+
+def content_hasher(user_id: int) -> "hmac.HMAC":
+    """HMAC-SHA256 для содержимого файла пользователя: update() по мере чтения, hexdigest() в конце."""
+    user_key = hmac.new(_CONTENT_HASH_KEY, str(user_id).encode(), hashlib.sha256).digest()
+    return hmac.new(user_key, digestmod=hashlib.sha256)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
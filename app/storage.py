@@ -0,0 +1,417 @@
+# app/storage.py
+# Где физически лежат зашифрованные файлы (STORAGE_BACKEND):
+#   "local" - каталог FILES_STORAGE_PATH, как раньше (раскладка внутри - app/storage_layout.py)
+#   "s3"    - S3-совместимое объектное хранилище (AWS S3, MinIO; локально для проверки - moto server)
+# Ключ объекта - тот же относительный путь, что хранится в File.storage_path ("ab/cd/<uuid>.enc").
+#
+# Загрузки по-прежнему шифруются во временный файл в FILES_STORAGE_PATH (у возобновляемых и multipart-загрузок
+# это состояние между запросами), а готовый файл передается бэкенду через put_file: локально это os.replace,
+# в S3 - multipart upload, части которого отправляются параллельно (STORAGE_S3_MULTIPART_CONCURRENCY).
+# Чтение - open_read: seekable файлоподобный объект (в S3 - потоковый GET с Range), поэтому дешифрование
+# и Range-запросы работают с любым бэкендом без изменений.
+# Методы блокирующие и вызываются из threadpool, как и остальной файловый I/O; клиент S3 потокобезопасен
+# и держит пул соединений на STORAGE_S3_MAX_CONNECTIONS.
+import io
+import logging
+import os
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from datetime import timezone
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from . import storage_layout
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+READ_BUFFER_SIZE = 1024 * 1024 # Как encryption.PIPELINE_BUFFER_SIZE
+
+
+class StoredBlob:
+    """Объект хранилища при сканировании (app/blob_gc.py). Размер и время изменения - через stat()."""
+
+    __slots__ = ("key", "name", "_entry", "_size", "_mtime")
+
+    def __init__(self, key: str, name: str, entry: Optional[os.DirEntry] = None, size: int = 0, mtime: float = 0.0):
+        self.key = key
+        self.name = name
+        self._entry = entry
+        self._size = size
+        self._mtime = mtime
+
+    def stat(self) -> Tuple[int, float]:
+        # Локально stat() делается только при вызове: сборщику нужен он лишь для кандидатов в сироты
+        if self._entry is not None:
+            result = self._entry.stat(follow_symlinks=False)
+            return result.st_size, result.st_mtime
+        return self._size, self._mtime
+
+
+class StorageStats:
+    FIELDS = ("opens", "missing", "puts", "put_bytes", "deletes", "errors")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(self.FIELDS, 0)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+class StorageBackend(ABC):
+    """Хранилище зашифрованных файлов. FileNotFoundError - если объекта нет."""
+
+    name = ""
+
+    def __init__(self):
+        self.storage_stats = StorageStats()
+
+    @abstractmethod
+    def open_read(self, key: str) -> BinaryIO:
+        ...
+
+    def iter_range(self, key: str, start: int, end: int, chunk_size: int = READ_BUFFER_SIZE) -> Iterator[bytes]:
+        """Байты [start, end] включительно, кусками не больше chunk_size."""
+        with self.open_read(key) as stream:
+            stream.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    @abstractmethod
+    def put_file(self, source_path: str, key: str):
+        """Переносит готовый локальный файл в хранилище под ключом key; source_path после этого не существует."""
+
+    @abstractmethod
+    def put_stream(self, stream: BinaryIO, key: str):
+        ...
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        """Удаляет объект. False, если его не было."""
+
+    @abstractmethod
+    def iter_blobs(self) -> Iterator[StoredBlob]:
+        ...
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.name, **self.storage_stats.snapshot()}
+
+
+class LocalStorageBackend(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str = storage_layout.FILES_STORAGE_PATH):
+        super().__init__()
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        # Старые строки хранят абсолютный путь - он используется как есть
+        if os.path.isabs(key):
+            return key
+        return os.path.join(self.root, *key.split("/"))
+
+    def open_read(self, key: str) -> BinaryIO:
+        try:
+            stream = open(self._path(key), "rb", buffering=READ_BUFFER_SIZE)
+        except FileNotFoundError:
+            self.storage_stats.count("missing")
+            raise
+        self.storage_stats.count("opens")
+        return stream
+
+    def put_file(self, source_path: str, key: str):
+        size = os.path.getsize(source_path)
+        target = self._path(key)
+        storage_layout.ensure_parent_directory(target)
+        os.replace(source_path, target)
+        self.storage_stats.count("puts")
+        self.storage_stats.count("put_bytes", size)
+
+    def put_stream(self, stream: BinaryIO, key: str):
+        target = storage_layout.ensure_parent_directory(self._path(key))
+        temp_target = storage_layout.temp_copy_path(target)
+        try:
+            with open(temp_target, "wb") as output:
+                size = 0
+                while chunk := stream.read(READ_BUFFER_SIZE):
+                    output.write(chunk)
+                    size += len(chunk)
+                output.flush()
+                os.fsync(output.fileno())
+            os.replace(temp_target, target)
+        finally:
+            if os.path.exists(temp_target):
+                os.remove(temp_target)
+        self.storage_stats.count("puts")
+        self.storage_stats.count("put_bytes", size)
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self._path(key))
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            return False
+        self.storage_stats.count("deletes")
+        return True
+
+    def iter_blobs(self) -> Iterator[StoredBlob]:
+        prefix_length = len(self.root) + 1
+        for entry in storage_layout.iter_storage_entries(self.root):
+            yield StoredBlob(entry.path[prefix_length:].replace(os.sep, "/"), entry.name, entry=entry)
+
+
+class _S3ObjectReader(io.RawIOBase):
+    """Seekable чтение объекта S3: один потоковый GET с Range от текущей позиции до конца объекта.
+
+    Последовательное чтение идет из одного ответа; seek в другое место открывает новый GET с нужного смещения.
+    """
+
+    def __init__(self, client, bucket: str, key: str, size: int):
+        super().__init__()
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._size = size
+        self._position = 0
+        self._body = None
+        self._body_position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._position = offset
+        return offset
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def readinto(self, buffer) -> int:
+        if self._position >= self._size or not len(buffer):
+            return 0
+        if self._body is None or self._body_position != self._position:
+            self._close_body()
+            response = self._client.get_object(Bucket=self._bucket, Key=self._key, Range=f"bytes={self._position}-")
+            self._body = response["Body"]
+            self._body_position = self._position
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self._body_position += len(data)
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class S3StorageBackend(StorageBackend):
+    name = "s3"
+
+    def __init__(self):
+        super().__init__()
+        # boto3 нужен только для STORAGE_BACKEND=s3
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        if not settings.STORAGE_S3_BUCKET:
+            raise ValueError("STORAGE_BACKEND=s3 requires STORAGE_S3_BUCKET")
+        self.bucket = settings.STORAGE_S3_BUCKET
+        self.prefix = settings.STORAGE_S3_PREFIX.strip("/") + "/" if settings.STORAGE_S3_PREFIX.strip("/") else ""
+        session = boto3.session.Session(
+            aws_access_key_id=settings.STORAGE_S3_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.STORAGE_S3_SECRET_ACCESS_KEY,
+            region_name=settings.STORAGE_S3_REGION,
+        )
+        self.client = session.client(
+            "s3",
+            endpoint_url=settings.STORAGE_S3_ENDPOINT_URL, # MinIO / moto server
+            config=Config(
+                max_pool_connections=settings.STORAGE_S3_MAX_CONNECTIONS,
+                retries={"max_attempts": 5, "mode": "standard"},
+                s3={"addressing_style": "path"} if settings.STORAGE_S3_ENDPOINT_URL else None,
+            ),
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.STORAGE_S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.STORAGE_S3_MULTIPART_CHUNK_SIZE,
+            max_concurrency=settings.STORAGE_S3_MULTIPART_CONCURRENCY,
+        )
+
+    def _object_key(self, key: str) -> str:
+        if os.path.isabs(key):
+            # Абсолютный путь старой строки в локальном хранилище - в S3 такого объекта нет
+            raise FileNotFoundError(key)
+        return self.prefix + key
+
+    def _is_missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def size(self, key: str) -> int:
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))["ContentLength"]
+        except ClientError as e:
+            if self._is_missing(e):
+                raise FileNotFoundError(key) from e
+            self.storage_stats.count("errors")
+            raise
+
+    def open_read(self, key: str) -> BinaryIO:
+        try:
+            size = self.size(key)
+        except FileNotFoundError:
+            self.storage_stats.count("missing")
+            raise
+        self.storage_stats.count("opens")
+        # BufferedReader дочитывает read(n) до n байт и не ходит в сеть при seek внутри буфера
+        return io.BufferedReader(_S3ObjectReader(self.client, self.bucket, self._object_key(key), size), buffer_size=READ_BUFFER_SIZE)
+
+    def iter_range(self, key: str, start: int, end: int, chunk_size: int = READ_BUFFER_SIZE) -> Iterator[bytes]:
+        # Один GET ровно на нужный диапазон
+        response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key), Range=f"bytes={start}-{end}")
+        body = response["Body"]
+        try:
+            while chunk := body.read(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def put_file(self, source_path: str, key: str):
+        size = os.path.getsize(source_path)
+        try:
+            # Больше STORAGE_S3_MULTIPART_THRESHOLD - multipart upload, части отправляются параллельно
+            self.client.upload_file(source_path, self.bucket, self._object_key(key), Config=self.transfer_config)
+        except Exception:
+            self.storage_stats.count("errors")
+            raise
+        os.remove(source_path)
+        self.storage_stats.count("puts")
+        self.storage_stats.count("put_bytes", size)
+
+    def put_stream(self, stream: BinaryIO, key: str):
+        counting = _CountingReader(stream)
+        try:
+            self.client.upload_fileobj(counting, self.bucket, self._object_key(key), Config=self.transfer_config)
+        except Exception:
+            self.storage_stats.count("errors")
+            raise
+        self.storage_stats.count("puts")
+        self.storage_stats.count("put_bytes", counting.count)
+
+    def delete(self, key: str) -> bool:
+        # DELETE в S3 идемпотентен и не сообщает, был ли объект: сначала HEAD,
+        # иначе delete_file_blob не перейдет к другим путям файла
+        try:
+            self.size(key)
+        except FileNotFoundError:
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        self.storage_stats.count("deletes")
+        return True
+
+    def iter_blobs(self) -> Iterator[StoredBlob]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                key = item["Key"][len(self.prefix):]
+                modified = item["LastModified"]
+                if modified.tzinfo is None:
+                    modified = modified.replace(tzinfo=timezone.utc)
+                yield StoredBlob(key, key.rsplit("/", 1)[-1], size=item["Size"], mtime=modified.timestamp())
+
+    def close(self):
+        self.client.close()
+
+
+class _CountingReader:
+    def __init__(self, stream: BinaryIO):
+        self._stream = stream
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+
+def _build_backend() -> StorageBackend:
+    if settings.STORAGE_BACKEND == "local":
+        return LocalStorageBackend()
+    if settings.STORAGE_BACKEND == "s3":
+        return S3StorageBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {settings.STORAGE_BACKEND!r} (expected 'local' or 's3')")
+
+
+backend = _build_backend()
+# Временные файлы загрузок всегда локальные; при STORAGE_BACKEND=local это то же хранилище
+staging = backend if isinstance(backend, LocalStorageBackend) else LocalStorageBackend()
+
+
+def _blob_keys(storage_path: str, stored_uuid: Optional[uuid.UUID]) -> List[str]:
+    # Путь из БД, затем пути по текущей и плоской раскладке: файл могли перенести (storage_layout migrate)
+    keys = [storage_path]
+    if stored_uuid is not None:
+        for candidate_layout in (storage_layout.layout, storage_layout.FlatLayout()):
+            key = candidate_layout.blob_path(stored_uuid)
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+def open_file_blob(storage_path: str, stored_uuid: Optional[uuid.UUID]) -> BinaryIO:
+    """Открывает зашифрованный файл File на чтение. FileNotFoundError, если его нет ни по одному пути."""
+    keys = _blob_keys(storage_path, stored_uuid)
+    for key in keys[:-1]:
+        try:
+            return backend.open_read(key)
+        except FileNotFoundError:
+            continue
+    return backend.open_read(keys[-1])
+
+
+def delete_file_blob(storage_path: str, stored_uuid: Optional[uuid.UUID]) -> bool:
+    for key in _blob_keys(storage_path, stored_uuid):
+        if backend.delete(key):
+            return True
+    return False
+
+
+def scan_targets() -> List[StorageBackend]:
+    """Что обходит сборщик сирот: хранилище и, если оно не локальное, локальные временные файлы загрузок."""
+    return [backend] if staging is backend else [backend, staging]
@@ -0,0 +1,283 @@
+# app/storage_layout.py
+# Раскладка зашифрованных файлов внутри FILES_STORAGE_PATH.
+# Раньше все <uuid>.enc лежали в одном каталоге: на миллионах файлов поиск по каталогу, листинг и бэкапы
+# на ext4/xfs становятся медленными. Теперь путь выбирает раскладка (STORAGE_LAYOUT):
+#   "sharded" - ab/cd/<uuid>.enc (первые STORAGE_SHARD_LEVELS * STORAGE_SHARD_WIDTH hex-символов uuid)
+#   "flat"    - <uuid>.enc, как раньше
+# В File.storage_path и UploadSession.temp_path хранится путь относительно FILES_STORAGE_PATH (через "/"),
+# так что каталог хранилища можно перенести, не меняя БД. Старые строки с абсолютными путями продолжают работать.
+#
+# Перенос существующих файлов в текущую раскладку без остановки сервиса:
+#   python -m app.storage_layout migrate [--dry-run] [--batch-size N] [--pause SECONDS]
+# Файл сначала появляется по новому пути (жесткая ссылка, либо копия на другой ФС), затем обновляется строка,
+# и только после коммита удаляется старый путь. Запрос, успевший прочитать старый путь, находит файл
+# через locate_blob (пробует путь из БД, путь текущей раскладки и плоский путь).
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional
+
+from sqlalchemy import bindparam, select, update
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+FILES_STORAGE_PATH = os.path.abspath(settings.FILES_STORAGE_PATH)
+os.makedirs(FILES_STORAGE_PATH, exist_ok=True)
+
+
+class StorageLayout(ABC):
+    """Соответствие stored_filename_uuid -> относительный путь в хранилище."""
+
+    name = ""
+
+    @abstractmethod
+    def directory(self, stored_uuid: uuid.UUID) -> str:
+        ...
+
+    def _join(self, stored_uuid: uuid.UUID, filename: str) -> str:
+        directory = self.directory(stored_uuid)
+        return f"{directory}/{filename}" if directory else filename
+
+    def blob_path(self, stored_uuid: uuid.UUID) -> str:
+        return self._join(stored_uuid, f"{stored_uuid}.enc")
+
+    def temp_path(self, stored_uuid: uuid.UUID) -> str:
+        # Временный файл - в том же каталоге, что и итоговый: os.replace в пределах каталога атомарен
+        return self._join(stored_uuid, f".{stored_uuid}.enc.part")
+
+
+class FlatLayout(StorageLayout):
+    name = "flat"
+
+    def directory(self, stored_uuid: uuid.UUID) -> str:
+        return ""
+
+
+class ShardedLayout(StorageLayout):
+    name = "sharded"
+
+    def __init__(self, levels: int = 2, width: int = 2):
+        if levels < 1 or width < 1 or levels * width > 32:
+            raise ValueError("STORAGE_SHARD_LEVELS * STORAGE_SHARD_WIDTH must be between 1 and 32")
+        self.levels = levels
+        self.width = width
+
+    def directory(self, stored_uuid: uuid.UUID) -> str:
+        digits = stored_uuid.hex
+        return "/".join(digits[level * self.width:(level + 1) * self.width] for level in range(self.levels))
+
+
+def _build_layout() -> StorageLayout:
+    if settings.STORAGE_LAYOUT == "flat":
+        return FlatLayout()
+    if settings.STORAGE_LAYOUT == "sharded":
+        return ShardedLayout(settings.STORAGE_SHARD_LEVELS, settings.STORAGE_SHARD_WIDTH)
+    raise ValueError(f"Unknown STORAGE_LAYOUT: {settings.STORAGE_LAYOUT!r} (expected 'sharded' or 'flat')")
+
+
+layout = _build_layout()
+_flat_layout = FlatLayout()
+
+_created_directories: set = set()
+_created_directories_lock = threading.Lock()
+
+
+def absolute_path(stored_path: str) -> str:
+    """Путь на диске для значения storage_path/temp_path (относительного или старого абсолютного)."""
+    if os.path.isabs(stored_path):
+        return stored_path
+    return os.path.join(FILES_STORAGE_PATH, *stored_path.split("/"))
+
+
+def ensure_parent_directory(stored_path: str) -> str:
+    """Создает каталог шарда при первой записи в него. Возвращает путь на диске."""
+    path_on_disk = absolute_path(stored_path)
+    directory = os.path.dirname(path_on_disk)
+    if directory not in _created_directories:
+        os.makedirs(directory, exist_ok=True)
+        with _created_directories_lock:
+            _created_directories.add(directory)
+    return path_on_disk
+
+
+def temp_copy_path(path_on_disk: str) -> str:
+    """Временное имя для записи файла целиком рядом с path_on_disk: .<имя>.part.<hex>.tmp.
+
+    Для <uuid>.enc это имя временного файла загрузки (blob_gc.TEMP_NAME_RE): остаток прерванной записи
+    сборщик удалит как временный файл без сессии.
+    """
+    directory, name = os.path.split(path_on_disk)
+    return os.path.join(directory, f".{name}.part.{uuid.uuid4().hex}.tmp")
+
+
+def locate_blob(stored_path: str, stored_uuid: Optional[uuid.UUID]) -> str:
+    """Путь на диске к файлу File: путь из БД, а если его нет (файл перенесли) - путь по раскладке.
+
+    Если файл не найден нигде, возвращается путь из БД (вызывающий сообщит об отсутствии файла).
+    """
+    recorded = absolute_path(stored_path)
+    if stored_uuid is None or os.path.exists(recorded):
+        return recorded
+    for candidate_layout in (layout, _flat_layout):
+        candidate = absolute_path(candidate_layout.blob_path(stored_uuid))
+        if candidate != recorded and os.path.exists(candidate):
+            return candidate
+    return recorded
+
+
+def iter_storage_entries(root: str = FILES_STORAGE_PATH) -> Iterator[os.DirEntry]:
+    """Все файлы хранилища, включая каталоги шардов. Потоково: в памяти только открытые каталоги текущей ветки."""
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as iterator:
+            for entry in iterator:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        pending.append(entry.path)
+                else:
+                    yield entry
+
+
+class MigrationStats:
+    def __init__(self):
+        self.checked = 0
+        self.moved = 0
+        self.relativized = 0 # Файл уже на месте, в БД был абсолютный путь
+        self.missing = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def _link_or_copy(source: str, target: str):
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        # Остаток прерванного запуска: если размер совпадает, считаем файл уже перенесенным
+        if os.path.getsize(source) != os.path.getsize(target):
+            raise
+    except OSError:
+        # Другая ФС или нет жестких ссылок: копируем под временным именем и атомарно переименовываем
+        temp_target = temp_copy_path(target)
+        try:
+            shutil.copyfile(source, temp_target)
+            with open(temp_target, "rb") as copied_file:
+                os.fsync(copied_file.fileno())
+            os.replace(temp_target, target)
+        finally:
+            if os.path.exists(temp_target):
+                os.remove(temp_target)
+
+
+def _place_blobs(rows, stats: MigrationStats, dry_run: bool) -> List[dict]:
+    """Кладет файлы пачки по путям текущей раскладки. Возвращает изменения для UPDATE."""
+    changes = []
+    for row in rows:
+        stats.checked += 1
+        blob_uuid = row.blob_uuid or row.stored_filename_uuid # Дубликат (app/dedup.py) указывает на объект исходного файла
+        target = layout.blob_path(blob_uuid)
+        if row.storage_path == target:
+            continue
+        source_on_disk = locate_blob(row.storage_path, blob_uuid)
+        target_on_disk = absolute_path(target)
+        if not os.path.exists(source_on_disk):
+            stats.missing += 1
+            logger.warning(f"Файл {row.storage_path} (file_id {row.file_id}) не найден, строка не изменена")
+            continue
+        if os.path.abspath(source_on_disk) == os.path.abspath(target_on_disk):
+            stats.relativized += 1
+            changes.append({"b_file_id": row.file_id, "b_old_path": row.storage_path, "b_new_path": target, "source": None})
+            continue
+        try:
+            if not dry_run:
+                ensure_parent_directory(target)
+                _link_or_copy(source_on_disk, target_on_disk)
+        except OSError as e:
+            stats.errors += 1
+            logger.error(f"Не удалось перенести {source_on_disk} -> {target_on_disk}: {e}")
+            continue
+        stats.moved += 1
+        changes.append({"b_file_id": row.file_id, "b_old_path": row.storage_path, "b_new_path": target, "source": source_on_disk})
+    return changes
+
+
+def _remove_sources(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Не удалось удалить старый путь {path}: {e}")
+
+
+async def migrate_files(batch_size: int = 500, dry_run: bool = False, pause_seconds: float = 0.0) -> MigrationStats:
+    """Переносит файлы всех строк files в текущую раскладку и записывает относительные пути."""
+    if settings.STORAGE_BACKEND != "local":
+        raise ValueError("Layout migration works on the local storage only (STORAGE_BACKEND=local)")
+    from starlette.concurrency import run_in_threadpool
+    from . import models
+    from .database import AsyncSessionLocal
+
+    stats = MigrationStats()
+    file_table = models.File.__table__
+    # Условие на старый путь: строку, которую за время пачки изменил кто-то еще, не трогаем
+    update_path = (
+        update(file_table)
+        .where(file_table.c.file_id == bindparam("b_file_id"), file_table.c.storage_path == bindparam("b_old_path"))
+        .values(storage_path=bindparam("b_new_path"))
+    )
+    last_file_id = 0
+    async with AsyncSessionLocal() as db:
+        while True:
+            rows = (await db.execute(
+                select(models.File.file_id, models.File.storage_path, models.File.stored_filename_uuid, models.File.blob_uuid)
+                .where(models.File.file_id > last_file_id).order_by(models.File.file_id).limit(batch_size)
+            )).all()
+            await db.rollback()
+            if not rows:
+                break
+            last_file_id = rows[-1].file_id
+            changes = await run_in_threadpool(_place_blobs, rows, stats, dry_run)
+            if changes and not dry_run:
+                await db.execute(update_path, [{key: value for key, value in change.items() if key != "source"} for change in changes])
+                await db.commit()
+                # Старый путь удаляем только после коммита: до него читатели идут по старому пути
+                await run_in_threadpool(_remove_sources, [change["source"] for change in changes if change["source"]])
+            if pause_seconds:
+                await asyncio.sleep(pause_seconds)
+    return stats
+
+
+async def _run_cli(batch_size: int, dry_run: bool, pause_seconds: float):
+    from .database import async_engine
+    started = time.perf_counter()
+    try:
+        stats = await migrate_files(batch_size=batch_size, dry_run=dry_run, pause_seconds=pause_seconds)
+        print(f"Раскладка {layout.name}{' (dry-run)' if dry_run else ''}: {stats.as_dict()}, {time.perf_counter() - started:.1f} с")
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    import argparse
+    from .logging_config import configure_logging, stop_logging
+    parser = argparse.ArgumentParser(prog="python -m app.storage_layout")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches (disk load)")
+    arguments = parser.parse_args()
+    configure_logging()
+    try:
+        asyncio.run(_run_cli(arguments.batch_size, arguments.dry_run, arguments.pause))
+    finally:
+        stop_logging()
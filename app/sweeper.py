@@ -0,0 +1,158 @@
+# app/sweeper.py
+# Фоновое удаление просроченных записей: одноразовые 2FA-коды и коды регистрации, refresh-токены,
+# неотправленные письма с истекшими кодами, брошенные возобновляемые загрузки.
+# Раньше коды и токены удалялись DELETE на всю таблицу в каждом запросе логина/обновления токена;
+# теперь запросы только фильтруют по expires_at, а удаляет этот модуль - пачками по SWEEPER_BATCH_SIZE строк, каждая пачка в своей короткой транзакции.
+#
+# Запускается в lifespan приложения (SWEEPER_ENABLED) или отдельно, например из cron:
+#   python -m app.sweeper          - один проход
+#   python -m app.sweeper --loop   - бесконечный цикл с интервалом SWEEPER_INTERVAL_SECONDS
+# Несколько воркеров могут чистить одновременно: повторное удаление тех же строк безопасно.
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .config import settings
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Модели с колонкой expires_at, просроченные строки которых просто удаляются (индексы - в models.py)
+EXPIRING_MODELS = [models.TwoFactorTempCode, models.RefreshToken, models.MailOutbox]
+
+
+class SweeperStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.failures = 0
+        self.deleted_total: dict = {}
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds: Optional[float] = None
+        self.last_deleted: dict = {}
+
+    def record(self, deleted: dict, seconds: float):
+        with self._lock:
+            self.runs += 1
+            self.last_run_at = datetime.now(timezone.utc)
+            self.last_run_seconds = round(seconds, 3)
+            self.last_deleted = deleted
+            for name, count in deleted.items():
+                self.deleted_total[name] = self.deleted_total.get(name, 0) + count
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.SWEEPER_ENABLED,
+                "interval_seconds": settings.SWEEPER_INTERVAL_SECONDS,
+                "batch_size": settings.SWEEPER_BATCH_SIZE,
+                "runs": self.runs,
+                "failures": self.failures,
+                "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+                "last_run_seconds": self.last_run_seconds,
+                "last_deleted": dict(self.last_deleted),
+                "deleted_total": dict(self.deleted_total),
+            }
+
+
+sweeper_stats = SweeperStats()
+
+
+async def delete_expired_batch(db: AsyncSession, model, now: datetime, batch_size: int) -> int:
+    """Удаляет не больше batch_size просроченных строк модели. Возвращает число удаленных."""
+    primary_key = model.__mapper__.primary_key[0]
+    # Сначала id по индексу expires_at, потом DELETE по ним: DELETE ... LIMIT нет в PostgreSQL
+    expired_ids = (await db.scalars(
+        select(primary_key).where(model.expires_at < now).order_by(model.expires_at).limit(batch_size)
+    )).all()
+    if not expired_ids:
+        return 0
+    result = await db.execute(
+        delete(model)
+        .where(primary_key.in_(expired_ids), model.expires_at < now) # Строку могли продлить между SELECT и DELETE
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def sweep_expired_rows(batch_size: Optional[int] = None) -> dict:
+    """Удаляет просроченные строки всех EXPIRING_MODELS пачками. Возвращает {таблица: удалено}."""
+    batch_size = batch_size or settings.SWEEPER_BATCH_SIZE
+    now = datetime.now(timezone.utc)
+    deleted = {}
+    async with AsyncSessionLocal() as db:
+        for model in EXPIRING_MODELS:
+            total = 0
+            while True:
+                count = await delete_expired_batch(db, model, now, batch_size)
+                total += count
+                if count < batch_size:
+                    break
+                await asyncio.sleep(0) # Между пачками отдаем event loop запросам
+            deleted[model.__tablename__] = total
+    return deleted
+
+
+async def sweep_once() -> dict:
+    """Один проход: просроченные коды/токены и брошенные загрузки (вместе с их файлами)."""
+    from .routers.uploads import purge_expired_upload_sessions # Роутер импортирует модели и шифрование - не при импорте модуля
+
+    started = time.perf_counter()
+    deleted = await sweep_expired_rows()
+    deleted[models.UploadSession.__tablename__] = await purge_expired_upload_sessions(batch_size=settings.SWEEPER_BATCH_SIZE)
+    sweeper_stats.record(deleted, time.perf_counter() - started)
+    return deleted
+
+
+async def sweeper_loop():
+    while True:
+        try:
+            deleted = await sweep_once()
+            if any(deleted.values()):
+                logger.info(f"Удалены просроченные записи: {deleted}")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            sweeper_stats.record_failure()
+            logger.error("Ошибка при удалении просроченных записей", exc_info=True)
+        await asyncio.sleep(settings.SWEEPER_INTERVAL_SECONDS)
+
+
+async def _run_cli(loop_forever: bool):
+    from .database import async_engine
+    try:
+        if loop_forever:
+            await sweeper_loop()
+        else:
+            deleted = await sweep_once()
+            print(f"Удалено: {deleted}")
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    # python -m app.sweeper [--loop]
+    import sys
+    from .logging_config import configure_logging, stop_logging
+    if sys.argv[1:] not in ([], ["--loop"]):
+        print("Usage: python -m app.sweeper [--loop]")
+        sys.exit(2)
+    configure_logging()
+    try:
+        asyncio.run(_run_cli(loop_forever=sys.argv[1:] == ["--loop"]))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_logging()
@@ -0,0 +1,36 @@
+# app/user_cache.py
+# Кэш пользователей для аутентификации в памяти процесса.
+# Каждый аутентифицированный запрос (в том числе каждый Range-запрос куска файла из SPA)
+# раньше делал SELECT пользователя по user_id из JWT. Кэш хранит снимок строки (schemas.User)
+# с коротким TTL; изменения/удаление пользователя через ORM сбрасывают запись сразу.
+from sqlalchemy import event
+
+from . import models, schemas
+from .config import settings
+from .ttl_cache import TTLCache
+
+
+class UserCache(TTLCache):
+    """LRU-кэш снимков пользователей (по user_id) с ограничением по числу записей и TTL.
+
+    Инвалидация через ORM-события действует только в текущем процессе: в остальных воркерах
+    запись доживает до истечения TTL, поэтому TTL должен быть коротким.
+    invalidate(user_id) - при изменении или удалении пользователя.
+    """
+
+    def put(self, user: models.User) -> schemas.User:
+        # Храним отвязанный от сессии снимок: ORM-объект нельзя разделять между запросами
+        snapshot = schemas.User.model_validate(user)
+        super().put(snapshot.user_id, snapshot)
+        return snapshot
+
+
+user_cache = UserCache(settings.AUTH_USER_CACHE_MAX_ENTRIES, settings.AUTH_USER_CACHE_TTL_SECONDS)
+
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_user(mapper, connection, target: models.User):
+    # Срабатывает на flush через ORM (в том числе в AsyncSession); массовые update()/delete() в обход ORM
+    # события не вызывают - после них нужен явный user_cache.invalidate()
+    user_cache.invalidate(target.user_id)
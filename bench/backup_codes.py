@@ -0,0 +1,102 @@
+# bench/backup_codes.py
+# Бенчмарк проверки резервных кодов: crud.verify_and_use_backup_code, коды/с.
+#   hmac   - коды из create_backup_codes_for_user (с code_lookup): одна выборка по индексу
+#            и не больше одной проверки bcrypt
+#   legacy - те же коды без code_lookup (как до индекса): перебор bcrypt по всем неиспользованным кодам
+# Для каждого варианта меряются верный код (строка помечается использованной) и неверный код
+# (худший случай перебора и цель для подбора). Используется пул bcrypt приложения (app/password_hashing.py).
+#   python bench/backup_codes.py [--codes 10] [--attempts 20] [--database-url ...]
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _parse_arguments():
+    parser = argparse.ArgumentParser(prog="python bench/backup_codes.py")
+    parser.add_argument("--codes", type=int, default=10, help="unused backup codes per user")
+    parser.add_argument("--attempts", type=int, default=20, help="verifications per case")
+    parser.add_argument("--database-url", default=None, help="default: temporary SQLite file")
+    return parser.parse_args()
+
+
+async def _make_user(db, models, name: str) -> int:
+    db_user = models.User(username=name, email=f"{name}@bench.invalid", password_hash="-")
+    db.add(db_user)
+    await db.commit()
+    return db_user.user_id
+
+
+async def _issue_codes(db, crud, models, user_id: int, count: int, legacy: bool) -> list:
+    codes = await crud.create_backup_codes_for_user(db, user_id, num_codes=count)
+    if legacy:
+        # Как строки, выданные до появления code_lookup
+        from sqlalchemy import update
+        await db.execute(update(models.UserBackupCode).where(models.UserBackupCode.user_id == user_id).values(code_lookup=None))
+        await db.commit()
+    return codes
+
+
+async def _measure(db, crud, models, legacy: bool, codes_per_user: int, attempts: int) -> dict:
+    result = {}
+    # Верный код: каждый раз новый пользователь с codes_per_user кодами, проверяется последний выданный
+    users = []
+    for attempt in range(attempts):
+        user_id = await _make_user(db, models, f"{'legacy' if legacy else 'hmac'}_ok_{attempt}")
+        users.append((user_id, (await _issue_codes(db, crud, models, user_id, codes_per_user, legacy))[-1]))
+    started = time.perf_counter()
+    for user_id, code in users:
+        assert await crud.verify_and_use_backup_code(db, user_id, code)
+    result["valid"] = attempts / (time.perf_counter() - started)
+
+    # Неверный код: один пользователь, все коды остаются неиспользованными
+    user_id = await _make_user(db, models, f"{'legacy' if legacy else 'hmac'}_bad")
+    await _issue_codes(db, crud, models, user_id, codes_per_user, legacy)
+    started = time.perf_counter()
+    for _ in range(attempts):
+        assert not await crud.verify_and_use_backup_code(db, user_id, "WRONGCODE0")
+    result["invalid"] = attempts / (time.perf_counter() - started)
+    return result
+
+
+async def _run(arguments):
+    from app import crud, models
+    from app.database import AsyncSessionLocal, Base, async_engine, engine
+    from app.password_hashing import password_hash_pool
+
+    Base.metadata.create_all(bind=engine)
+    try:
+        print(f"{arguments.codes} неиспользованных кодов у пользователя, {arguments.attempts} проверок на случай")
+        print(f"{'scheme':<8} {'valid codes/s':>14} {'invalid codes/s':>16}")
+        async with AsyncSessionLocal() as db:
+            for legacy in (False, True):
+                result = await _measure(db, crud, models, legacy, arguments.codes, arguments.attempts)
+                print(f"{'legacy' if legacy else 'hmac':<8} {result['valid']:>14.1f} {result['invalid']:>16.1f}")
+    finally:
+        password_hash_pool.shutdown()
+        await async_engine.dispose()
+
+
+def main():
+    arguments = _parse_arguments()
+    temp_dir = None
+    if arguments.database_url is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="bench_backup_codes_")
+        arguments.database_url = f"sqlite:///{temp_dir.name}/bench.db"
+    # Настройки читаются при импорте app.config
+    os.environ["DATABASE_URL"] = arguments.database_url
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, ROOT)
+    try:
+        asyncio.run(_run(arguments))
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# bench/db_pool_load.py
+# Нагрузочный тест пула соединений (user-015): как пропускная способность упирается в DB_POOL_SIZE.
+# Для каждого размера пула запускается отдельный процесс (движки создаются при импорте app.database
+# с настройками из окружения): --concurrency задач в течение --seconds берут сессию AsyncSessionLocal,
+# выполняют запрос и держат соединение --hold-ms (имитация запроса к API). В конце печатаются
+# запросы/с и счетчики pool_stats(): ожидание выдачи соединения и таймауты.
+#   python bench/db_pool_load.py [--pool-sizes 1,2,5,10,20] [--concurrency 50] [--hold-ms 5]
+#                                [--database-url postgresql://...] (по умолчанию - временная SQLite)
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+async def _load(concurrency: int, seconds: float, hold: float) -> dict:
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import text
+    from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+    from app.database import AsyncSessionLocal, async_engine, pool_stats
+
+    completed = 0
+    timeouts = 0
+    deadline = time.perf_counter() + seconds
+
+    async def worker():
+        nonlocal completed, timeouts
+        while time.perf_counter() < deadline:
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(text("SELECT 1"))
+                    await asyncio.sleep(hold) # Соединение занято, пока "обрабатывается запрос"
+                completed += 1
+            except PoolTimeoutError:
+                timeouts += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stats = pool_stats()["async"]
+    await async_engine.dispose()
+    return {"requests_per_s": completed / elapsed, "completed": completed, "timeouts": timeouts, **stats}
+
+
+def _run_child(arguments, pool_size: int) -> dict:
+    env = dict(
+        os.environ,
+        DATABASE_URL=arguments.database_url,
+        DB_POOL_SIZE=str(pool_size),
+        DB_MAX_OVERFLOW=str(arguments.max_overflow),
+        DB_POOL_TIMEOUT=str(arguments.pool_timeout),
+        LOG_LEVEL="WARNING",
+    )
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", "--concurrency", str(arguments.concurrency),
+         "--seconds", str(arguments.seconds), "--hold-ms", str(arguments.hold_ms)],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python bench/db_pool_load.py")
+    parser.add_argument("--pool-sizes", default="1,2,5,10,20")
+    parser.add_argument("--max-overflow", type=int, default=0)
+    parser.add_argument("--pool-timeout", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--hold-ms", type=float, default=5.0)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.child:
+        result = asyncio.run(_load(arguments.concurrency, arguments.seconds, arguments.hold_ms / 1000))
+        print(json.dumps(result))
+        return
+
+    temp_dir = None
+    if arguments.database_url is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="bench_pool_")
+        arguments.database_url = f"sqlite:///{temp_dir.name}/bench.db"
+    try:
+        print(f"{arguments.database_url.split('@')[-1]}: {arguments.concurrency} задач, {arguments.seconds:g} с, "
+              f"соединение занято {arguments.hold_ms:g} мс, overflow {arguments.max_overflow}, timeout {arguments.pool_timeout:g} с")
+        print(f"{'pool':>5} {'req/s':>9} {'wait avg':>10} {'wait max':>10} {'timeouts':>9}")
+        for pool_size in (int(size) for size in arguments.pool_sizes.split(",")):
+            result = _run_child(arguments, pool_size)
+            print(f"{pool_size:>5} {result['requests_per_s']:>9.1f} {result['checkout_wait_seconds_avg'] * 1000:>8.2f}ms "
+                  f"{result['checkout_wait_seconds_max'] * 1000:>8.1f}ms {result['checkout_timeouts']:>9}")
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# bench/mail_throughput.py
+# Бенчмарк отправки 2FA-кодов (user-021), коды/с, через локальный SMTP-приемник
+# (python -m app.mailer debug-server, запускается отдельным процессом на --port).
+#   per-message - отдельное SMTP-соединение на каждое письмо, как прежний send_2fa_code_email
+#                 (без STARTTLS и LOGIN: с реальным сервером разница будет больше)
+#   outbox      - two_factor.queue_2fa_code_email кладет --codes писем в mail_outbox, затем
+#                 mail_sender рассылает их пачками через MAIL_CONNECTIONS постоянных соединений
+#   python bench/mail_throughput.py [--codes 500] [--connections 1,2,4] [--port 1026]
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def _wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"SMTP debug server did not start on port {port}")
+
+
+async def _per_message(count: int) -> float:
+    import aiosmtplib
+    from app.config import settings
+    from email.message import EmailMessage
+
+    started = time.perf_counter()
+    for number in range(count):
+        message = EmailMessage()
+        message["Subject"] = "Код подтверждения для Сейф-Папки"
+        message["From"] = settings.EMAIL_USER
+        message["To"] = f"user{number}@bench.invalid"
+        message.set_content(f"Ваш одноразовый код для входа в Сейф-Папку: {number:06d}")
+        await aiosmtplib.send(message, hostname=settings.SMTP_SERVER, port=settings.SMTP_PORT, start_tls=False)
+    return count / (time.perf_counter() - started)
+
+
+async def _outbox(count: int, connections: int) -> dict:
+    from app import mailer, two_factor
+    from app.config import settings
+    from app.database import AsyncSessionLocal
+
+    settings.MAIL_CONNECTIONS = connections
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=10)
+    started = time.perf_counter()
+    async with AsyncSessionLocal() as db:
+        for number in range(count):
+            await two_factor.queue_2fa_code_email(db, f"user{number}@bench.invalid", f"{number:06d}", expires_at)
+    enqueue_rate = count / (time.perf_counter() - started)
+
+    sent_before = mailer.mail_sender.counters["sent"]
+    opened_before = mailer.mail_sender.counters["connections_opened"]
+    started = time.perf_counter()
+    sender_task = asyncio.create_task(mailer.mail_sender.run())
+    while mailer.mail_sender.counters["sent"] - sent_before < count:
+        if sender_task.done():
+            sender_task.result()
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    sender_task.cancel()
+    try:
+        await sender_task
+    except asyncio.CancelledError:
+        pass
+    return {
+        "enqueue": enqueue_rate,
+        "send": count / elapsed,
+        "connections_opened": mailer.mail_sender.counters["connections_opened"] - opened_before,
+    }
+
+
+async def _run(arguments):
+    from app import models  # noqa: F401 (таблицы для create_all)
+    from app.database import Base, async_engine, engine
+
+    Base.metadata.create_all(bind=engine)
+    try:
+        print(f"{arguments.codes} кодов, пачка MAIL_BATCH_SIZE={os.environ['MAIL_BATCH_SIZE']}, SMTP 127.0.0.1:{arguments.port}")
+        print(f"{'mode':<16} {'enqueue codes/s':>16} {'send codes/s':>13} {'connections':>12}")
+        rate = await _per_message(arguments.codes)
+        print(f"{'per-message':<16} {'-':>16} {rate:>13.1f} {arguments.codes:>12}")
+        for connections in (int(value) for value in arguments.connections.split(",")):
+            result = await _outbox(arguments.codes, connections)
+            print(f"{f'outbox x{connections}':<16} {result['enqueue']:>16.1f} {result['send']:>13.1f} {result['connections_opened']:>12}")
+    finally:
+        await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python bench/mail_throughput.py")
+    parser.add_argument("--codes", type=int, default=500)
+    parser.add_argument("--connections", default="1,2,4")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--port", type=int, default=1026)
+    parser.add_argument("--database-url", default=None, help="default: temporary SQLite file")
+    arguments = parser.parse_args()
+
+    temp_dir = tempfile.TemporaryDirectory(prefix="bench_mail_")
+    # Настройки читаются при импорте app.config
+    os.environ.update({
+        "DATABASE_URL": arguments.database_url or f"sqlite:///{temp_dir.name}/bench.db",
+        "SMTP_SERVER": "127.0.0.1",
+        "SMTP_PORT": str(arguments.port),
+        "SMTP_STARTTLS": "false",
+        "EMAIL_USER": "bench@bench.invalid",
+        "EMAIL_PASSWORD": "",
+        "MAIL_BATCH_SIZE": str(arguments.batch_size),
+        "LOG_LEVEL": "WARNING",
+    })
+    sys.path.insert(0, ROOT)
+    smtp_server = subprocess.Popen(
+        [sys.executable, "-m", "app.mailer", "debug-server", str(arguments.port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(arguments.port)
+        asyncio.run(_run(arguments))
+    finally:
+        smtp_server.terminate()
+        smtp_server.wait()
+        temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
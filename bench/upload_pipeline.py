@@ -0,0 +1,99 @@
+# bench/upload_pipeline.py
+# Бенчмарк шифрования загрузки (user-004): пропускная способность (МБ/с) и задержка event loop,
+# пока идет загрузка большого файла.
+#   inline    - encryption.encrypt_file_stream прямо в корутине (как /upload до конвейера): loop стоит
+#   pipelined - _encrypt_to_disk из app/routers/files.py через run_in_threadpool: чтение, шифрование
+#               и запись в трех потоках с буферами PIPELINE_BUFFER_SIZE
+# Пока идет шифрование, отдельная задача каждые --tick-ms засыпает и меряет, насколько позже просыпается.
+#   python bench/upload_pipeline.py [--size-mb 512] [--modes inline,pipelined] [--dir /tmp]
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://") # app.database создает движки при импорте
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from starlette.concurrency import run_in_threadpool  # noqa: E402
+
+from app import encryption  # noqa: E402
+from app.routers.files import _encrypt_to_disk  # noqa: E402
+
+
+def _make_source(directory: str, size_mb: int) -> str:
+    fd, path = tempfile.mkstemp(prefix="bench_upload_", suffix=".bin", dir=directory)
+    block = os.urandom(1024 * 1024)
+    with os.fdopen(fd, "wb") as source_file:
+        for _ in range(size_mb):
+            source_file.write(block)
+    return path
+
+
+def _encrypt_inline(source_path: str, target_path: str, file_key: bytes):
+    with open(source_path, "rb") as source_file, open(target_path, "wb") as target_file:
+        encryption.encrypt_file_stream(source_file, target_file, file_key)
+
+
+async def _sample_lag(tick: float, lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(tick)
+        lags.append(max(0.0, time.perf_counter() - started - tick))
+
+
+async def _run(mode: str, source_path: str, target_path: str, tick: float) -> dict:
+    file_key = encryption.generate_random_file_key()
+    lags, stop = [], asyncio.Event()
+    sampler = asyncio.create_task(_sample_lag(tick, lags, stop))
+    await asyncio.sleep(tick * 2) # Сэмплер успевает начать до загрузки
+    started = time.perf_counter()
+    if mode == "inline":
+        _encrypt_inline(source_path, target_path, file_key)
+    else:
+        with open(source_path, "rb") as source_file:
+            await run_in_threadpool(_encrypt_to_disk, source_file, target_path, file_key)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await sampler
+    size_mb = os.path.getsize(source_path) / (1024 * 1024)
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    return {
+        "mode": mode,
+        "seconds": elapsed,
+        "mb_per_s": size_mb / elapsed,
+        "lag_samples": len(lags),
+        "lag_p50_ms": statistics.median(lags_ms),
+        "lag_p99_ms": lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))],
+        "lag_max_ms": lags_ms[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python bench/upload_pipeline.py")
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--modes", default="inline,pipelined")
+    parser.add_argument("--dir", default=tempfile.gettempdir(), help="where to put the source and encrypted files")
+    parser.add_argument("--tick-ms", type=float, default=10.0)
+    arguments = parser.parse_args()
+
+    source_path = _make_source(arguments.dir, arguments.size_mb)
+    target_path = f"{source_path}.enc"
+    try:
+        print(f"{arguments.size_mb} МиБ, буфер конвейера {encryption.PIPELINE_BUFFER_SIZE // 1024} КиБ, "
+              f"очередь {encryption.PIPELINE_QUEUE_DEPTH}, такт {arguments.tick_ms:g} мс")
+        print(f"{'mode':<10} {'s':>7} {'MB/s':>8} {'samples':>8} {'lag p50':>9} {'lag p99':>9} {'lag max':>9}")
+        for mode in arguments.modes.split(","):
+            result = asyncio.run(_run(mode.strip(), source_path, target_path, arguments.tick_ms / 1000))
+            print(f"{result['mode']:<10} {result['seconds']:>7.2f} {result['mb_per_s']:>8.1f} {result['lag_samples']:>8} "
+                  f"{result['lag_p50_ms']:>7.2f}ms {result['lag_p99_ms']:>7.2f}ms {result['lag_max_ms']:>7.1f}ms")
+    finally:
+        for path in (source_path, target_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
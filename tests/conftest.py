@@ -0,0 +1,62 @@
+# tests/conftest.py
+# Общее окружение тестов: временная SQLite-база и каталог хранилища, фоновые задачи выключены.
+# Настройки читаются при импорте app.config, поэтому окружение задается до импорта приложения.
+#   python -m pytest -q tests
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+TEST_ROOT = tempfile.mkdtemp(prefix="pochta_tests_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{TEST_ROOT}/test.db")
+os.environ.setdefault("FILES_STORAGE_PATH", os.path.join(TEST_ROOT, "user_files_encrypted"))
+os.environ.setdefault("SECRET_KEY", "test_secret_key")
+os.environ.setdefault("KEK_HEX", "11" * 32) # Без PBKDF2 при первом обращении к ключам
+for background_task in ("SWEEPER_ENABLED", "MAIL_SENDER_ENABLED", "GC_ENABLED"):
+    os.environ.setdefault(background_task, "false")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(TEST_ROOT, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app.main import app
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def db_session():
+    from app.database import SessionLocal
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def user(client, db_session):
+    """Новый пользователь на каждый тест (у файлов и статистики нет общих строк между тестами)."""
+    from app import models
+    name = f"user_{uuid.uuid4().hex[:12]}"
+    db_user = models.User(username=name, email=f"{name}@test.invalid", password_hash="-")
+    db_session.add(db_user)
+    db_session.commit()
+    db_session.refresh(db_user)
+    return db_user
+
+
+@pytest.fixture
+def auth_headers(user):
+    from app import security
+    token = security.create_access_token({"sub": user.username, "user_id": user.user_id})
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,144 @@
+# tests/test_dedup_references.py
+# Подсчет ссылок на объект хранилища при дедупликации (app/dedup.py): объект удаляется сборщиком
+# (blob_gc.purge_deleted_files) только вместе с последней ссылкой, а dedup_saved_bytes в счетчиках
+# пользователя равен сумме (живых ссылок - 1) * размер по объектам.
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import blob_gc, models, security, storage_layout
+from app.config import settings
+
+
+@pytest.fixture
+def upload(client, auth_headers):
+    def upload_content(data: bytes, filename: str = "same.bin") -> dict:
+        response = client.post(
+            f"/api/v1/files/upload/stream?filename={filename}",
+            content=data,
+            headers={**auth_headers, "Content-Type": "application/octet-stream"}
+        )
+        assert response.status_code == 201, response.text
+        return response.json()
+    return upload_content
+
+
+@pytest.fixture(autouse=True)
+def dedup_enabled(monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_DEDUP_ENABLED", True)
+
+
+def _stats(client, headers) -> dict:
+    response = client.get("/api/v1/files/stats", headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _delete(client, headers, file_id: int):
+    assert client.delete(f"/api/v1/files/{file_id}", headers=headers).status_code == 204
+
+
+def _purge(client, db_session, file_ids: list) -> int:
+    # Удаленные строки "старше" срока хранения
+    expired_at = datetime.now(timezone.utc) - timedelta(days=settings.GC_DELETED_RETENTION_DAYS + 1)
+    db_session.query(models.File).filter(models.File.file_id.in_(file_ids)).update(
+        {models.File.deleted_at: expired_at}, synchronize_session=False
+    )
+    db_session.commit()
+    return client.portal.call(blob_gc.purge_deleted_files)
+
+
+def _blob_exists(blob_uuid) -> bool:
+    return os.path.exists(storage_layout.absolute_path(storage_layout.layout.blob_path(blob_uuid)))
+
+
+def _blob_uuid(db_session, file_id: int):
+    db_file = db_session.get(models.File, file_id)
+    return db_file.blob_uuid or db_file.stored_filename_uuid
+
+
+def test_duplicate_shares_the_source_blob(client, auth_headers, db_session, upload):
+    data = os.urandom(100_000)
+    source, duplicate = upload(data), upload(data, "copy.bin")
+    assert _blob_uuid(db_session, duplicate["file_id"]) == _blob_uuid(db_session, source["file_id"])
+    stats = _stats(client, auth_headers)
+    assert stats["total_files"] == 2
+    assert stats["dedup_saved_bytes"] == source["file_size_bytes"]
+
+
+def test_source_deleted_while_duplicate_is_live(client, auth_headers, db_session, upload):
+    data = os.urandom(100_000)
+    source, duplicate = upload(data), upload(data, "copy.bin")
+    blob_uuid = _blob_uuid(db_session, source["file_id"])
+
+    _delete(client, auth_headers, source["file_id"])
+    assert _stats(client, auth_headers)["dedup_saved_bytes"] == 0
+    assert _purge(client, db_session, [source["file_id"]]) >= 1
+    db_session.expire_all()
+    assert db_session.get(models.File, source["file_id"]) is None
+    # Объект нужен живому дубликату
+    assert _blob_exists(blob_uuid)
+    response = client.get(f"/api/v1/files/{duplicate['file_id']}/download", headers=auth_headers)
+    assert response.status_code == 200
+    assert response.content == data
+
+    # Последняя ссылка: объект удаляется вместе с ней
+    _delete(client, auth_headers, duplicate["file_id"])
+    assert _stats(client, auth_headers) == {"total_files": 0, "total_bytes": 0, "dedup_saved_bytes": 0, "mime_families": {}}
+    _purge(client, db_session, [duplicate["file_id"]])
+    assert not _blob_exists(blob_uuid)
+
+
+def test_all_references_purged_in_one_batch(client, auth_headers, db_session, upload):
+    data = os.urandom(50_000)
+    rows = [upload(data, f"copy{number}.bin") for number in range(3)]
+    blob_uuid = _blob_uuid(db_session, rows[0]["file_id"])
+    for row in rows:
+        _delete(client, auth_headers, row["file_id"])
+    _purge(client, db_session, [row["file_id"] for row in rows])
+    assert not _blob_exists(blob_uuid)
+
+
+def test_saved_bytes_follow_live_references(client, auth_headers, db_session, upload):
+    data = os.urandom(30_000)
+    rows = [upload(data, f"copy{number}.bin") for number in range(3)]
+    size = rows[0]["file_size_bytes"]
+    other = upload(os.urandom(10), "other.bin")
+    assert _stats(client, auth_headers)["dedup_saved_bytes"] == 2 * size
+
+    _delete(client, auth_headers, rows[1]["file_id"]) # Дубликат
+    assert _stats(client, auth_headers)["dedup_saved_bytes"] == size
+    _delete(client, auth_headers, rows[0]["file_id"]) # Исходный файл
+    assert _stats(client, auth_headers)["dedup_saved_bytes"] == 0
+    _delete(client, auth_headers, other["file_id"]) # Без дубликатов - экономия не меняется
+    assert _stats(client, auth_headers)["dedup_saved_bytes"] == 0
+
+    # Новая загрузка того же содержимого ссылается на объект, который еще жив
+    upload(data, "again.bin")
+    stats = _stats(client, auth_headers)
+    assert stats["dedup_saved_bytes"] == size
+
+    # Пересчет счетчиков с нуля дает то же самое
+    user_id = db_session.get(models.File, rows[2]["file_id"]).user_id
+    db_session.query(models.UserMimeFamilyStats).filter(models.UserMimeFamilyStats.user_id == user_id).delete()
+    db_session.query(models.UserFileStats).filter(models.UserFileStats.user_id == user_id).delete()
+    db_session.commit()
+    assert _stats(client, auth_headers) == stats
+
+
+def test_no_dedup_across_users(client, auth_headers, db_session, upload, user):
+    data = os.urandom(20_000)
+    mine = upload(data)
+    other_user = models.User(username=f"{user.username}_b", email=f"{user.username}_b@example.com", password_hash="-")
+    db_session.add(other_user)
+    db_session.commit()
+    other_headers = {"Authorization": "Bearer " + security.create_access_token({"sub": other_user.username, "user_id": other_user.user_id})}
+    response = client.post(
+        "/api/v1/files/upload/stream?filename=same.bin",
+        content=data,
+        headers={**other_headers, "Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 201
+    assert _blob_uuid(db_session, response.json()["file_id"]) != _blob_uuid(db_session, mine["file_id"])
+    assert _stats(client, other_headers)["dedup_saved_bytes"] == 0
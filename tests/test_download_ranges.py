@@ -0,0 +1,104 @@
+# tests/test_download_ranges.py
+# Скачивание с Range и If-Range (GET /files/{id}/download): сегментированный формат дешифрует
+# только сегменты, покрывающие диапазон, поэтому отдельно проверяются диапазоны через границы сегментов.
+import os
+
+import pytest
+
+from app import encryption
+
+SEGMENT = encryption.DEFAULT_SEGMENT_SIZE
+DATA = os.urandom(3 * SEGMENT + 100)
+
+
+@pytest.fixture
+def uploaded(client, auth_headers):
+    response = client.post(
+        "/api/v1/files/upload/stream?filename=ranges.bin",
+        content=DATA,
+        headers={**auth_headers, "Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 201, response.text
+    url = f"/api/v1/files/{response.json()['file_id']}/download"
+    full = client.get(url, headers=auth_headers)
+    return url, full.headers
+
+
+def _get(client, headers, url, **extra):
+    return client.get(url, headers={**headers, **extra})
+
+
+def test_full_download_advertises_ranges(client, auth_headers, uploaded):
+    url, full_headers = uploaded
+    response = _get(client, auth_headers, url)
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Length"] == str(len(DATA))
+    assert full_headers["ETag"].startswith('"')
+
+
+@pytest.mark.parametrize("range_value, start, end", [
+    ("bytes=10-19", 10, 19),
+    ("bytes=0-0", 0, 0),
+    # Через одну и через две границы сегментов
+    (f"bytes={SEGMENT - 5}-{SEGMENT + 4}", SEGMENT - 5, SEGMENT + 4),
+    (f"bytes={SEGMENT - 1}-{2 * SEGMENT + 1}", SEGMENT - 1, 2 * SEGMENT + 1),
+    # Ровно один сегмент и последний (неполный) сегмент
+    (f"bytes={SEGMENT}-{2 * SEGMENT - 1}", SEGMENT, 2 * SEGMENT - 1),
+    (f"bytes={3 * SEGMENT}-", 3 * SEGMENT, len(DATA) - 1),
+    # Конец за пределами файла обрезается
+    (f"bytes={len(DATA) - 3}-{len(DATA) + 1000}", len(DATA) - 3, len(DATA) - 1),
+    # Суффиксные диапазоны: последние N байт, N больше файла - весь файл
+    ("bytes=-100", len(DATA) - 100, len(DATA) - 1),
+    (f"bytes=-{SEGMENT + 200}", len(DATA) - SEGMENT - 200, len(DATA) - 1),
+    (f"bytes=-{len(DATA) + 10}", 0, len(DATA) - 1),
+])
+def test_range(client, auth_headers, uploaded, range_value, start, end):
+    url, _ = uploaded
+    response = _get(client, auth_headers, url, Range=range_value)
+    assert response.status_code == 206, response.text
+    assert response.content == DATA[start:end + 1]
+    assert response.headers["Content-Range"] == f"bytes {start}-{end}/{len(DATA)}"
+    assert response.headers["Content-Length"] == str(end - start + 1)
+
+
+@pytest.mark.parametrize("range_value", [f"bytes={len(DATA)}-", f"bytes={len(DATA) + 5}-{len(DATA) + 10}"])
+def test_unsatisfiable_range(client, auth_headers, uploaded, range_value):
+    url, _ = uploaded
+    response = _get(client, auth_headers, url, Range=range_value)
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+@pytest.mark.parametrize("range_value", ["bytes=0-1,5-6", "items=0-10", "bytes=20-10", "bytes=-0", "bytes=abc"])
+def test_unsupported_range_returns_full_file(client, auth_headers, uploaded, range_value):
+    url, _ = uploaded
+    response = _get(client, auth_headers, url, Range=range_value)
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_if_range(client, auth_headers, uploaded):
+    url, full_headers = uploaded
+    for validator in (full_headers["ETag"], full_headers["Last-Modified"]):
+        response = _get(client, auth_headers, url, Range="bytes=5-9", **{"If-Range": validator})
+        assert response.status_code == 206
+        assert response.content == DATA[5:10]
+    # Валидатор не совпал - файл "изменился", отдается целиком
+    response = _get(client, auth_headers, url, Range="bytes=5-9", **{"If-Range": '"0000-other-etag"'})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_empty_file_range_is_unsatisfiable(client, auth_headers):
+    response = client.post(
+        "/api/v1/files/upload/stream?filename=empty.bin",
+        content=b"",
+        headers={**auth_headers, "Content-Type": "application/octet-stream"}
+    )
+    url = f"/api/v1/files/{response.json()['file_id']}/download"
+    assert _get(client, auth_headers, url).content == b""
+    response = _get(client, auth_headers, url, Range="bytes=0-")
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */0"
@@ -0,0 +1,162 @@
+# tests/test_encryption.py
+# Сегментированный формат (app/encryption.py): шифрование и дешифрование на границах сегментов,
+# чтение диапазонов и обнаружение подмены (байт, порядок сегментов, обрезка, заголовок-AAD).
+# Старый формат (один GCM-поток) должен по-прежнему читаться.
+import io
+import os
+
+import pytest
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from app import encryption
+
+SEGMENT = 1024 # Маленький сегмент: много границ на небольших данных
+TAG = encryption.GCM_TAG_SIZE
+HEADER = encryption.SEGMENTED_HEADER_SIZE
+SIZES = [0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 3 * SEGMENT, 3 * SEGMENT + 7]
+
+
+def _encrypt(data: bytes, key: bytes, chunk: int = 100) -> bytes:
+    encryptor = encryption.SegmentedEncryptor(key, SEGMENT)
+    out = [encryptor.update(data[position:position + chunk]) for position in range(0, len(data), chunk)]
+    out.append(encryptor.finalize())
+    return b"".join(out)
+
+
+def _decrypt(encrypted: bytes, key: bytes) -> bytes:
+    return b"".join(encryption.iter_decrypt_segmented(io.BytesIO(encrypted), key))
+
+
+def _segments(encrypted: bytes) -> list:
+    body = encrypted[HEADER:]
+    return [body[position:position + SEGMENT + TAG] for position in range(0, len(body), SEGMENT + TAG)]
+
+
+@pytest.fixture
+def key() -> bytes:
+    return encryption.generate_random_file_key()
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_round_trip(key, size):
+    data = os.urandom(size)
+    encrypted = _encrypt(data, key)
+    assert len(encrypted) == encryption.segmented_encrypted_size(size, SEGMENT)
+    assert encryption.segmented_plaintext_size(len(encrypted), SEGMENT) == size
+    assert encryption.segment_count(len(encrypted), SEGMENT) == max(1, -(-size // SEGMENT))
+    assert _decrypt(encrypted, key) == data
+    assert encryption.plaintext_size(io.BytesIO(encrypted), encryption.SEGMENTED_ALGORITHM) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_stream_pipelined_and_batch_encryption_agree(key, size):
+    data = os.urandom(size)
+    plain_output, pipelined_output = io.BytesIO(), io.BytesIO()
+    nonce_prefix, final_tag = encryption.encrypt_file_stream(io.BytesIO(data), plain_output, key, SEGMENT)
+    assert plain_output.getvalue()[-TAG:] == final_tag
+    encryption.encrypt_file_stream_pipelined(io.BytesIO(data), pipelined_output, key, SEGMENT, buffer_size=300, queue_depth=2)
+    assert _decrypt(plain_output.getvalue(), key) == data
+    assert _decrypt(pipelined_output.getvalue(), key) == data
+
+    # Параллельные пачки (multipart) с тем же заголовком дают те же байты, что и последовательный шифратор
+    header = encryption.build_segmented_header(SEGMENT, nonce_prefix)
+    final_index = max(0, -(-size // SEGMENT) - 1)
+    batches = [
+        encryption.encrypt_segment_batch(key, header.raw, first // SEGMENT, data[first:first + 2 * SEGMENT], final_index)
+        for first in range(0, max(size, 1), 2 * SEGMENT)
+    ]
+    assert header.raw + b"".join(batches) == plain_output.getvalue()
+
+
+def test_ranges_across_segment_boundaries(key):
+    data = os.urandom(3 * SEGMENT + 7)
+    encrypted = _encrypt(data, key)
+    points = [0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 2 * SEGMENT, 3 * SEGMENT, len(data) - 1]
+    for start in points:
+        for end in points:
+            if end < start:
+                continue
+            chunks = encryption.iter_decrypt_range(io.BytesIO(encrypted), key, start, end)
+            assert b"".join(chunks) == data[start:end + 1], (start, end)
+
+
+def _assert_rejected(encrypted: bytes, key: bytes):
+    with pytest.raises(ValueError, match="Decryption failed"):
+        _decrypt(encrypted, key)
+
+
+def test_flipped_byte_is_detected(key):
+    encrypted = bytearray(_encrypt(os.urandom(2 * SEGMENT + 10), key))
+    for position in (HEADER, HEADER + SEGMENT + 3, len(encrypted) - 1):
+        tampered = bytearray(encrypted)
+        tampered[position] ^= 0x01
+        _assert_rejected(bytes(tampered), key)
+
+
+def test_reordered_segments_are_detected(key):
+    encrypted = _encrypt(os.urandom(3 * SEGMENT), key)
+    first, second, third = _segments(encrypted)
+    _assert_rejected(encrypted[:HEADER] + second + first + third, key)
+    # Полный сегмент на месте финального (и наоборот) тоже не проходит: флаг final входит в nonce
+    _assert_rejected(encrypted[:HEADER] + first + third + second, key)
+
+
+def test_truncation_is_detected(key):
+    encrypted = _encrypt(os.urandom(2 * SEGMENT + 10), key)
+    final_segment_size = 10 + TAG
+    # Без финального сегмента: последний полный сегмент не помечен как финальный
+    _assert_rejected(encrypted[:-final_segment_size], key)
+    # Финальный сегмент обрезан
+    _assert_rejected(encrypted[:-3], key)
+    # Пустой финальный сегмент файла из целых сегментов
+    whole = _encrypt(os.urandom(2 * SEGMENT), key)
+    _assert_rejected(whole[:-(SEGMENT + TAG)], key)
+    # Остался только заголовок
+    _assert_rejected(encrypted[:HEADER], key)
+    # Лишний сегмент в конце
+    _assert_rejected(encrypted + _segments(encrypted)[0], key)
+
+
+def test_modified_header_is_detected(key):
+    encrypted = _encrypt(os.urandom(SEGMENT + 10), key)
+    # Префикс nonce и размер сегмента - часть AAD каждого сегмента
+    for position in (HEADER - 1, 8):
+        tampered = bytearray(encrypted)
+        tampered[position] ^= 0x01
+        _assert_rejected(bytes(tampered), key)
+    # Неизвестная версия и чужой MAGIC отклоняются до дешифрования
+    _assert_rejected(encrypted[:4] + bytes([encryption.SEGMENTED_VERSION + 1]) + encrypted[5:], key)
+    _assert_rejected(b"XXXX" + encrypted[4:], key)
+
+
+def test_wrong_key_is_detected(key):
+    _assert_rejected(_encrypt(b"secret", key), encryption.generate_random_file_key())
+
+
+def _legacy_encrypt(data: bytes, key: bytes):
+    iv = os.urandom(12)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(iv)).encryptor()
+    return iv + encryptor.update(data) + encryptor.finalize(), encryptor.tag
+
+
+@pytest.mark.parametrize("size", [0, 1, 64 * 1024 + 5])
+def test_legacy_files_still_decrypt(key, size):
+    data = os.urandom(size)
+    encrypted, tag = _legacy_encrypt(data, key)
+    chunks = encryption.iter_decrypt_file(io.BytesIO(encrypted), key, encryption.LEGACY_ALGORITHM, tag)
+    assert b"".join(chunks) == data
+    output = io.BytesIO()
+    encryption.decrypt_file_stream(io.BytesIO(encrypted), output, key, tag)
+    assert output.getvalue() == data
+    assert encryption.plaintext_size(io.BytesIO(encrypted), encryption.LEGACY_ALGORITHM) == size
+    assert not encryption.supports_range(encryption.LEGACY_ALGORITHM)
+
+
+def test_legacy_tampering_is_detected(key):
+    encrypted, tag = _legacy_encrypt(os.urandom(1000), key)
+    tampered = bytearray(encrypted)
+    tampered[-1] ^= 0x01
+    with pytest.raises(ValueError, match="Decryption failed"):
+        b"".join(encryption.iter_decrypt_file(io.BytesIO(bytes(tampered)), key, encryption.LEGACY_ALGORITHM, tag))
+    with pytest.raises(ValueError, match="Decryption failed"):
+        b"".join(encryption.iter_decrypt_file(io.BytesIO(encrypted), key, encryption.LEGACY_ALGORITHM, bytes(TAG)))
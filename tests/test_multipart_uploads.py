@@ -0,0 +1,167 @@
+# tests/test_multipart_uploads.py
+# Multipart-загрузки (PUT /uploads/{id}/parts/{n}, POST /uploads/{id}/complete): части шифруются
+# независимо с глобальными номерами сегментов, поэтому их можно слать в любом порядке и одновременно.
+# Финальный сегмент (флаг final в nonce) есть только в последней части.
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import encryption, storage_layout
+
+SEGMENT = encryption.DEFAULT_SEGMENT_SIZE
+PART = 2 * SEGMENT
+
+
+def _create(client, headers, size: int, part_size: int = PART) -> dict:
+    response = client.post(
+        "/api/v1/uploads/multipart",
+        json={"filename": "parts.bin", "upload_length": size, "part_size": part_size},
+        headers=headers
+    )
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def _parts(data: bytes, part_size: int = PART) -> dict:
+    if not data:
+        return {1: b""}
+    return {number + 1: data[start:start + part_size] for number, start in enumerate(range(0, len(data), part_size))}
+
+
+def _put(client, headers, upload_id: str, part_number: int, data: bytes):
+    return client.put(f"/api/v1/uploads/{upload_id}/parts/{part_number}", content=data, headers=headers)
+
+
+def _complete(client, headers, upload_id: str):
+    return client.post(f"/api/v1/uploads/{upload_id}/complete", headers=headers)
+
+
+def _download(client, headers, file_id: int) -> bytes:
+    response = client.get(f"/api/v1/files/{file_id}/download", headers=headers)
+    assert response.status_code == 200, response.text
+    return response.content
+
+
+def _upload_files() -> set:
+    # Файлы сессий (.<uuid>.enc.part), их части (...part<n>) и временные части (...tmp)
+    return {entry.name for entry in storage_layout.iter_storage_entries() if ".part" in entry.name or entry.name.endswith(".tmp")}
+
+
+# Последняя часть короче, ровно на границе сегмента, единственная короткая часть и пустой файл
+@pytest.mark.parametrize("size", [3 * PART + 100, 3 * PART, 2 * PART + SEGMENT, SEGMENT + 5, 0])
+def test_parts_out_of_order(client, auth_headers, size):
+    data = os.urandom(size)
+    files_before = _upload_files()
+    upload = _create(client, auth_headers, size)
+    parts = _parts(data)
+    assert upload["part_count"] == len(parts)
+
+    for part_number in sorted(parts, reverse=True):
+        response = _put(client, auth_headers, upload["upload_id"], part_number, parts[part_number])
+        assert response.status_code == 200, response.text
+        assert response.json()["size"] == len(parts[part_number])
+
+    response = _complete(client, auth_headers, upload["upload_id"])
+    assert response.status_code == 201, response.text
+    assert response.json()["file_size_bytes"] == encryption.segmented_encrypted_size(size, SEGMENT)
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+    assert _upload_files() == files_before
+
+
+def test_parts_in_parallel(client, auth_headers):
+    data = os.urandom(6 * PART + 1234)
+    upload = _create(client, auth_headers, len(data))
+    parts = _parts(data)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(pool.map(lambda item: _put(client, auth_headers, upload["upload_id"], *item), parts.items()))
+    assert [response.status_code for response in responses] == [200] * len(parts)
+
+    listed = client.get(f"/api/v1/uploads/{upload['upload_id']}/parts", headers=auth_headers).json()
+    assert [part["part_number"] for part in listed] == sorted(parts)
+    response = _complete(client, auth_headers, upload["upload_id"])
+    assert response.status_code == 201, response.text
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+
+
+def test_duplicate_part_replaces_previous(client, auth_headers):
+    data = os.urandom(2 * PART + 10)
+    upload = _create(client, auth_headers, len(data))
+    parts = _parts(data)
+    assert _put(client, auth_headers, upload["upload_id"], 2, os.urandom(PART)).status_code == 200
+    for part_number, part in parts.items():
+        assert _put(client, auth_headers, upload["upload_id"], part_number, part).status_code == 200
+
+    listed = client.get(f"/api/v1/uploads/{upload['upload_id']}/parts", headers=auth_headers).json()
+    assert [part["part_number"] for part in listed] == [1, 2, 3]
+    response = _complete(client, auth_headers, upload["upload_id"])
+    assert response.status_code == 201, response.text
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+
+
+def test_missing_part_blocks_complete(client, auth_headers):
+    data = os.urandom(3 * PART)
+    upload = _create(client, auth_headers, len(data))
+    parts = _parts(data)
+    for part_number in (1, 3):
+        assert _put(client, auth_headers, upload["upload_id"], part_number, parts[part_number]).status_code == 200
+
+    response = _complete(client, auth_headers, upload["upload_id"])
+    assert response.status_code == 409
+    assert "[2]" in response.json()["detail"]
+
+    assert _put(client, auth_headers, upload["upload_id"], 2, parts[2]).status_code == 200
+    response = _complete(client, auth_headers, upload["upload_id"])
+    assert response.status_code == 201, response.text
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+
+
+def test_part_sizes_are_exact(client, auth_headers):
+    data = os.urandom(PART + 100)
+    files_before = _upload_files()
+    upload = _create(client, auth_headers, len(data))
+    upload_id = upload["upload_id"]
+    # Часть не последняя - ровно part_size; последняя - ровно остаток
+    assert _put(client, auth_headers, upload_id, 1, data[:PART - 1]).status_code == 400
+    assert _put(client, auth_headers, upload_id, 1, data[:PART] + b"x").status_code == 413
+    assert _put(client, auth_headers, upload_id, 2, data[PART:] + b"x").status_code == 413
+    assert _put(client, auth_headers, upload_id, 2, data[PART:-1]).status_code == 400
+    assert _put(client, auth_headers, upload_id, 3, b"").status_code == 400
+    assert _put(client, auth_headers, upload_id, 0, b"").status_code == 422
+    assert client.get(f"/api/v1/uploads/{upload_id}/parts", headers=auth_headers).json() == []
+    # Отклоненные части не оставляют временных файлов; отмена удаляет файл сессии
+    assert client.delete(f"/api/v1/uploads/{upload_id}", headers=auth_headers).status_code == 204
+    assert _upload_files() == files_before
+
+
+def test_final_segment_flag_is_only_in_last_part(client, auth_headers):
+    # Файл из целых частей: если бы последний сегмент последней части не был помечен финальным
+    # (или финальным был сегмент в середине), дешифрование бы не прошло
+    data = os.urandom(2 * PART)
+    upload = _create(client, auth_headers, len(data))
+    parts = _parts(data)
+    for part_number, part in parts.items():
+        assert _put(client, auth_headers, upload["upload_id"], part_number, part).status_code == 200
+    response = _complete(client, auth_headers, upload["upload_id"])
+    file_id = response.json()["file_id"]
+    assert _download(client, auth_headers, file_id) == data
+    # Диапазон по последнему сегменту проверяет тег финального сегмента отдельно
+    response = client.get(f"/api/v1/files/{file_id}/download", headers={**auth_headers, "Range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.content == data[-10:]
+
+
+def test_part_size_must_be_whole_segments(client, auth_headers):
+    response = client.post(
+        "/api/v1/uploads/multipart",
+        json={"filename": "parts.bin", "upload_length": 10, "part_size": SEGMENT + 1},
+        headers=auth_headers
+    )
+    assert response.status_code == 422
+
+
+def test_sequential_endpoints_reject_multipart(client, auth_headers):
+    upload = _create(client, auth_headers, 10)
+    response = client.patch(f"/api/v1/uploads/{upload['upload_id']}", content=b"x", headers={**auth_headers, "Upload-Offset": "0"})
+    assert response.status_code == 409
+    assert client.post(f"/api/v1/uploads/{upload['upload_id']}/finalize", headers=auth_headers).status_code == 409
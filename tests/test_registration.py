@@ -0,0 +1,49 @@
+# tests/test_registration.py
+# Подтверждение регистрации (POST /auth/register/confirm): пользователь, его резервные коды и удаление
+# кода регистрации сохраняются вместе - занятый пул bcrypt (429) не должен оставлять аккаунт без кодов.
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from app import crud, models
+from app.password_hashing import PasswordHashPoolBusy
+
+
+def _pending_registration(db_session) -> models.TwoFactorTempCode:
+    name = f"reg_{uuid.uuid4().hex[:12]}"
+    db_code = models.TwoFactorTempCode(
+        pending_email=f"{name}@example.com",
+        pending_username=name,
+        pending_password_hash="-",
+        code="123456",
+        purpose="registration_verify",
+        expires_at=datetime.now(timezone.utc) + timedelta(minutes=15)
+    )
+    db_session.add(db_code)
+    db_session.commit()
+    return db_code
+
+
+def test_confirm_is_retryable_when_hash_pool_is_busy(client, db_session, monkeypatch):
+    db_code = _pending_registration(db_session)
+    code_id, email, username = db_code.id, db_code.pending_email, db_code.pending_username
+    confirm = {"email": email, "code": "123456"}
+
+    async def busy(values):
+        raise PasswordHashPoolBusy()
+
+    monkeypatch.setattr(crud, "hash_passwords", busy)
+    response = client.post("/api/v1/auth/register/confirm", json=confirm)
+    assert response.status_code == 429, response.text
+    db_session.expire_all()
+    assert db_session.query(models.User).filter(models.User.email == email).count() == 0
+    assert db_session.get(models.TwoFactorTempCode, code_id) is not None
+
+    monkeypatch.undo()
+    response = client.post("/api/v1/auth/register/confirm", json=confirm)
+    assert response.status_code == 201, response.text
+    body = response.json()
+    assert body["username"] == username
+    assert len(body["backup_codes"]) == 5
+    db_session.expire_all()
+    assert db_session.query(models.UserBackupCode).filter(models.UserBackupCode.user_id == body["user_id"]).count() == 5
+    assert db_session.get(models.TwoFactorTempCode, code_id) is None
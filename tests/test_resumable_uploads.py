@@ -0,0 +1,79 @@
+# tests/test_resumable_uploads.py
+# Возобновляемые загрузки (app/routers/uploads.py): PATCH после того, как все данные получены,
+# не должен трогать финальный сегмент, а finalize не должен создавать File из неполного файла.
+import os
+import uuid
+
+import pytest
+
+from app import encryption, models
+from app.routers import uploads
+
+SEGMENT = encryption.DEFAULT_SEGMENT_SIZE
+
+
+def _create(client, headers, size: int) -> str:
+    response = client.post("/api/v1/uploads", json={"filename": "data.bin", "upload_length": size}, headers=headers)
+    assert response.status_code == 201, response.text
+    return response.json()["upload_id"]
+
+
+def _patch(client, headers, upload_id: str, offset: int, data: bytes):
+    return client.patch(f"/api/v1/uploads/{upload_id}", content=data, headers={**headers, "Upload-Offset": str(offset)})
+
+
+def _download(client, headers, file_id: int) -> bytes:
+    response = client.get(f"/api/v1/files/{file_id}/download", headers=headers)
+    assert response.status_code == 200, response.text
+    return response.content
+
+
+@pytest.mark.parametrize("size", [0, 1, SEGMENT, SEGMENT + 10, 200000])
+def test_patch_after_complete_keeps_final_segment(client, auth_headers, size):
+    data = os.urandom(size)
+    upload_id = _create(client, auth_headers, size)
+    if size:
+        response = _patch(client, auth_headers, upload_id, 0, data)
+        assert response.status_code == 204, response.text
+        assert response.headers["Upload-Offset"] == str(size)
+
+    # Повтор последнего PATCH (ответ потерялся) и PATCH пустого файла: ничего не меняют
+    response = _patch(client, auth_headers, upload_id, size, b"")
+    assert response.status_code == 204, response.text
+    assert response.headers["Upload-Offset"] == str(size)
+    # Лишние байты после конца - 413, файл тоже не трогается
+    assert _patch(client, auth_headers, upload_id, size, b"x").status_code == 413
+
+    response = client.post(f"/api/v1/uploads/{upload_id}/finalize", headers=auth_headers)
+    assert response.status_code == 201, response.text
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+
+
+def test_resume_after_partial_chunk(client, auth_headers):
+    data = os.urandom(200000)
+    upload_id = _create(client, auth_headers, len(data))
+    # Сохраняются только целые сегменты: offset выравнивается вниз
+    response = _patch(client, auth_headers, upload_id, 0, data[:100000])
+    assert response.headers["Upload-Offset"] == str(SEGMENT)
+    assert _patch(client, auth_headers, upload_id, 0, data[:10]).status_code == 409
+    assert _patch(client, auth_headers, upload_id, SEGMENT, data[SEGMENT:]).status_code == 204
+
+    response = client.post(f"/api/v1/uploads/{upload_id}/finalize", headers=auth_headers)
+    assert response.status_code == 201, response.text
+    assert _download(client, auth_headers, response.json()["file_id"]) == data
+
+
+@pytest.mark.parametrize("size", [0, SEGMENT + 10])
+def test_finalize_rejects_truncated_file(client, auth_headers, db_session, size):
+    upload_id = _create(client, auth_headers, size)
+    if size:
+        assert _patch(client, auth_headers, upload_id, 0, os.urandom(size)).status_code == 204
+    db_upload = db_session.get(models.UploadSession, uuid.UUID(upload_id))
+    # Имитируем файл, потерявший финальный сегмент
+    with open(uploads._temp_location(db_upload), "r+b") as part_file:
+        part_file.truncate(encryption.SEGMENTED_HEADER_SIZE + (size // SEGMENT) * (SEGMENT + encryption.GCM_TAG_SIZE))
+
+    files_before = db_session.query(models.File).filter(models.File.user_id == db_upload.user_id).count()
+    response = client.post(f"/api/v1/uploads/{upload_id}/finalize", headers=auth_headers)
+    assert response.status_code == 409, response.text
+    assert db_session.query(models.File).filter(models.File.user_id == db_upload.user_id).count() == files_before
@@ -0,0 +1,172 @@
+# tests/test_storage.py
+# Бэкенды хранилища (app/storage.py): S3 - на moto (mock_aws, без сети), локальный - во временном каталоге.
+# Проверяются загрузка (в том числе multipart), чтение диапазонов через _S3ObjectReader, удаление
+# и поиск файла по запасным путям (путь из БД, текущая и плоская раскладка).
+import io
+import os
+import uuid
+
+import pytest
+
+from app import storage, storage_layout
+from app.config import settings
+
+MiB = 1024 * 1024
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def s3_backend(monkeypatch):
+    for name, value in {
+        "STORAGE_S3_BUCKET": "pochta-test",
+        "STORAGE_S3_PREFIX": "blobs",
+        "STORAGE_S3_ENDPOINT_URL": None,
+        "STORAGE_S3_REGION": "us-east-1",
+        "STORAGE_S3_ACCESS_KEY_ID": "testing",
+        "STORAGE_S3_SECRET_ACCESS_KEY": "testing",
+        # Минимальная часть S3 - 5 МиБ: файл из теста уходит тремя частями
+        "STORAGE_S3_MULTIPART_THRESHOLD": 5 * MiB,
+        "STORAGE_S3_MULTIPART_CHUNK_SIZE": 5 * MiB,
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+    with moto.mock_aws():
+        backend = storage.S3StorageBackend()
+        backend.client.create_bucket(Bucket="pochta-test")
+        yield backend
+        backend.close()
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    backend = storage.LocalStorageBackend(str(tmp_path))
+    # Запасные пути строятся через storage_layout.absolute_path - он должен смотреть в тот же каталог
+    monkeypatch.setattr(storage_layout, "FILES_STORAGE_PATH", str(tmp_path))
+    monkeypatch.setattr(storage, "backend", backend)
+    return backend
+
+
+def _count_gets(backend, monkeypatch) -> list:
+    calls = []
+    get_object = backend.client.get_object
+
+    def counting_get_object(**kwargs):
+        calls.append(kwargs.get("Range"))
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(backend.client, "get_object", counting_get_object)
+    return calls
+
+
+def test_s3_put_file_multipart_and_read(s3_backend, tmp_path):
+    data = os.urandom(12 * MiB + 123)
+    source = tmp_path / "upload.part"
+    source.write_bytes(data)
+
+    s3_backend.put_file(str(source), "ab/cd/blob.enc")
+    assert not source.exists()
+    head = s3_backend.client.head_object(Bucket="pochta-test", Key="blobs/ab/cd/blob.enc")
+    assert head["ContentLength"] == len(data)
+    assert head["ETag"].strip('"').endswith("-3") # multipart upload из трех частей
+    assert s3_backend.size("ab/cd/blob.enc") == len(data)
+    with s3_backend.open_read("ab/cd/blob.enc") as stream:
+        assert stream.read() == data
+    assert s3_backend.stats()["puts"] == 1
+    assert s3_backend.stats()["put_bytes"] == len(data)
+
+
+def test_s3_put_stream(s3_backend):
+    data = os.urandom(6 * MiB)
+    s3_backend.put_stream(io.BytesIO(data), "stream.enc")
+    assert s3_backend.size("stream.enc") == len(data)
+    assert b"".join(s3_backend.iter_range("stream.enc", 0, len(data) - 1)) == data
+    assert s3_backend.stats()["put_bytes"] == len(data)
+
+
+def test_s3_reader_ranges(s3_backend, monkeypatch):
+    data = os.urandom(3 * MiB + 17)
+    s3_backend.put_stream(io.BytesIO(data), "range.enc")
+    gets = _count_gets(s3_backend, monkeypatch)
+
+    with s3_backend.open_read("range.enc") as stream:
+        # Последовательное чтение идет из одного ответа
+        assert stream.read(10) == data[:10]
+        assert stream.read(MiB) == data[10:10 + MiB]
+        assert len(gets) == 1
+        # seek назад за пределы буфера - новый GET с нужного смещения
+        stream.seek(5)
+        assert stream.read(100) == data[5:105]
+        stream.seek(-7, os.SEEK_END)
+        assert stream.read() == data[-7:]
+        assert stream.tell() == len(data)
+        assert stream.read(10) == b""
+    assert gets[0] == "bytes=0-"
+    assert "bytes=5-" in gets
+
+    gets.clear()
+    assert b"".join(s3_backend.iter_range("range.enc", 100, 2 * MiB, chunk_size=64 * 1024)) == data[100:2 * MiB + 1]
+    assert gets == [f"bytes=100-{2 * MiB}"]
+
+
+def test_s3_missing_and_delete(s3_backend):
+    with pytest.raises(FileNotFoundError):
+        s3_backend.open_read("missing.enc")
+    with pytest.raises(FileNotFoundError):
+        s3_backend.open_read("/old/absolute/path.enc")
+    assert s3_backend.stats()["missing"] == 2
+
+    s3_backend.put_stream(io.BytesIO(b"data"), "to-delete.enc")
+    assert [blob.key for blob in s3_backend.iter_blobs()] == ["to-delete.enc"]
+    assert s3_backend.delete("to-delete.enc") is True
+    assert s3_backend.delete("to-delete.enc") is False
+    assert list(s3_backend.iter_blobs()) == []
+    assert s3_backend.stats()["deletes"] == 1
+
+
+def test_s3_delete_file_blob_falls_back_to_layout_key(s3_backend, monkeypatch):
+    monkeypatch.setattr(storage, "backend", s3_backend)
+    stored_uuid = uuid.uuid4()
+    s3_backend.put_stream(io.BytesIO(b"data"), storage_layout.layout.blob_path(stored_uuid))
+    # В БД остался старый путь, объект лежит по пути текущей раскладки
+    with storage.open_file_blob(f"{stored_uuid}.enc", stored_uuid) as stream:
+        assert stream.read() == b"data"
+    assert storage.delete_file_blob(f"{stored_uuid}.enc", stored_uuid) is True
+    assert storage.delete_file_blob(f"{stored_uuid}.enc", stored_uuid) is False
+
+
+@pytest.mark.parametrize("stored_layout", [storage_layout.layout, storage_layout.FlatLayout()], ids=["current", "flat"])
+def test_local_path_fallback(local_backend, tmp_path, stored_layout):
+    stored_uuid = uuid.uuid4()
+    local_backend.put_stream(io.BytesIO(b"payload"), stored_layout.blob_path(stored_uuid))
+    recorded_paths = [
+        str(tmp_path / "moved-away" / f"{stored_uuid}.enc"), # Старая строка с абсолютным путем
+        "zz/zz/" + f"{stored_uuid}.enc", # Относительный путь, по которому файла уже нет
+    ]
+    for recorded_path in recorded_paths:
+        with storage.open_file_blob(recorded_path, stored_uuid) as stream:
+            assert stream.read() == b"payload"
+    assert storage.delete_file_blob(recorded_paths[0], stored_uuid) is True
+    assert storage.delete_file_blob(recorded_paths[0], stored_uuid) is False
+    with pytest.raises(FileNotFoundError):
+        storage.open_file_blob(recorded_paths[0], stored_uuid)
+
+
+def test_local_put_file_and_ranges(local_backend, tmp_path):
+    data = os.urandom(2 * MiB + 5)
+    source = tmp_path / "upload.part"
+    source.write_bytes(data)
+    local_backend.put_file(str(source), "ab/cd/blob.enc")
+    assert not source.exists()
+    assert local_backend.size("ab/cd/blob.enc") == len(data)
+    assert b"".join(local_backend.iter_range("ab/cd/blob.enc", 7, MiB)) == data[7:MiB + 1]
+    assert [blob.key for blob in local_backend.iter_blobs()] == ["ab/cd/blob.enc"]
+    # Временные файлы put_stream не остаются рядом с объектом
+    local_backend.put_stream(io.BytesIO(data), "ab/cd/blob.enc")
+    assert sorted(os.listdir(tmp_path / "ab" / "cd")) == ["blob.enc"]
+
+
+def test_backends_are_abstract():
+    with pytest.raises(TypeError):
+        storage.StorageBackend()
+    with pytest.raises(TypeError):
+        storage_layout.StorageLayout()
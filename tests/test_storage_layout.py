@@ -0,0 +1,113 @@
+# tests/test_storage_layout.py
+# Перенос файлов в текущую раскладку (storage_layout.migrate_files): пути в БД становятся относительными,
+# файлы переносятся жесткими ссылками (без копирования данных), повторный запуск после прерывания безопасен.
+import os
+import uuid
+
+import pytest
+
+from app import blob_gc, models, storage_layout
+
+
+def _add_file(db_session, user, stored_path_for) -> models.File:
+    """Строка files и файл на диске по плоскому пути; stored_path_for(путь на диске) - что записать в БД."""
+    stored_uuid = uuid.uuid4()
+    flat_path = storage_layout.FlatLayout().blob_path(stored_uuid)
+    path_on_disk = storage_layout.ensure_parent_directory(flat_path)
+    with open(path_on_disk, "wb") as blob:
+        blob.write(os.urandom(1000))
+    db_file = models.File(
+        user_id=user.user_id, original_filename="old.bin", stored_filename_uuid=stored_uuid,
+        storage_path=stored_path_for(flat_path), mime_type="application/octet-stream", file_size_bytes=1000,
+        encryption_algorithm="AES-256-GCM", encryption_iv="00" * 12, encryption_auth_tag="00" * 16,
+        encrypted_dek_hex="00", dek_iv_hex="00" * 12, dek_auth_tag_hex="00" * 16
+    )
+    db_session.add(db_file)
+    db_session.commit()
+    return db_file
+
+
+def _migrate(client) -> storage_layout.MigrationStats:
+    return client.portal.call(lambda: storage_layout.migrate_files(batch_size=3))
+
+
+@pytest.fixture
+def old_rows(client, db_session, user):
+    if storage_layout.layout.name == "flat":
+        pytest.skip("the current layout is flat: nothing to move")
+    return [
+        _add_file(db_session, user, storage_layout.absolute_path), # Абсолютный путь, как в старых строках
+        _add_file(db_session, user, lambda flat_path: flat_path), # Относительный плоский путь
+    ]
+
+
+def test_migrate_relativizes_and_links(client, db_session, old_rows):
+    sources = {row.file_id: storage_layout.absolute_path(row.storage_path) for row in old_rows}
+    inodes = {file_id: os.stat(path).st_ino for file_id, path in sources.items()}
+
+    stats = _migrate(client)
+    assert stats.errors == 0
+    db_session.expire_all()
+    for row in old_rows:
+        db_file = db_session.get(models.File, row.file_id)
+        assert db_file.storage_path == storage_layout.layout.blob_path(db_file.stored_filename_uuid)
+        target = storage_layout.absolute_path(db_file.storage_path)
+        # Жесткая ссылка: тот же inode, данные не копировались; старый путь удален после коммита
+        assert os.stat(target).st_ino == inodes[row.file_id]
+        assert not os.path.exists(sources[row.file_id])
+
+    # Повторный запуск ничего не меняет
+    stats = _migrate(client)
+    assert stats.moved == stats.relativized == stats.errors == 0
+    db_session.expire_all()
+    for row in old_rows:
+        assert db_session.get(models.File, row.file_id).storage_path == storage_layout.layout.blob_path(row.stored_filename_uuid)
+
+
+def test_migrate_resumes_after_interruption(client, db_session, old_rows):
+    # Прерванный запуск: ссылка по новому пути уже создана, но строка не обновлена и старый путь не удален
+    row = old_rows[0]
+    source = storage_layout.absolute_path(row.storage_path)
+    target = storage_layout.ensure_parent_directory(storage_layout.layout.blob_path(row.stored_filename_uuid))
+    os.link(source, target)
+
+    stats = _migrate(client)
+    assert stats.errors == 0
+    db_session.expire_all()
+    assert db_session.get(models.File, row.file_id).storage_path == storage_layout.layout.blob_path(row.stored_filename_uuid)
+    assert os.path.exists(target)
+    assert not os.path.exists(source)
+
+
+def test_migrate_rows_with_file_already_in_place(client, db_session, user):
+    # Файл уже лежит по пути раскладки, а в БД абсолютный путь: переносить нечего, только переписать строку
+    db_file = _add_file(db_session, user, storage_layout.absolute_path)
+    target = storage_layout.layout.blob_path(db_file.stored_filename_uuid)
+    os.replace(storage_layout.absolute_path(db_file.storage_path), storage_layout.ensure_parent_directory(target))
+    db_file.storage_path = storage_layout.absolute_path(target)
+    db_session.commit()
+
+    stats = _migrate(client)
+    assert stats.relativized >= 1
+    db_session.expire_all()
+    assert db_session.get(models.File, db_file.file_id).storage_path == target
+
+
+def test_copy_fallback_uses_gc_temp_name(old_rows, monkeypatch):
+    # Без жестких ссылок (другая ФС) файл копируется под временным именем, которое знает сборщик
+    row = old_rows[0]
+    source = storage_layout.absolute_path(row.storage_path)
+    target = storage_layout.ensure_parent_directory(storage_layout.layout.blob_path(row.stored_filename_uuid))
+    temp_name = os.path.basename(storage_layout.temp_copy_path(target))
+    match = blob_gc.TEMP_NAME_RE.match(temp_name)
+    assert match and match.group(1) == str(row.stored_filename_uuid)
+
+    def no_links(source_path, target_path):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(storage_layout.os, "link", no_links)
+    storage_layout._link_or_copy(source, target)
+    assert os.stat(target).st_ino != os.stat(source).st_ino
+    with open(source, "rb") as source_file, open(target, "rb") as target_file:
+        assert source_file.read() == target_file.read()
+    assert [name for name in os.listdir(os.path.dirname(target)) if name.endswith(".tmp")] == []